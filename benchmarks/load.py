@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+End to end load test of the command line against local stand-ins of the
+replication feed, the OSM API and Mailgun.
+
+Usage: python benchmarks/load.py --nodes 100000 --ways 10000 --relations 500 --api-latency 0.02
+
+Generates a synthetic diff, serves it as the last sequence of a replication
+feed and runs `changewithin` on it. The previous versions of the modified
+elements are answered by the fake OSM API (history, NodeGet, WayFull and
+RelationGet) and the report is posted to the fake Mailgun. Each server can
+add latency and fail a ratio of the requests. The phases of the run are
+taken from the time the servers receive the requests:
+
+    startup     start of the process to the request of state.txt
+    download    state.txt to the end of the diff
+    processing  end of the diff to the report, or to the exit without report
+    report      report request to the exit
+
+With --host, --db, --user and --password the run uses the database cache.
+"""
+from __future__ import absolute_import, print_function
+import gzip
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+CLI = "from changewithin.cli import cli_generate_report; cli_generate_report()"
+BBOX = (41.9933, 2.8576, 41.9623, 2.7847)
+SEQUENCE = "000/000/001"
+TIMESTAMP = "2017-05-27T21:19:43Z"
+
+ROUTES = [
+    ("state", re.compile(r"^/replication/state\.txt$")),
+    ("diff", re.compile(r"^/replication/\d{3}/\d{3}/\d{3}\.osc\.gz$")),
+    ("history", re.compile(r"^/api/0\.6/(node|way|relation)/(\d+)/history$")),
+    ("way_full", re.compile(r"^/api/0\.6/way/(\d+)/full$")),
+    ("get", re.compile(r"^/api/0\.6/(node|relation)/(\d+)$")),
+    ("mailgun", re.compile(r"^/mailgun/messages$"))
+]
+
+
+def location(identifier):
+    """
+    Returns a stable location for an element id, half of them inside the
+    bounding box
+
+    :param identifier: Element id
+    :return: Tuple with lat and lon
+    """
+    rnd = random.Random(identifier)
+    if identifier % 2:
+        return rnd.uniform(BBOX[2], BBOX[0]), rnd.uniform(BBOX[3], BBOX[1])
+    return rnd.uniform(-80, 80), rnd.uniform(-180, 180)
+
+
+def tags_xml(identifier, version):
+    """
+    Returns the tags of an element version, a third of the elements change
+    the value of their building tag on each version
+
+    :param identifier: Element id
+    :param version: Element version
+    :return: XML of the tags
+    """
+    value = "yes" if identifier % 3 or version % 2 else "house"
+    return '<tag k="building" v="{0}"/><tag k="addr:housenumber" v="{1}"/>'.format(value, identifier % 200)
+
+
+def element_xml(element, identifier, version, body=""):
+    """
+    Returns the XML of an element version
+
+    :param element: node, way or relation
+    :param identifier: Element id
+    :param version: Element version
+    :param body: Node refs or members
+    :return: XML
+    """
+    attrs = 'id="{0}" version="{1}" changeset="{2}" timestamp="{3}" user="load" uid="1" visible="true"'.format(
+        identifier, version, identifier // 100 + version, TIMESTAMP)
+    if element == "node":
+        lat, lon = location(identifier)
+        attrs += ' lat="{0:.7f}" lon="{1:.7f}"'.format(lat, lon)
+    return '<{0} {1}>{2}{3}</{0}>'.format(element, attrs, body, tags_xml(identifier, version))
+
+
+def way_refs(identifier):
+    """
+    Returns the node ids of a way, the nodes are not part of the diff
+
+    :param identifier: Way id
+    :return: List of node ids
+    """
+    base = 10000000 + identifier * 4
+    return [base + offset for offset in range(4)]
+
+
+def write_diff(filename, nodes, ways, relations, modified):
+    """
+    Writes a gzipped synthetic diff
+
+    :param filename: Path of the osc.gz to write
+    :param nodes: Number of nodes
+    :param ways: Number of ways
+    :param relations: Number of relations
+    :param modified: Ratio of elements that are modifications of a previous version
+    :return: None
+    """
+    rnd = random.Random(42)
+    with gzip.open(filename, "wb") as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n')
+        for element, count in (("node", nodes), ("way", ways), ("relation", relations)):
+            for identifier in range(1, count + 1):
+                version = rnd.randint(2, 4) if rnd.random() < modified else 1
+                if element == "way":
+                    body = "".join('<nd ref="{0}"/>'.format(ref) for ref in way_refs(identifier))
+                elif element == "relation":
+                    body = '<member type="way" ref="{0}" role="outer"/><member type="node" ref="{1}" role=""/>'.format(
+                        identifier, identifier)
+                else:
+                    body = ""
+                action = "create" if version == 1 else "modify"
+                f.write('<{0}>{1}</{0}>\n'.format(action, element_xml(element, identifier, version, body)).encode("utf-8"))
+        f.write(b'</osmChange>\n')
+
+
+class Stats(object):
+    """
+    Requests received by the fake servers
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.events = {}
+
+    def add(self, route, start, end, failed):
+        with self.lock:
+            data = self.requests.setdefault(route, {"count": 0, "errors": 0, "times": []})
+            data["count"] += 1
+            data["errors"] += 1 if failed else 0
+            data["times"].append(end - start)
+            first, last = self.events.get(route, (start, end))
+            self.events[route] = (min(first, start), max(last, end))
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Replication feed, OSM API and Mailgun on a single local port
+    """
+    daemon_threads = True
+
+    def __init__(self, diff, latency, error_rate):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeRequestHandler)
+        self.diff = diff
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = Stats()
+        self.random = random.Random(7)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of the command line
+    """
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written apart, without this each keep
+    # alive response waits for the delayed ack of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, content, content_type="text/xml; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def dispatch(self):
+        start = time.time()
+        path = self.path.split("?")[0]
+        for route, regex in ROUTES:
+            match = regex.match(path)
+            if match:
+                break
+        else:
+            self.send(404, b"Not found", "text/plain")
+            return
+        service = {"state": "feed", "diff": "feed", "mailgun": "mail"}.get(route, "api")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.server.latency[service])
+        failed = self.server.random.random() < self.server.error_rate[service]
+        if failed:
+            self.send(500, b"Internal error", "text/plain")
+        else:
+            self.answer(route, match)
+        self.server.stats.add(route, start, time.time(), failed)
+
+    do_GET = dispatch
+    do_POST = dispatch
+
+    def answer(self, route, match):
+        if route == "state":
+            content = "#{0}\nsequenceNumber={1}\ntimestamp={2}\n".format(
+                TIMESTAMP, int(SEQUENCE.replace("/", "")), TIMESTAMP.replace(":", "\\:"))
+            self.send(200, content.encode("utf-8"), "text/plain")
+        elif route == "diff":
+            with open(self.server.diff, "rb") as f:
+                self.send(200, f.read(), "application/x-gzip")
+        elif route == "history":
+            element, identifier = match.group(1), int(match.group(2))
+            body = ""
+            if element == "way":
+                body = "".join('<nd ref="{0}"/>'.format(ref) for ref in way_refs(identifier))
+            elif element == "relation":
+                body = '<member type="way" ref="{0}" role="outer"/>'.format(identifier)
+            versions = "".join(element_xml(element, identifier, version, body) for version in range(1, 5))
+            self.send(200, '<osm version="0.6">{0}</osm>'.format(versions).encode("utf-8"))
+        elif route == "way_full":
+            identifier = int(match.group(1))
+            refs = way_refs(identifier)
+            body = "".join('<nd ref="{0}"/>'.format(ref) for ref in refs)
+            content = "".join(element_xml("node", ref, 1) for ref in refs) + element_xml("way", identifier, 1, body)
+            self.send(200, '<osm version="0.6">{0}</osm>'.format(content).encode("utf-8"))
+        elif route == "get":
+            element, identifier = match.group(1), int(match.group(2))
+            body = ""
+            if element == "relation":
+                body = '<member type="way" ref="{0}" role="outer"/>'.format(identifier)
+            content = element_xml(element, identifier, 1, body)
+            self.send(200, '<osm version="0.6">{0}</osm>'.format(content).encode("utf-8"))
+        elif route == "mailgun":
+            self.send(200, b'{"id": "<load@example.com>", "message": "Queued. Thank you."}', "application/json")
+
+
+def write_config(filename, url):
+    """
+    Writes the configuration of the run, pointing to the fake servers
+
+    :param filename: Path of the configuration
+    :param url: Base url of the fake servers
+    :return: None
+    """
+    with open(filename, "w") as f:
+        f.write("""[email]
+    recipients = load@example.com
+
+[area]
+    bbox = {bbox}
+
+[mailgun]
+    domain = example.com
+    api_key = key-load
+    api_url = {url}/mailgun/messages
+
+[tags]
+    [[building]]
+        tags = building=.*
+        type = node,way
+
+[osm]
+    api_url = {url}
+
+[replication]
+    url = {url}/replication
+""".format(bbox=", ".join(str(x) for x in BBOX), url=url))
+
+
+def percentile(values, ratio):
+    """
+    Returns a percentile of a list of values
+
+    :param values: Values
+    :param ratio: Percentile between 0 and 1
+    :return: Value
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+@click.command()
+@click.option("--nodes", default=100000)
+@click.option("--ways", default=10000)
+@click.option("--relations", default=500)
+@click.option("--modified", default=0.3, help="Ratio of elements that modify a previous version")
+@click.option("--feed-latency", default=0.0, help="Seconds added to each request of the replication feed")
+@click.option("--api-latency", default=0.01, help="Seconds added to each request of the OSM API")
+@click.option("--api-error-rate", default=0.0, help="Ratio of failed requests of the OSM API")
+@click.option("--mail-latency", default=0.1, help="Seconds added to the request of Mailgun")
+@click.option("--mail-error-rate", default=0.0, help="Ratio of failed requests of Mailgun")
+@click.option("--report/--no-report", default=True)
+@click.option("--host", default=None)
+@click.option("--db", default=None)
+@click.option("--user", default=None)
+@click.option("--password", default=None)
+def bench(nodes, ways, relations, modified, feed_latency, api_latency, api_error_rate, mail_latency,
+          mail_error_rate, report, host, db, user, password):
+    workdir = tempfile.mkdtemp(prefix="changewithin-load-")
+    try:
+        diff = os.path.join(workdir, "diff.osc.gz")
+        start = time.time()
+        write_diff(diff, nodes, ways, relations, modified)
+        print("diff: {0} nodes, {1} ways, {2} relations, {3:.1f} MiB, generated in {4:.1f}s".format(
+            nodes, ways, relations, os.path.getsize(diff) / 1048576.0, time.time() - start))
+
+        server = FakeServer(diff, {"feed": feed_latency, "api": api_latency, "mail": mail_latency},
+                            {"feed": 0.0, "api": api_error_rate, "mail": mail_error_rate})
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        config = os.path.join(workdir, "config.ini")
+        write_config(config, server.url)
+        env = dict(os.environ, BARD_CONFIG=config)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + env.get("PYTHONPATH", "").split(os.pathsep))
+        args = [sys.executable, "-c", CLI]
+        if not report:
+            args.append("--no-report")
+        if host is not None:
+            args += ["--host", host, "--db", db, "--user", user, "--password", password]
+
+        log = os.path.join(workdir, "run.log")
+        with open(log, "w") as out:
+            start = time.time()
+            code = subprocess.call(args, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+            end = time.time()
+        server.shutdown()
+        server.server_close()
+
+        with open(log) as f:
+            output = f.read()
+        if code != 0 or "Traceback" in output:
+            print("the run failed with code {0}:\n{1}".format(code, output[-2000:]))
+
+        stats = server.stats
+        events = stats.events
+        state_start = events.get("state", (end, end))[0]
+        diff_end = events.get("diff", (state_start, state_start))[1]
+        report_start = events.get("mailgun", (end, end))[0]
+        phases = [
+            ("startup", state_start - start),
+            ("download", diff_end - state_start),
+            ("processing", report_start - diff_end),
+            ("report", end - report_start)
+        ]
+        elements = nodes + ways + relations
+        print("\n{0:<12} {1:>9}".format("phase", "seconds"))
+        for name, elapsed in phases:
+            print("{0:<12} {1:>9.3f}".format(name, elapsed))
+        print("{0:<12} {1:>9.3f}".format("total", end - start))
+        processing = phases[2][1]
+        if processing > 0:
+            print("\nthroughput: {0:.0f} elements/s during processing, {1:.0f} elements/s end to end".format(
+                elements / processing, elements / (end - start)))
+
+        print("\n{0:<10} {1:>8} {2:>7} {3:>9} {4:>9} {5:>9}".format("request", "count", "errors", "mean ms",
+                                                                     "p95 ms", "total s"))
+        for route, regex in ROUTES:
+            if route not in stats.requests:
+                continue
+            data = stats.requests[route]
+            times = data["times"]
+            print("{0:<10} {1:>8} {2:>7} {3:>9.1f} {4:>9.1f} {5:>9.2f}".format(
+                route, data["count"], data["errors"], sum(times) / len(times) * 1000,
+                percentile(times, 0.95) * 1000, sum(times)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the node path of ChangeHandler, node by node against the batch
+of nodes stored on the cache.
+
+Usage: python benchmarks/node_filter.py --nodes 200000 --host localhost --db changewithin --user osm --password osm
+
+The batch is only used with the cache, where each batch of nodes is stored
+with one bulk INSERT instead of one INSERT per node. The benchmark reports
+the time and the INSERT statements sent to the database by each path.
+
+Without the database options both handlers check the nodes one by one, the
+default batch size doesn't change the run without cache. Batching there was
+slower, 1.93s against 1.49s node by node on 200000 nodes, as every node was
+copied into the batch to repeat the spatial filter already done on it.
+"""
+from __future__ import absolute_import, print_function
+import os
+import random
+import time
+from tempfile import mkstemp
+
+import click
+
+from changewithin.changewithin import ChangeHandler
+
+BBOX = (41.9933, 2.8576, 41.9623, 2.7847)
+
+
+def write_diff(filename, nodes, tagged):
+    """
+    Writes a synthetic diff with nodes spread over the world
+
+    :param filename: Path of the osc to write
+    :param nodes: Number of nodes
+    :param tagged: Ratio of tagged nodes
+    :return: None
+    """
+    rnd = random.Random(42)
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <create>\n')
+        for identifier in range(1, nodes + 1):
+            if rnd.random() < 0.01:
+                lat = rnd.uniform(BBOX[2], BBOX[0])
+                lon = rnd.uniform(BBOX[3], BBOX[1])
+            else:
+                lat = rnd.uniform(-80, 80)
+                lon = rnd.uniform(-180, 180)
+            f.write('  <node id="{0}" version="1" changeset="{1}" timestamp="2017-05-27T21:19:43Z" '
+                    'user="bench" uid="1" lat="{2:.7f}" lon="{3:.7f}"'.format(identifier, identifier // 100, lat, lon))
+            if rnd.random() < tagged:
+                f.write('>\n   <tag k="building" v="yes"/>\n   <tag k="addr:housenumber" v="{0}"/>\n  </node>\n'.format(
+                    identifier % 200))
+            else:
+                f.write('/>\n')
+        f.write(' </create>\n</osmChange>\n')
+
+
+def run(filename, node_batch_size, db=None):
+    """
+    Applies a handler to the file
+
+    :param filename: Path of the osc
+    :param node_batch_size: Batch size of the handler
+    :param db: Tuple with host, database, user and password of the cache
+    :return: Elapsed seconds and the handler
+    """
+    handler = ChangeHandler(node_batch_size=node_batch_size)
+    handler.inserts = 0
+    if db is not None:
+        handler.set_cache(*db)
+        add_node = handler.cache.add_node
+        add_nodes = handler.cache.add_nodes
+
+        def count_node(*args, **kwargs):
+            handler.inserts += 1
+            return add_node(*args, **kwargs)
+
+        def count_nodes(*args, **kwargs):
+            handler.inserts += 1
+            return add_nodes(*args, **kwargs)
+
+        handler.cache.add_node = count_node
+        handler.cache.add_nodes = count_nodes
+    handler.set_bbox(*BBOX)
+    handler.set_tags("building", "building", ".*", ["node", "way"])
+    handler.set_tags("housenumber", "addr:housenumber", ".*", ["node", "way"])
+    start = time.time()
+    handler.apply_file(filename)
+    handler.flush_nodes()
+    if handler.cache_enabled:
+        handler.cache.commit()
+    return time.time() - start, handler
+
+
+@click.command()
+@click.option("--nodes", default=500000)
+@click.option("--tagged", default=0.1)
+@click.option("--batch", default=10000)
+@click.option("--host", default=None)
+@click.option("--db", default=None)
+@click.option("--user", default=None)
+@click.option("--password", default=None)
+def bench(nodes, tagged, batch, host, db, user, password):
+    cache = None
+    if host is not None:
+        cache = (host, db, user, password)
+    handle, filename = mkstemp(prefix='bench-', suffix='.osc')
+    os.close(handle)
+    try:
+        write_diff(filename, nodes, tagged)
+        single_time, single = run(filename, 0, cache)
+        batch_time, batched = run(filename, batch, cache)
+        assert single.changeset == batched.changeset
+        print("nodes: {0} cache: {1}".format(nodes, cache is not None))
+        print("node by node: {0:.2f}s ({1:.0f} nodes/s), {2} inserts".format(
+            single_time, nodes / single_time, single.inserts))
+        print("batch of {0}: {1:.2f}s ({2:.0f} nodes/s), {3} inserts".format(
+            batch, batch_time, nodes / batch_time, batched.inserts))
+        print("speedup: {0:.1f}x".format(single_time / batch_time))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the native pre-filter of ChangeHandler, the objects that reach
+the Python callbacks and the time of a diff with and without it.
+
+Usage: python benchmarks/prefilter.py --nodes 1000000 --ways 100000
+
+The tags are watched with exact keys (building$ and addr:housenumber$), so
+the reader drops the untagged objects and the ones without those keys.
+"""
+from __future__ import absolute_import, print_function
+import os
+import random
+import time
+from tempfile import mkstemp
+
+import click
+import osmium
+
+from changewithin.changewithin import ChangeHandler
+
+BBOX = (41.9933, 2.8576, 41.9623, 2.7847)
+
+
+def write_diff(filename, nodes, ways, tagged, watched):
+    """
+    Writes a synthetic diff with nodes spread over the world and ways of
+    four consecutive nodes
+
+    :param filename: Path of the osc to write
+    :param nodes: Number of nodes
+    :param ways: Number of ways
+    :param tagged: Ratio of tagged nodes
+    :param watched: Ratio of tagged objects with the watched tags
+    :return: None
+    """
+    rnd = random.Random(42)
+
+    def tags():
+        if rnd.random() < watched:
+            return '<tag k="building" v="yes"/><tag k="addr:housenumber" v="{0}"/>'.format(rnd.randint(1, 200))
+        return '<tag k="highway" v="residential"/>'
+
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <create>\n')
+        for identifier in range(1, nodes + 1):
+            if rnd.random() < 0.01:
+                lat = rnd.uniform(BBOX[2], BBOX[0])
+                lon = rnd.uniform(BBOX[3], BBOX[1])
+            else:
+                lat = rnd.uniform(-80, 80)
+                lon = rnd.uniform(-180, 180)
+            f.write('  <node id="{0}" version="1" changeset="{1}" timestamp="2017-05-27T21:19:43Z" '
+                    'user="bench" uid="1" lat="{2:.7f}" lon="{3:.7f}"'.format(identifier, identifier // 100, lat, lon))
+            if rnd.random() < tagged:
+                f.write('>{0}</node>\n'.format(tags()))
+            else:
+                f.write('/>\n')
+        for identifier in range(1, ways + 1):
+            first = rnd.randint(1, max(1, nodes - 4))
+            refs = "".join('<nd ref="{0}"/>'.format(first + offset) for offset in range(4))
+            f.write('  <way id="{0}" version="1" changeset="{1}" timestamp="2017-05-27T21:19:43Z" '
+                    'user="bench" uid="1">{2}{3}</way>\n'.format(identifier, identifier // 100, refs, tags()))
+        f.write(' </create>\n</osmChange>\n')
+
+
+def run(filename, prefilter):
+    """
+    Applies a handler to the file
+
+    :param filename: Path of the osc
+    :param prefilter: True to drop the objects in the reader
+    :return: Elapsed seconds and the handler
+    """
+    handler = ChangeHandler()
+    handler.prefilter = prefilter
+    handler.set_bbox(*BBOX)
+    handler.set_tags("building", "building$", ".*", ["node", "way"])
+    handler.set_tags("housenumber", "addr:housenumber$", ".*", ["node", "way"])
+    start = time.time()
+    filters = handler.prefilters()
+    if filters:
+        handler.apply_file(filename, osmium.osm.osm_entity_bits.CHANGESET, filters=filters)
+    else:
+        handler.apply_file(filename, osmium.osm.osm_entity_bits.CHANGESET)
+    handler.flush_nodes()
+    return time.time() - start, handler
+
+
+@click.command()
+@click.option("--nodes", default=500000)
+@click.option("--ways", default=50000)
+@click.option("--tagged", default=0.1, help="Ratio of tagged nodes")
+@click.option("--watched", default=0.2, help="Ratio of tagged objects with the watched tags")
+def bench(nodes, ways, tagged, watched):
+    handle, filename = mkstemp(prefix='bench-', suffix='.osc')
+    os.close(handle)
+    try:
+        write_diff(filename, nodes, ways, tagged, watched)
+        plain_time, plain = run(filename, False)
+        filtered_time, filtered = run(filename, True)
+        assert plain.changeset == filtered.changeset
+        print("nodes: {0} ways: {1}".format(nodes, ways))
+        print("{0:<12} {1:>12} {2:>12} {3:>9}".format("", "node calls", "way calls", "seconds"))
+        for name, elapsed, handler in (("python", plain_time, plain), ("pre-filter", filtered_time, filtered)):
+            print("{0:<12} {1:>12} {2:>12} {3:>9.2f}".format(name, handler.num_nodes, handler.num_ways, elapsed))
+        print("callbacks: {0:.1f}% of the objects reach python, speedup: {1:.1f}x".format(
+            100.0 * (filtered.num_nodes + filtered.num_ways) / (plain.num_nodes + plain.num_ways),
+            plain_time / filtered_time))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the startup time of the command line.
+
+Usage: python benchmarks/startup.py --runs 20
+
+Measures `changewithin --help` and the creation of ChangeWithin as done by
+`changewithin --initialize` (without database). With --host, --db, --user and
+--password it also measures a full `changewithin --initialize`.
+"""
+from __future__ import absolute_import, print_function
+import subprocess
+import sys
+import time
+
+import click
+
+CLI = "from changewithin.cli import cli_generate_report; cli_generate_report()"
+INIT = "from changewithin.changewithin import ChangeWithin; ChangeWithin().initialize_db()"
+
+# Targets in seconds, median of the runs
+TARGETS = {
+    "--help": 0.15,
+    "--initialize": 0.2
+}
+
+
+def measure(args, runs):
+    """
+    Runs a python command several times
+
+    :param args: Arguments of the python interpreter
+    :param runs: Number of runs
+    :return: Median of the elapsed seconds
+    """
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, stdout=subprocess.PIPE)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+@click.command()
+@click.option("--runs", default=10)
+@click.option("--host", default=None)
+@click.option("--db", default=None)
+@click.option("--user", default=None)
+@click.option("--password", default=None)
+def bench(runs, host, db, user, password):
+    baseline = measure(["-c", "pass"], runs)
+    results = [
+        ("--help", measure(["-c", CLI, "--help"], runs)),
+    ]
+    if host is not None:
+        results.append(("--initialize", measure(
+            ["-c", CLI, "--initialize", "--host", host, "--db", db, "--user", user, "--password", password], runs)))
+    else:
+        results.append(("--initialize", measure(["-c", INIT], runs)))
+    print("python startup: {0:.3f}s".format(baseline))
+    failed = False
+    for name, elapsed in results:
+        ok = elapsed <= TARGETS[name]
+        failed = failed or not ok
+        print("{0:<14} {1:.3f}s target {2:.3f}s {3}".format(name, elapsed, TARGETS[name], "ok" if ok else "SLOW"))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    bench()
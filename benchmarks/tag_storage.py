@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the tag storage of the cache, hstore against the dictionary of
+interned keys and values.
+
+Usage: python benchmarks/tag_storage.py --host localhost --db changewithin --user user --password password
+
+Writes the same synthetic nodes with each storage into an initialized
+cache and reports the bytes of the tag columns, with the rows of the
+dictionary for the interned layout, and the time of get_node on a sample
+of them. Everything is written in a transaction that is rolled back at the
+end, the cache is left as it was.
+"""
+from __future__ import absolute_import, print_function
+import random
+import time
+
+import click
+
+from changewithin.changewithin import DbCache
+
+# Popular tags of the buildings, most values repeat across the nodes
+STREETS = ["Carrer Nou", "Carrer del Carme", "Rambla de la Llibertat", "Pujada de Sant Feliu", "Carrer Major"]
+
+
+def node_tags(rnd, identifier):
+    """
+    Returns the tags of a synthetic node
+
+    :param rnd: Random generator
+    :param identifier: Node id
+    :return: Tags
+    """
+    tags = {"building": rnd.choice(["yes", "yes", "yes", "house", "residential"])}
+    if rnd.random() < 0.6:
+        tags["addr:street"] = rnd.choice(STREETS)
+        tags["addr:housenumber"] = str(identifier % 300)
+        tags["addr:postcode"] = "1700{0}".format(identifier % 5)
+        tags["addr:city"] = "Girona"
+    if rnd.random() < 0.05:
+        tags["name"] = "Building {0}".format(identifier)
+    return tags
+
+
+def write_nodes(cache, first, count, storage):
+    """
+    Writes the synthetic nodes with a storage
+
+    :param cache: Cache
+    :param first: Id of the first node
+    :param count: Number of nodes
+    :param storage: hstore or dictionary
+    :return: Elapsed seconds
+    """
+    rnd = random.Random(42)
+    cache.tag_storage = storage
+    start = time.time()
+    batch = []
+    for identifier in range(first, first + count):
+        batch.append((identifier, 1, rnd.uniform(41.9623, 41.9933), rnd.uniform(2.7847, 2.8576),
+                      node_tags(rnd, identifier)))
+        if len(batch) == 10000:
+            cache.add_nodes(batch)
+            batch = []
+    cache.add_nodes(batch)
+    return time.time() - start
+
+
+def read_nodes(cache, ids):
+    """
+    Reads nodes with get_node
+
+    :param cache: Cache
+    :param ids: Node ids
+    :return: Elapsed seconds
+    """
+    start = time.time()
+    for identifier in ids:
+        cache.get_node(identifier)
+    return time.time() - start
+
+
+@click.command()
+@click.option("--nodes", default=200000)
+@click.option("--lookups", default=10000)
+@click.option("--host", required=True)
+@click.option("--db", required=True)
+@click.option("--user", required=True)
+@click.option("--password", required=True)
+def bench(nodes, lookups, host, db, user, password):
+    from changewithin.tagdict import TagDictionary
+
+    cache = DbCache(host, db, user, password)
+    cur = cache.con.cursor()
+    # Far from the ids of OSM
+    first = 10 ** 15
+    try:
+        hstore_write = write_nodes(cache, first, nodes, "hstore")
+        dictionary_write = write_nodes(cache, first + nodes, nodes, "dictionary")
+        cur.execute("ANALYZE cache_node;")
+        cur.execute("""
+        SELECT sum(pg_column_size(tag)) FILTER (WHERE id < %s),
+               sum(pg_column_size(tag_ids)) FILTER (WHERE id >= %s)
+        FROM cache_node WHERE id >= %s;
+        """, (first + nodes, first + nodes, first))
+        hstore_size, ids_size = cur.fetchone()
+        cur.execute("SELECT count(*), coalesce(sum(pg_column_size(text) + 4), 0) FROM cache_tag_text;")
+        texts, dictionary_size = cur.fetchone()
+
+        rnd = random.Random(7)
+        sample = [rnd.randrange(nodes) for _ in range(lookups)]
+        hstore_read = read_nodes(cache, [first + offset for offset in sample])
+        cache.tag_dictionary = TagDictionary()
+        dictionary_cold = read_nodes(cache, [first + nodes + offset for offset in sample])
+        dictionary_read = read_nodes(cache, [first + nodes + offset for offset in sample])
+
+        print("nodes: {0}, dictionary texts: {1}".format(nodes, texts))
+        print("\n{0:<22} {1:>12} {2:>10} {3:>14}".format("storage", "tag bytes", "write s", "get_node us"))
+        print("{0:<22} {1:>12} {2:>10.2f} {3:>14.1f}".format(
+            "hstore", hstore_size, hstore_write, hstore_read / lookups * 1e6))
+        print("{0:<22} {1:>12} {2:>10.2f} {3:>14.1f}".format(
+            "dictionary (cold)", ids_size + dictionary_size, dictionary_write, dictionary_cold / lookups * 1e6))
+        print("{0:<22} {1:>12} {2:>10} {3:>14.1f}".format(
+            "dictionary (warm)", ids_size + dictionary_size, "", dictionary_read / lookups * 1e6))
+        print("\nsize ratio: {0:.2f}".format(float(ids_size + dictionary_size) / hstore_size))
+    finally:
+        cur.close()
+        cache.con.rollback()
+        cache.close()
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,5 +1,18 @@
 from __future__ import absolute_import
-from changewithin.changewithin import ChangeWithin
-from changewithin.changewithin import ChangeHandler
-from changewithin.changewithin import get_state
-from changewithin.changewithin import get_osc
\ No newline at end of file
+import sys
+
+if sys.version_info >= (3, 7):
+    # Resolved on first access, so the command line can start without
+    # loading the processing module and its dependencies
+    _LAZY = ["ChangeWithin", "ChangeHandler", "get_state", "get_osc"]
+
+    def __getattr__(name):
+        if name in _LAZY:
+            from changewithin import changewithin as module
+            return getattr(module, name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    from changewithin.changewithin import ChangeWithin
+    from changewithin.changewithin import ChangeHandler
+    from changewithin.changewithin import get_state
+    from changewithin.changewithin import get_osc
\ No newline at end of file
@@ -0,0 +1,426 @@
+from __future__ import absolute_import
+import io
+import os
+import sys
+from datetime import datetime, timedelta
+
+
+def parse_timestamp(text):
+    """
+    Returns the timestamp of a state.txt
+
+    :param text: Content of the state file
+    :type text: str
+    :return: Timestamp of the last change included in the sequence
+    :rtype: datetime
+    """
+    for line in text.splitlines():
+        if line.startswith("timestamp="):
+            # The colons are escaped as in a java properties file
+            value = line.split("=", 1)[1].strip().replace("\\:", ":")
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    raise ValueError("state.txt without timestamp")
+
+
+class SequenceIndex(object):
+    """
+    Finds the replication sequences of a range of dates from their state
+    files. The states are downloaded once and kept while the index lives.
+    """
+
+    def __init__(self, url, timeout=10.0):
+        """
+        Class constructor
+
+        :param url: Base url of the replication files
+        :type url: str
+        :param timeout: Seconds to wait for the server on each request
+        :type timeout: float
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = None
+        self.timestamps = {}
+
+    def get(self, path):
+        """
+        Downloads a state file
+
+        :param path: Path of the file from the base url
+        :type path: str
+        :return: Content of the file
+        :rtype: str
+        """
+        if self.session is None:
+            import requests
+
+            self.session = requests.Session()
+        resp = self.session.get("{}/{}".format(self.url, path), timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.text
+
+    def latest(self):
+        """
+        Returns the last sequence of the replication
+
+        :return: Sequence number
+        :rtype: int
+        """
+        from changewithin.mirror import parse_state
+
+        text = self.get("state.txt")
+        sequence = int(parse_state(text))
+        self.timestamps[sequence] = parse_timestamp(text)
+        return sequence
+
+    def timestamp(self, sequence):
+        """
+        Returns the timestamp of a sequence
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Timestamp of the last change included in the sequence
+        :rtype: datetime
+        """
+        from changewithin.mirror import sequence_path
+
+        if sequence not in self.timestamps:
+            self.timestamps[sequence] = parse_timestamp(self.get("{}.state.txt".format(sequence_path(sequence))))
+        return self.timestamps[sequence]
+
+    def first_after(self, moment, low, high):
+        """
+        Returns the first sequence with a timestamp after a moment, with a
+        binary search between two sequences
+
+        :param moment: Moment to search
+        :type moment: datetime
+        :param low: First sequence of the search
+        :type low: int
+        :param high: Last sequence of the search
+        :type high: int
+        :return: Sequence number, high + 1 if all of them are before the moment
+        :rtype: int
+        """
+        high += 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) > moment:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def sequences(self, start, end):
+        """
+        Returns the sequences with the changes of a range of days
+
+        :param start: First day included
+        :type start: datetime.date
+        :param end: Last day included
+        :type end: datetime.date
+        :return: Sequence numbers, oldest first
+        :rtype: list
+        """
+        last = self.latest()
+        start = datetime(start.year, start.month, start.day)
+        end = datetime(end.year, end.month, end.day) + timedelta(days=1)
+        first = self.first_after(start, 0, last)
+        after = self.first_after(end, first, last)
+        return list(range(first, after))
+
+    def interval(self, sequence):
+        """
+        Returns the time covered by a sequence
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Time between the previous sequence and this one
+        :rtype: timedelta
+        """
+        if sequence == 0:
+            return timedelta(days=1)
+        return self.timestamp(sequence) - self.timestamp(sequence - 1)
+
+    def day(self, sequence):
+        """
+        Returns the day of the changes of a sequence. The timestamp is the end
+        of the covered time, a daily diff finishes at midnight of the next day
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Day
+        :rtype: datetime.date
+        """
+        return (self.timestamp(sequence) - self.interval(sequence)).date()
+
+
+def process_sequence(task):
+    """
+    Downloads and matches the diff of a sequence, runs on the workers of
+    the pool
+
+    :param task: Tuple with the configuration, the replication url, the sequence number, True to keep the diff
+        and True to return the matched changes
+    :type task: tuple
+    :return: dict with the sequence, the changesets, the stats as lists, the total, the approximate stats
+        serialized or None, the failed elements, the path of the diff if it was kept and the matched changes
+        or None
+    :rtype: dict
+    """
+    from changewithin.changewithin import ChangeWithin, get_osc
+    from changewithin.export import ChangeList
+
+    conf, url, sequence, keep, store = task
+    changewithin = ChangeWithin()
+    changewithin.load_config(conf)
+    # The processes of the pool already run in parallel
+    changewithin.lookup_workers = 0
+    changes = None
+    if store:
+        # Without cache here, the main process stores them
+        changes = ChangeList()
+        changewithin.handler.exporters.append(changes)
+    filename = get_osc(mirror=changewithin.mirror, url=url, sequence=sequence)
+    temporary = changewithin.mirror is None
+    try:
+        changewithin.process_file(filename)
+    except Exception:
+        if temporary:
+            os.unlink(filename)
+        raise
+    if temporary and not keep:
+        os.unlink(filename)
+    stats = {}
+    for name, value in changewithin.stats.items():
+        stats[name] = value if isinstance(value, int) else list(value)
+    sketch = changewithin.handler.sketch
+    return {
+        "sequence": sequence,
+        "changesets": changewithin.changesets,
+        "stats": stats,
+        "total": stats.pop("total", len(changewithin.changesets)),
+        "sketch": sketch.dumps() if sketch is not None else None,
+        "errors": changewithin.handler.errors.failed,
+        "filename": filename if keep else None,
+        "temporary": temporary,
+        "changes": changes.changes if changes is not None else None
+    }
+
+
+class BackfillResults(object):
+    """
+    Merges the results of the diffs of a period. A changeset of several
+    diffs of the period keeps the elements of all of them.
+    """
+
+    def __init__(self, limit=1000):
+        """
+        Class constructor
+
+        :param limit: Number of changesets kept for the report
+        :type limit: int
+        """
+        self.limit = limit
+        self.changesets = {}
+        self.ids = set()
+        self.stats = {}
+        self.counts = {}
+        self.truncated = 0
+        self.errors = 0
+        self.sequences = 0
+        self.sketch = None
+
+    def add(self, result):
+        """
+        Adds the result of a diff
+
+        :param result: Result of process_sequence
+        :type result: dict
+        :return: None
+        """
+        self.sequences += 1
+        self.errors += result["errors"]
+        if result.get("sketch") is not None:
+            from changewithin.sketch import ApproximateStats
+
+            # Read again, the same result is merged in several periods
+            sketch = ApproximateStats.loads(result["sketch"])
+            if self.sketch is None:
+                self.sketch = sketch
+            else:
+                self.sketch.merge(sketch)
+            return
+        for identifier, changeset in result["changesets"].items():
+            self.ids.add(identifier)
+            current = self.changesets.get(identifier)
+            if current is None:
+                if len(self.changesets) < self.limit:
+                    # Copied, the same result is merged in several periods
+                    current = dict(changeset)
+                    for ids_key in ("nids", "wids", "rids"):
+                        current[ids_key] = dict((tag_name, list(ids)) for tag_name, ids in changeset[ids_key].items())
+                    self.changesets[identifier] = current
+                continue
+            for ids_key in ("nids", "wids", "rids"):
+                for tag_name, ids in changeset[ids_key].items():
+                    current[ids_key].setdefault(tag_name, []).extend(ids)
+        for name, value in result["stats"].items():
+            if isinstance(value, int):
+                # Counts of the spilled diffs can't be deduplicated
+                self.counts[name] = self.counts.get(name, 0) + value
+            else:
+                self.stats.setdefault(name, set()).update(value)
+        # The spilled diffs only return the first changesets
+        self.truncated += max(0, result["total"] - len(result["changesets"]))
+
+    def report_stats(self):
+        """
+        Returns the stats of the report
+
+        :return: Changesets by tag name and the total
+        :rtype: dict
+        """
+        if self.sketch is not None:
+            return self.sketch.report_stats()
+        stats = dict((name, len(ids)) for name, ids in self.stats.items())
+        for name, count in self.counts.items():
+            stats[name] = stats.get(name, 0) + count
+        stats["total"] = len(self.ids) + self.truncated
+        return stats
+
+
+def write_report(changewithin, results, date, filename):
+    """
+    Writes the HTML report of some results
+
+    :param changewithin: Configured instance used to render
+    :type changewithin: changewithin.changewithin.ChangeWithin
+    :param results: Merged results
+    :type results: BackfillResults
+    :param date: Date of the report
+    :type date: datetime.date
+    :param filename: Path of the report
+    :type filename: str
+    :return: None
+    """
+    html_version, text_version = changewithin.render(results.changesets, results.report_stats(), date)
+    with io.open(filename, "w", encoding="utf-8") as f_out:
+        f_out.write(html_version)
+
+
+def backfill(changewithin, start, end, workers=None, output_dir="."):
+    """
+    Matches the diffs of a range of days with a pool of processes and
+    writes a report for each day and a summary of the period. The diffs are
+    downloaded and matched in parallel without cache, the results arrive in
+    sequence order and, if the instance has a cache, each diff is then
+    stored on it in that order so its versions stay consistent, with its
+    matched changes when the instance stores the results.
+
+    :param changewithin: Instance with the configuration loaded
+    :type changewithin: changewithin.changewithin.ChangeWithin
+    :param start: First day included
+    :type start: datetime.date
+    :param end: Last day included
+    :type end: datetime.date
+    :param workers: Number of processes, the number of CPUs by default
+    :type workers: int
+    :param output_dir: Directory of the reports
+    :type output_dir: str
+    :return: Paths of the reports written, the summary last
+    :rtype: list
+    """
+    from multiprocessing import Pool
+    from changewithin.export import ResultWriter
+    from changewithin.mirror import REPLICATION_URL, sequence_path
+
+    if changewithin.mirror is not None:
+        url = changewithin.mirror.url
+    else:
+        url = changewithin.replication_url or REPLICATION_URL
+    index = SequenceIndex(url)
+    sequences = index.sequences(start, end)
+    if not sequences:
+        sys.stderr.write('no replication sequences from {} to {}\n'.format(start, end))
+        return []
+    sys.stderr.write('backfilling sequences {} to {}\n'.format(sequences[0], sequences[-1]))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    conf = changewithin.conf.dict() if hasattr(changewithin.conf, "dict") else dict(changewithin.conf)
+    # Past changes are not pushed
+    conf.pop("webhooks", None)
+    keep = changewithin.handler.cache_enabled
+    store = keep and changewithin.store_results
+    tasks = [(conf, url, sequence, keep, store) for sequence in sequences]
+    reports = []
+    summary = BackfillResults()
+    day = None
+    daily = None
+    pool = Pool(workers)
+    try:
+        for result in pool.imap(process_sequence, tasks):
+            if result["filename"] is not None:
+                try:
+                    changewithin.cache_file(result["filename"])
+                finally:
+                    if result["temporary"]:
+                        os.unlink(result["filename"])
+            if result["changes"] is not None:
+                results = ResultWriter(changewithin.handler.cache, "{}/{}.osc.gz".format(
+                    url, sequence_path(result["sequence"])))
+                for change in result["changes"]:
+                    results.write(change)
+                results.close()
+            result_day = index.day(result["sequence"])
+            if result_day != day:
+                if daily is not None:
+                    reports.append(write_day(changewithin, daily, day, output_dir))
+                day = result_day
+                daily = BackfillResults()
+            daily.add(result)
+            summary.add(result)
+            sys.stderr.write('sequence {} of {}: {} changesets\n'.format(
+                result["sequence"], day, len(result["changesets"]) or result["total"]))
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    reports.append(write_day(changewithin, daily, day, output_dir))
+
+    filename = os.path.join(output_dir, 'osm_change_report_{}_{}.html'.format(
+        start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+    write_report(changewithin, summary, end, filename)
+    reports.append(filename)
+    stats = summary.report_stats()
+    sys.stderr.write('{} sequences, {} changesets, {} failed elements\n'.format(
+        summary.sequences, stats["total"], summary.errors))
+    return reports
+
+
+def write_day(changewithin, results, day, output_dir):
+    """
+    Writes the report of a day
+
+    :param changewithin: Configured instance used to render
+    :type changewithin: changewithin.changewithin.ChangeWithin
+    :param results: Merged results of the day
+    :type results: BackfillResults
+    :param day: Day
+    :type day: datetime.date
+    :param output_dir: Directory of the reports
+    :type output_dir: str
+    :return: Path of the report
+    :rtype: str
+    """
+    filename = os.path.join(output_dir, 'osm_change_report_{}.html'.format(day.strftime('%Y-%m-%d')))
+    write_report(changewithin, results, day, filename)
+    if results.sketch is not None:
+        # Merged with the stats of other days by merge-stats
+        with io.open(os.path.join(output_dir, 'osm_change_stats_{}.json'.format(day.strftime('%Y-%m-%d'))), "w",
+                     encoding="utf-8") as f_out:
+            f_out.write(u"{}".format(results.sketch.dumps()))
+    return filename
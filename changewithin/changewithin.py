@@ -1,23 +1,24 @@
 from __future__ import absolute_import
+import math
 import os
 import re
 import sys
+import threading
+import time
+from array import array
+from functools import partial
 from tempfile import mkstemp
 
-from configobj import ConfigObj
 import osmium
-import requests
 import gettext
-from jinja2 import Environment
-from osconf import config_from_environment
-import osmapi
-import psycopg2
-import psycopg2.extras
-from psycopg2.extensions import AsIs
 
+from changewithin.compat import INT64
+from changewithin.errors import ErrorAggregator, ErrorRateExceeded
+from changewithin.export import get_exporter, ResultWriter
 
-
-from raven import Client
+# Only osmium is imported at load time, the handler subclasses it. The rest
+# of the dependencies are imported where they are used to keep the startup
+# of short runs fast.
 
 # Env vars:
 # AREA_GEOJSON
@@ -28,39 +29,53 @@ from raven import Client
 # CONFIG
 
 
-def get_state():
+def get_state(mirror=None, url=None):
     """
     Downloads the state from OSM replication system
 
+    :param mirror: Local mirror of the replication files, None to always download
+    :type mirror: changewithin.mirror.ReplicationMirror
+    :param url: Base url of the replication files, the daily diffs of planet.openstreetmap.org by default
+    :type url: str
     :return: Actual state as a str
     """
+    if mirror is not None:
+        return mirror.state()
+    import requests
+    from changewithin.mirror import REPLICATION_URL
 
-    r = requests.get('http://planet.openstreetmap.org/replication/day/state.txt')
+    r = requests.get('{}/state.txt'.format((url or REPLICATION_URL).rstrip("/")))
     return r.text.split('\n')[1].split('=')[1]
 
 
-def get_osc(stateurl=None):
+def get_osc(stateurl=None, mirror=None, url=None, sequence=None):
     """
     Function to download the osc file
 
     :param stateurl: str with the url of the osc
-    :return: None
+    :param mirror: Local mirror of the replication files, None to always download
+    :type mirror: changewithin.mirror.ReplicationMirror
+    :param url: Base url of the replication files, the daily diffs of planet.openstreetmap.org by default
+    :type url: str
+    :param sequence: Sequence to download, the last one by default
+    :type sequence: int
+    :return: Path of the osc file
     """
+    import requests
+    from changewithin.mirror import REPLICATION_URL, sequence_path
 
     if not stateurl:
-        state = get_state()
-
-        # zero-pad state so it can be safely split.
-        state = '000000000' + state
-        path = '{0}/{1}/{2}'.format(state[-9:-6], state[-6:-3], state[-3:])
-        stateurl = 'http://planet.openstreetmap.org/replication/day/{0}.osc.gz'.format(path)
+        state = sequence if sequence is not None else get_state(mirror, url)
+        if mirror is not None:
+            return mirror.diff(state)
+        stateurl = '{0}/{1}.osc.gz'.format((url or REPLICATION_URL).rstrip("/"), sequence_path(state))
 
     sys.stderr.write('downloading {0}...\n'.format(stateurl))
     # prepare a local file to store changes
     handle, filename = mkstemp(prefix='change-', suffix='.osc.gz')
     os.close(handle)
 
-    with open(filename, "w") as f:
+    with open(filename, "wb") as f:
         resp = requests.get(stateurl)
         f.write(resp.content)
     sys.stderr.write('Done\n')
@@ -71,14 +86,181 @@ def get_osc(stateurl=None):
     return filename
 
 
+EARTH_RADIUS = 6371008.8
+# Meters of a degree of latitude, used to convert the geometry tolerance to
+# the units of the cached geometries
+DEGREE_METERS = 111320.0
+# Elements of each multi element request of the OSM API
+API_CHUNK_SIZE = 100
+# Version newer than any, to read the last cached version of a node
+MAX_VERSION = 2 ** 31 - 1
+
+
+def flatten_coordinates(coordinates):
+    """
+    Flattens nested lists of coordinates into a list of coordinate pairs
+
+    :param coordinates: Nested lists of coordinates
+    :type coordinates: list
+    :return: List of coordinate pairs
+    :rtype: list
+    """
+    if not coordinates:
+        return []
+    if not isinstance(coordinates[0], (list, tuple)):
+        return [list(coordinates)]
+    ret = []
+    for coordinate in coordinates:
+        ret.extend(flatten_coordinates(coordinate))
+    return ret
+
+
+def literal_key(pattern):
+    """
+    Returns the key matched by a key expression if it only matches that
+    key, like building$ or ^name$. Expressions without the $ anchor also
+    match the keys that start with them.
+
+    :param pattern: Key expression
+    :type pattern: str
+    :return: Key or None
+    :rtype: str
+    """
+    match = re.match(r"^\^?([\w:\-]+)\$$", pattern)
+    if match:
+        return match.group(1)
+    return None
+
+
+def location_distance(first, second):
+    """
+    Returns the approximate distance in meters between two locations, good
+    enough for the short distances of a moved element
+
+    :param first: Tuple with lat and lon
+    :type first: tuple
+    :param second: Tuple with lat and lon
+    :type second: tuple
+    :return: Distance in meters
+    :rtype: float
+    """
+    lat = math.radians((first[0] + second[0]) / 2.0)
+    dx = math.radians(second[1] - first[1]) * math.cos(lat)
+    dy = math.radians(second[0] - first[0])
+    return EARTH_RADIUS * math.hypot(dx, dy)
+
+
+class NodeBatch(object):
+    """
+    Columnar buffer of the nodes read from the diff, so the spatial filter
+    can be applied to a whole batch at once
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.clear()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clear(self):
+        """
+        Empties the batch
+
+        :return: None
+        """
+        self.ids = []
+        self.versions = []
+        self.lats = array('d')
+        self.lons = array('d')
+        self.info = []
+
+    def add(self, identifier, version, lat, lon, info):
+        """
+        Adds a node to the batch
+
+        :param identifier: Node id
+        :type identifier: int
+        :param version: Node version
+        :type version: int
+        :param lat: Latitude, nan if the node has no location
+        :type lat: float
+        :param lon: Longitude, nan if the node has no location
+        :type lon: float
+        :param info: Tuple with changeset, user, uid, deleted, tags and timestamp
+        :type info: tuple
+        :return: None
+        """
+        self.ids.append(identifier)
+        self.versions.append(version)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.info.append(info)
+
+    def in_bbox(self, north, east, south, west):
+        """
+        Returns the positions of the nodes inside the bounding box
+
+        :param north: North of bbox
+        :param east: East of the bbox
+        :param south: South of the bbox
+        :param west: West of the bbox
+        :return: Indexes of the nodes inside the bounding box
+        :rtype: numpy.ndarray
+        """
+        import numpy
+
+        lats = numpy.frombuffer(self.lats, dtype=numpy.float64)
+        lons = numpy.frombuffer(self.lons, dtype=numpy.float64)
+        mask = (lats < north) & (lats > south) & (lons < east) & (lons > west)
+        return numpy.flatnonzero(mask)
+
+    def outside_bbox(self, north, east, south, west):
+        """
+        Returns the positions of the nodes with a valid location outside the
+        bounding box
+
+        :param north: North of bbox
+        :param east: East of the bbox
+        :param south: South of the bbox
+        :param west: West of the bbox
+        :return: Indexes of the nodes outside the bounding box
+        :rtype: numpy.ndarray
+        """
+        import numpy
+
+        lats = numpy.frombuffer(self.lats, dtype=numpy.float64)
+        lons = numpy.frombuffer(self.lons, dtype=numpy.float64)
+        mask = (lats < north) & (lats > south) & (lons < east) & (lons > west)
+        return numpy.flatnonzero(~numpy.isnan(lats) & ~mask)
+
+    def valid(self):
+        """
+        Returns the positions of the nodes with a valid location
+
+        :return: Indexes of the nodes with location
+        :rtype: numpy.ndarray
+        """
+        import numpy
+
+        lats = numpy.frombuffer(self.lats, dtype=numpy.float64)
+        return numpy.flatnonzero(~numpy.isnan(lats))
+
+
 class ChangeHandler(osmium.SimpleHandler):
     """
     Class that handles the changes
     """
 
-    def __init__(self):
+    def __init__(self, node_batch_size=10000):
         """
         Class constructor
+
+        :param node_batch_size: Number of nodes stored on the cache together, 0 to store them one by one.
+            Without cache the nodes are always checked one by one
+        :type node_batch_size: int
         """
         osmium.SimpleHandler.__init__(self)
         self.num_nodes = 0
@@ -93,20 +275,205 @@ class ChangeHandler(osmium.SimpleHandler):
         self.stats = {}
         self.cache = None
         self.cache_enabled = False
-        self.sentry_client = Client()
+        self.errors = ErrorAggregator()
+        self.node_batch_size = node_batch_size
+        self.node_batch = NodeBatch()
+        self.relation_envelopes = {}
+        self.exporters = []
+        self.keep_changesets = True
+        self.spill = None
+        self.sketch = None
+        self.prefilter = True
+        self.extract = None
+        self.modified_nodes = set()
+        self.incomplete_ways = set()
+        self.entered_ways = []
+        self.left_ways = []
+        self.geometry_tolerance = 1.0
+        self.api_url = None
+        self.api = None
+        self.node_changesets = {}
+        self.geometry_ways = []
+        self.notifier = None
+        self.cache_buffer = None
+        self.cache_skipped = {"node": 0, "way": 0}
+        self.cache_referenced = 0
+        self.outside_ids = array(INT64)
+        self.outside_versions = array(INT64)
+        self.outside_index = None
+        self.referenced_nodes = set()
+        self.place_deleted = None
+        self.deleted_api_limit = 1000
+        self.deleted = {"node": [], "way": [], "relation": []}
+        self.deleted_nodes = {}
+        self.deleted_resolved = {"cache": 0, "api": 0, "unresolved": 0}
+        self.lookups = None
+        self.local = threading.local()
+
+    @property
+    def sentry_client(self):
+        """
+        Sentry client, created on the first report
+
+        :return: Client
+        """
+        return self.errors.sentry_client
+
+    def report_error(self, elem, exc_info=None, count=1):
+        """
+        Records the exception being handled, aborts the processing when the
+        error rate is over the limit
+
+        :param elem: Type of element that failed
+        :type elem: str
+        :param exc_info: Exception info, the one being handled by default
+        :type exc_info: tuple
+        :param count: Number of elements lost by the exception
+        :type count: int
+        :return: None
+        """
+        self.errors.record(elem, exc_info or sys.exc_info(), count)
+        if self.errors.exceeded(self.num_nodes + self.num_ways + self.num_rel):
+            raise ErrorRateExceeded("{} failed elements, over the error rate of {}".format(
+                self.errors.failed, self.errors.max_error_rate))
+
+    def osm_api(self):
+        """
+        Client of the OSM API, created on first use and shared by all the
+        lookups of the handler. Each lookup worker creates its own client,
+        they are not shared between threads.
 
-    def set_cache(self, host, db, user, password):
+        :return: OsmApi
+        """
+        worker = getattr(self.local, "worker", False)
+        api = getattr(self.local, "api", None) if worker else self.api
+        if api is None:
+            import osmapi
+
+            if self.api_url is None:
+                api = osmapi.OsmApi()
+            else:
+                api = osmapi.OsmApi(api=self.api_url)
+            if worker:
+                self.local.api = api
+            else:
+                self.api = api
+        return api
+
+    def start_lookups(self, workers=4, queue_size=1000):
+        """
+        Starts the workers that check the previous tags of the modified
+        elements, the matching doesn't wait for them and their results are
+        handled on the thread of the handler
+
+        :param workers: Number of threads
+        :type workers: int
+        :param queue_size: Maximum number of checks waiting for a worker
+        :type queue_size: int
+        :return: None
+        """
+        from changewithin.pipeline import LookupPool
+
+        self.lookups = LookupPool(self.has_tag_changed, workers, queue_size, initializer=self.start_lookup_worker,
+                                  finalizer=self.stop_lookup_worker)
+
+    def finish_lookups(self, discard=False):
+        """
+        Waits for the pending checks, handles their results and stops the
+        workers
+
+        :param discard: True to drop the pending checks, when the run failed
+        :type discard: bool
+        :return: Stats of the lookup and the aggregate stages, empty if the workers were not started
+        :rtype: list
+        """
+        lookups = self.lookups
+        if lookups is None:
+            return []
+        try:
+            lookups.close(discard)
+        finally:
+            self.lookups = None
+        return [lookups.stats.summary(), lookups.handled.summary()]
+
+    def start_lookup_worker(self):
+        """
+        Prepares a lookup worker
+
+        :return: None
+        """
+        self.local.worker = True
+
+    def stop_lookup_worker(self):
+        """
+        Returns the cache connection of a lookup worker
+
+        :return: None
+        """
+        if self.cache_enabled:
+            self.cache.release()
+
+    def check_tags(self, elem, identifier, tags, key_re, version, changed, unchanged=None):
+        """
+        Checks if the tags of a modified element changed from its previous
+        version, on the lookup workers if they are started
+
+        :param elem: Type of element node, way or relation
+        :type elem: str
+        :param identifier: Element id
+        :type identifier: int
+        :param tags: Tags of the element
+        :type tags: dict
+        :param key_re: Compiled re expression of the key
+        :param version: Version of the element
+        :type version: int
+        :param changed: Called if the tags changed
+        :type changed: callable
+        :param unchanged: Called if the tags didn't change
+        :type unchanged: callable
+        :return: None
+        """
+        if self.lookups is None:
+            if self.has_tag_changed(identifier, tags, key_re, version, elem):
+                changed()
+            elif unchanged is not None:
+                unchanged()
+            return
+        if self.cache_enabled and self.cache.get_pending_nodes() > 0:
+            # The workers read with their own connections, the previous
+            # versions written by this run must be committed to be found
+            self.cache.commit()
+
+        def handle(result, exc_info):
+            if exc_info is None:
+                try:
+                    if result:
+                        changed()
+                    elif unchanged is not None:
+                        unchanged()
+                    return
+                except Exception:
+                    exc_info = sys.exc_info()
+            self.report_error(elem, exc_info)
+
+        self.lookups.submit((identifier, tags, key_re, version, elem), handle)
+
+    def set_cache(self, host, db, user, password, pool_size=4, cache=None):
         """
         Sets the cache of the handler
         :param host: database host
         :param db: database name
         :param user: database user
         :param password: database password
+        :param pool_size: maximum number of connections of the cache
+        :param cache: existing cache to share instead of connecting again
         :return: None
         :rtype: None
         """
 
-        self.cache = DbCache(host,db,user,password)
+        if cache is None:
+            cache = DbCache(host, db, user, password, pool_size)
+        self.cache = cache
         self.cache_enabled = True
 
     def location_in_bbox(self, location):
@@ -126,13 +493,22 @@ class ChangeHandler(osmium.SimpleHandler):
         :return: Booelan
         """
 
-        inside = False
-        x = 0
-        while not inside and x < len(nodes):
-            if nodes[x].location.valid():
-                inside = self.location_in_bbox(nodes[x].location)
-            x += 1
-        return inside
+        return self.way_location_in_bbox(nodes) is not None
+
+    def way_location_in_bbox(self, nodes):
+        """
+        Returns the location of the first node of the way inside the bounding box
+
+        :param nodes: Nodes of the way
+        :return: Tuple with lat and lon or None if the way is outside
+        :rtype: tuple
+        """
+
+        for node in nodes:
+            location = node.location
+            if location.valid() and self.location_in_bbox(location):
+                return location.lat, location.lon
+        return None
 
     def node_in_bbox(self, node):
         """
@@ -163,79 +539,211 @@ class ChangeHandler(osmium.SimpleHandler):
         :param way_id: id of the way
         :return:
         """
-        osm_api = osmapi.OsmApi()
-        way = self.cache.get_way(way_id)
-        if not way:
-            way = osm_api.WayGet(way_id)
-        ret = False
-        index = 0
-        while not ret and index < len(way["nd"]):
-            ret = self.node_in_bbox(way["nd"][index])
-            index += 1
-        return ret
+        if self.cache_enabled:
+            found_nodes, found_ways, extent = self.cache.get_extent([], [way_id])
+            if way_id in found_ways:
+                return way_id in self.cache.ways_in_bbox([way_id], (self.north, self.east, self.south, self.west))
+        for coordinate in self.way_coordinates(way_id, self.osm_api()):
+            if self.node_in_bbox(coordinate):
+                return True
+        return False
+
+    def envelope_in_bbox(self, envelope):
+        """
+        Checks if an envelope intersects the bounding box
+
+        :param envelope: Tuple with south, west, north and east
+        :type envelope: tuple
+        :return: True if the envelope intersects the bounding box
+        :rtype: bool
+        """
+        if envelope is None:
+            return False
+        south, west, north, east = envelope
+        return south < self.north and north > self.south and west < self.east and east > self.west
+
+    def node_coordinates(self, node_id, api):
+        """
+        Returns the coordinates of a node from the cache or the API
+
+        :param node_id: Node id
+        :type node_id: int
+        :param api: OSM API client
+        :return: List of [lat, lon]
+        :rtype: list
+        """
+        node = None
+        if self.cache_enabled:
+            node = self.cache.get_node(node_id)
+        if node is None:
+            node = api.NodeGet(node_id)
+        if node is None:
+            return []
+        if "data" in node:
+            node = node["data"]
+        return [[node["lat"], node["lon"]]]
+
+    def way_coordinates(self, way_id, api):
+        """
+        Returns the coordinates of a way from the cache or the API, the ways
+        fetched from the API are stored on the cache
+
+        :param way_id: Way id
+        :type way_id: int
+        :param api: OSM API client
+        :return: List of [lat, lon]
+        :rtype: list
+        """
+        if self.cache_enabled:
+            way = self.cache.get_way(way_id)
+            if way is not None:
+                return flatten_coordinates(way["data"]["coordinates"])
+        locations = {}
+        refs = []
+        version = None
+        tags = {}
+        for element in api.WayFull(way_id):
+            if element["type"] == "way":
+                version = element["data"]["version"]
+                tags = element["data"]["tag"]
+                refs = element["data"]["nd"]
+            elif element["type"] == "node":
+                locations[element["data"]["id"]] = [element["data"]["lat"], element["data"]["lon"]]
+        nodes = [locations[ref] for ref in refs if ref in locations]
+        if self.cache_enabled and version is not None:
+            self.cache.add_way(way_id, version, nodes, tags, refs)
+        return nodes
+
+    def resolve_relation(self, rel_id, version=None, members=None, api=None, visiting=None):
+        """
+        Resolves the envelope of a relation walking its members, nested
+        relations included. Relations already being resolved are skipped to
+        break cycles.
+
+        :param rel_id: Relation id
+        :type rel_id: int
+        :param version: Relation version, None for the last one
+        :type version: int
+        :param members: List of (type, ref) with the type as n, w or r, None to download them
+        :type members: list
+        :param api: OSM API client
+        :param visiting: Ids of the relations being resolved
+        :type visiting: set
+        :return: Envelope as (south, west, north, east) or None, if a member is inside the bbox and the ids
+            of the relations where a cycle was cut, the result is only complete when it is empty
+        :rtype: tuple
+        """
+        if api is None:
+            api = self.osm_api()
+        if visiting is None:
+            visiting = set()
+        if rel_id in visiting:
+            return None, False, set([rel_id])
+        memo = self.relation_envelopes.get(rel_id)
+        if memo is not None and (version is None or memo[0] == version):
+            return memo[1], memo[2], set()
+        cached = None
+        if self.cache_enabled:
+            cached = self.cache.get_relation(rel_id, version)
+            if cached is not None:
+                envelope = cached["data"]["envelope"]
+                if not self.envelope_in_bbox(envelope):
+                    return envelope, False, set()
+                if cached["data"]["inside"] is not None:
+                    # Resolved by a previous run, the members aren't walked again
+                    if version is not None:
+                        self.relation_envelopes[rel_id] = (version, envelope, cached["data"]["inside"])
+                    return envelope, cached["data"]["inside"], set()
+        if members is None:
+            if version is None:
+                rel = api.RelationGet(rel_id)
+            else:
+                rel = api.RelationGet(rel_id, version)
+            version = rel["version"]
+            members = [(member["type"][0], member["ref"]) for member in rel["member"]]
+
+        visiting.add(rel_id)
+        coordinates = []
+        inside = False
+        cut = set()
+        envelopes = []
+        cached_nodes = set()
+        cached_ways = set()
+        if self.cache_enabled:
+            # The members on the cache are checked with a query per type,
+            # only the missing ones are resolved one by one
+            node_refs = [ref for member_type, ref in members if member_type == "n"]
+            way_refs = [ref for member_type, ref in members if member_type == "w"]
+            cached_nodes, cached_ways, extent = self.cache.get_extent(node_refs, way_refs)
+            if extent is not None:
+                envelopes.append(extent)
+                if self.envelope_in_bbox(extent):
+                    bbox = (self.north, self.east, self.south, self.west)
+                    inside = bool(self.cache.nodes_in_bbox(cached_nodes, bbox)) or \
+                        bool(self.cache.ways_in_bbox(cached_ways, bbox))
+        for member_type, ref in members:
+            if member_type == "n":
+                if ref not in cached_nodes:
+                    coordinates.extend(self.node_coordinates(ref, api))
+            elif member_type == "w":
+                if ref not in cached_ways:
+                    coordinates.extend(self.way_coordinates(ref, api))
+            elif member_type == "r":
+                envelope, member_inside, member_cut = self.resolve_relation(ref, api=api, visiting=visiting)
+                inside = inside or member_inside
+                cut.update(member_cut)
+                if envelope is not None:
+                    envelopes.append(envelope)
+        visiting.discard(rel_id)
+        cut.discard(rel_id)
+
+        if not inside:
+            for coordinate in coordinates:
+                if self.node_in_bbox(coordinate):
+                    inside = True
+                    break
+        for lat, lon in coordinates:
+            envelopes.append((lat, lon, lat, lon))
+        envelope = None
+        if envelopes:
+            envelope = (
+                min(e[0] for e in envelopes),
+                min(e[1] for e in envelopes),
+                max(e[2] for e in envelopes),
+                max(e[3] for e in envelopes)
+            )
+        if not cut and version is not None:
+            self.relation_envelopes[rel_id] = (version, envelope, inside)
+            if self.cache_enabled and envelope is not None and cached is None:
+                self.cache.add_relation(rel_id, version, envelope, inside)
+        return envelope, inside, cut
+
+    def relation_location(self, rel_id):
+        """
+        Returns the center of the resolved envelope of a relation
+
+        :param rel_id: Relation id
+        :type rel_id: int
+        :return: Tuple with lat and lon or None if the relation is not resolved
+        :rtype: tuple
+        """
+        memo = self.relation_envelopes.get(rel_id)
+        if memo is None or memo[1] is None:
+            return None
+        south, west, north, east = memo[1]
+        return (south + north) / 2.0, (west + east) / 2.0
 
     def rel_in_bbox(self, relation):
         """
         Checks if the relation is in the bounding box
 
-        :param relation: List of members of the relation
+        :param relation: Relation to check
         :return: True if the relation is in the bounding box
         :rtype: bool
         """
-        api = osmapi.OsmApi()
-        for member in relation.members:
-            if member.type == "n":
-                if self.cache_enabled:
-                    node = self.cache.get_node(member.ref)
-                    if node is None:
-                        node = api.NodeGet(member.ref)
-                    ret = self.node_in_bbox(node)
-                    if ret:
-                        return True
-            elif member.type == "w":
-                if self.cache_enabled:
-                    way = self.cache.get_way(member.ref)
-                else:
-                    way = None
-                if way is None:
-                    way = api.WayFull(member.ref)
-                    nodes = []
-                    for element in way:
-                        if element["type"] == "way":
-                            version = element["data"]["version"]
-                            tags = element["data"]["tag"]
-                        else:
-                            nodes.append([element["data"]["lat"],element["data"]["lon"]])
-                    if self.cache_enabled:
-                        self.cache.add_way(member.ref, version, nodes, tags)
-                    print("way ref:{}".format(member.ref))
-                if "coordinates" in way:
-                    nodes = way.get("coordinates", [])
-                else:
-                    nodes = way
-                for node in nodes:
-                    if isinstance(node, dict) and node.get("type")!="node":
-                        for node_id in node.get("nd", []):
-                            n = self.cache.get_node(node_id)
-                            if node is None:
-                                node = api.NodeGet(node_id)
-                            ret = self.node_in_bbox(n)
-                            if ret:
-                                return True
-                    else:
-                        ret = self.node_in_bbox(node)
-                        if ret:
-                            return True
-            else:
-                print("member.type:{}".format(member.type))
-
-        # rel_data = api.RelationFull(relation.id)
-        # for element in rel_data:
-        #     if element["type"] == "node":
-        #         ret = self.node_in_bbox(element)
-        #         if ret:
-        #             return True
-        # return False
+        members = [(member.type, member.ref) for member in relation.members]
+        envelope, inside, cut = self.resolve_relation(relation.id, relation.version, members)
+        return inside
 
     def has_tag_changed(self, gid, old_tags, watch_tags, version, elem):
         """
@@ -250,7 +758,7 @@ class ChangeHandler(osmium.SimpleHandler):
         """
 
         previous_elem = {}
-        osm_api = osmapi.OsmApi()
+        osm_api = self.osm_api()
         if elem == 'node':
             if self.cache_enabled:
                 previous_elem = self.cache.get_node(gid, version -1)
@@ -263,6 +771,9 @@ class ChangeHandler(osmium.SimpleHandler):
         elif elem == 'relation':
             previous_elem = osm_api.RelationHistory(gid)[version - 1]
         if previous_elem:
+            if "data" in previous_elem:
+                # Elements of the cache
+                previous_elem = previous_elem["data"]
             previous_tags = previous_elem['tag']
             out_tags = {}
             for key, value in previous_tags.items():
@@ -292,11 +803,16 @@ class ChangeHandler(osmium.SimpleHandler):
         """
         Checks if the element have the key,value
 
-        :param element: Element to check
-        :param key_re: Compiled re expression of key 
+        :param element: Element to check, osmium tags or dict
+        :param key_re: Compiled re expression of key
         :param value_re: Compiled re expression of value
         :return: boolean
         """
+        if isinstance(element, dict):
+            for key, value in element.items():
+                if key_re.match(key) and value_re.match(value):
+                    return True
+            return False
         for tag in element:
             key = tag.k
             value = tag.v
@@ -304,21 +820,376 @@ class ChangeHandler(osmium.SimpleHandler):
                 return True
         return False
 
-    def set_tags(self, name, key, value, element_types):
+    def register_change(self, elem, tag_name, changeset, user, uid, identifier, version=None, location=None,
+                        timestamp=None):
+        """
+        Stores a matched element on the stats and on its changeset, and
+        writes it to the exporters
+
+        :param elem: Type of element node, way or relation
+        :type elem: str
+        :param tag_name: Name of the matched tags
+        :type tag_name: str
+        :param changeset: Changeset of the element
+        :type changeset: int
+        :param user: User of the changeset
+        :type user: str
+        :param uid: User id of the changeset
+        :type uid: int
+        :param identifier: Id of the element
+        :type identifier: int
+        :param version: Version of the element
+        :type version: int
+        :param location: Tuple with lat and lon of the element
+        :type location: tuple
+        :param timestamp: Timestamp of the element version
+        :type timestamp: datetime.datetime
+        :return: None
+        """
+        ids_key = {"node": "nids", "way": "wids", "relation": "rids"}[elem]
+        if self.sketch is not None:
+            # Only the counts are kept, the changesets are not
+            self.sketch.add(tag_name, elem, identifier, changeset, user, uid)
+        elif self.spill is None:
+            # With spill the stats are counted when the changes are merged
+            if tag_name in self.stats:
+                self.stats[tag_name].add(changeset)
+            else:
+                self.stats[tag_name] = [changeset]
+        if self.exporters or self.notifier is not None:
+            if location is None:
+                location = (None, None)
+            change = {
+                "changeset": changeset,
+                "user": user,
+                "uid": uid,
+                "type": elem,
+                "id": identifier,
+                "version": version,
+                "rule": tag_name,
+                "lat": location[0],
+                "lon": location[1],
+                "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ") if timestamp else None
+            }
+            for exporter in self.exporters:
+                exporter.write(change)
+            if self.notifier is not None:
+                self.notifier.write(change)
+        if not self.keep_changesets or self.sketch is not None:
+            return
+        if self.spill is not None:
+            self.spill.add(changeset, user, uid, ids_key, tag_name, identifier)
+            return
+        if changeset not in self.changeset:
+            self.changeset[changeset] = {
+                "changeset": changeset,
+                "user": user,
+                "uid": uid,
+                "nids": {},
+                "wids": {},
+                "rids": {}
+            }
+        if tag_name not in self.changeset[changeset][ids_key]:
+            self.changeset[changeset][ids_key][tag_name] = []
+        self.changeset[changeset][ids_key][tag_name].append(identifier)
+
+    def match_node(self, identifier, version, changeset, user, uid, deleted, tags, location=None, timestamp=None,
+                   moved=False):
+        """
+        Checks the tags of a node inside the bounding box
+
+        :param identifier: Node id
+        :param version: Node version
+        :param changeset: Changeset of the node
+        :param user: User of the changeset
+        :param uid: User id of the changeset
+        :param deleted: True if the node is deleted
+        :param tags: Tags of the node
+        :type tags: dict
+        :param location: Tuple with lat and lon of the node
+        :type location: tuple
+        :param timestamp: Timestamp of the node version
+        :type timestamp: datetime.datetime
+        :param moved: True if the node moved from its previous version
+        :type moved: bool
+        :return: None
+        """
+        for tag_name in self.tags.keys():
+            key_re = self.tags[tag_name]["key_re"]
+            value_re = self.tags[tag_name]["value_re"]
+            if self.has_tag(tags, key_re, value_re):
+                change = partial(self.register_change, "node", tag_name, changeset, user, uid, identifier, version,
+                                 location, timestamp)
+                if deleted or version == 1 or (moved and self.tags[tag_name]["geometry"]):
+                    change()
+                else:
+                    self.check_tags("node", identifier, tags, key_re, version, change)
+
+    def flush_nodes(self):
+        """
+        Filters the pending batch of nodes, stores them on the cache and checks
+        the tags of the ones inside the bounding box
+
+        :return: None
+        """
+        batch = self.node_batch
+        if not len(batch):
+            return
+        self.num_nodes += len(batch)
+        geometry = self.geometry_enabled
+        try:
+            if self.cache_enabled:
+                area = self.cache_area()
+                if area is None:
+                    cached = batch.valid()
+                else:
+                    cached = batch.in_bbox(*area)
+                    self.skip_nodes(batch, batch.outside_bbox(*area))
+                rows = []
+                for indx in cached:
+                    rows.append((batch.ids[indx], batch.versions[indx], batch.lats[indx], batch.lons[indx],
+                                 batch.info[indx][4]))
+                    if batch.versions[indx] > 1:
+                        self.modified_nodes.add(batch.ids[indx])
+                        if geometry:
+                            self.node_changesets[batch.ids[indx]] = batch.info[indx][:3] + batch.info[indx][5:]
+                self.cache.add_nodes(rows)
+        except Exception:
+            # The whole batch is lost for the cache
+            self.report_error("node", count=len(batch))
+        inside = batch.in_bbox(self.north, self.east, self.south, self.west)
+        moved = set()
+        if geometry:
+            try:
+                moved = self.moved_nodes(batch, inside)
+            except Exception:
+                self.report_error("node")
+        for indx in inside:
+            if self.extract is not None:
+                self.extract.add_node(batch.ids[indx])
+            changeset, user, uid, deleted, tags, timestamp = batch.info[indx]
+            if not tags:
+                continue
+            try:
+                self.match_node(batch.ids[indx], batch.versions[indx], changeset, user, uid, deleted, tags,
+                                (batch.lats[indx], batch.lons[indx]), timestamp, batch.ids[indx] in moved)
+            except Exception:
+                self.report_error("node")
+        batch.clear()
+        if self.lookups is not None:
+            self.lookups.collect()
+
+    def skip_nodes(self, batch, indexes):
+        """
+        Keeps the id and version of the nodes of the batch not stored on the
+        cache, in case a way of the area uses them
+
+        :param batch: Batch of nodes
+        :type batch: NodeBatch
+        :param indexes: Positions of the skipped nodes
+        :type indexes: list
+        :return: None
+        """
+        for indx in indexes:
+            self.outside_ids.append(batch.ids[indx])
+            self.outside_versions.append(batch.versions[indx])
+        self.outside_index = None
+        self.cache_skipped["node"] += len(indexes)
+
+    def moved_nodes(self, batch, indexes):
+        """
+        Returns which of the modified nodes of the batch moved further than
+        the tolerance from their previous cached version, with a single
+        lookup for the whole batch
+
+        :param batch: Batch of nodes
+        :type batch: NodeBatch
+        :param indexes: Positions of the nodes to check
+        :type indexes: list
+        :return: Ids of the moved nodes
+        :rtype: set
+        """
+        rules = [tag for tag in self.tags.values() if tag["geometry"]]
+        candidates = {}
+        for indx in indexes:
+            tags = batch.info[indx][4]
+            if batch.versions[indx] == 1 or not tags or batch.info[indx][3]:
+                continue
+            for rule in rules:
+                if self.has_tag(tags, rule["key_re"], rule["value_re"]):
+                    candidates[batch.ids[indx]] = (batch.versions[indx], (batch.lats[indx], batch.lons[indx]))
+                    break
+        if not candidates:
+            return set()
+        previous = self.cache.get_previous_locations(
+            list(candidates.keys()), [candidate[0] for candidate in candidates.values()])
+        moved = set()
+        for identifier, location in previous.items():
+            if location_distance(location, candidates[identifier][1]) > self.geometry_tolerance:
+                moved.add(identifier)
+        return moved
+
+    def add_geometry_way(self, way):
+        """
+        Keeps a way of the diff with the same tags, its geometry is compared
+        with the previous version once the diff is processed
+
+        :param way: Tuple with the id, version, tag name, changeset, user, uid, location and timestamp
+        :type way: tuple
+        :return: None
+        """
+        self.geometry_ways.append(way)
+
+    def check_way_geometries(self):
+        """
+        Matches the ways of the diff with the same tags whose geometry changed
+        further than the tolerance from their previous cached version
+
+        :return: None
+        """
+        if not self.geometry_ways:
+            return
+        pending = dict((way[0], way) for way in self.geometry_ways)
+        self.geometry_ways = []
+        reshaped = self.cache.get_reshaped_ways(
+            list(pending.keys()), [way[1] for way in pending.values()], self.geometry_tolerance / DEGREE_METERS)
+        for way_id in reshaped:
+            identifier, version, tag_name, changeset, user, uid, location, timestamp = pending[way_id]
+            self.register_change("way", tag_name, changeset, user, uid, identifier, version, location, timestamp)
+
+    def update_way_geometries(self):
+        """
+        Rebuilds from the cached nodes the geometry of the ways that use a
+        node modified on the diff and of the ways of the diff stored without
+        geometry, and keeps the ones that entered or left the bounding box
+
+        :return: None
+        """
+        if not self.cache_enabled:
+            return
+        way_ids = self.cache.get_ways_by_nodes(self.modified_nodes)
+        way_ids.update(self.incomplete_ways)
+        bbox = (self.north, self.east, self.south, self.west)
+        geometry = self.geometry_enabled
+        in_diff = set(way[0] for way in self.geometry_ways)
+        for way_id, was_inside, is_inside, distance, tags, refs, version in self.cache.rebuild_way_geometries(
+                list(way_ids), bbox):
+            if is_inside and not was_inside:
+                self.entered_ways.append(way_id)
+            elif was_inside and not is_inside:
+                self.left_ways.append(way_id)
+            if geometry and is_inside and way_id not in in_diff and distance is not None and \
+                    distance * DEGREE_METERS > self.geometry_tolerance:
+                self.match_moved_way(way_id, version, tags or {}, refs or [])
+        self.modified_nodes = set()
+        self.incomplete_ways = set()
+        self.node_changesets = {}
+        self.outside_ids = array(INT64)
+        self.outside_versions = array(INT64)
+        self.outside_index = None
+        self.referenced_nodes = set()
+
+    def match_moved_way(self, way_id, version, tags, refs):
+        """
+        Matches a way not included on the diff that moved because its nodes
+        did, the change is credited to the changeset of the first moved node
+
+        :param way_id: Way id
+        :type way_id: int
+        :param version: Cached version of the way, it doesn't change when only its nodes move
+        :type version: int
+        :param tags: Cached tags of the way
+        :type tags: dict
+        :param refs: Node ids of the way
+        :type refs: list
+        :return: None
+        """
+        for ref in refs:
+            if ref in self.node_changesets:
+                changeset, user, uid, timestamp = self.node_changesets[ref]
+                break
+        else:
+            return
+        for tag_name in self.tags.keys():
+            if self.tags[tag_name]["geometry"] and \
+                    self.has_tag(tags, self.tags[tag_name]["key_re"], self.tags[tag_name]["value_re"]):
+                self.register_change("way", tag_name, changeset, user, uid, way_id, version, timestamp=timestamp)
+
+    def set_tags(self, name, key, value, element_types, geometry=False):
         """
         Sets the tags to wathc on the handler
         :param name: Name of the tags
         :param key: Key value expression
         :param value: Value expression
         :param element_types: List of element types
+        :param geometry: True to also match the elements moved or reshaped with the same tags, needs the cache
         :return: None
         """
         self.tags[name] = {}
         self.tags[name]["key_re"] = re.compile(key)
         self.tags[name]["value_re"] = re.compile(value)
         self.tags[name]["types"] = element_types
+        self.tags[name]["geometry"] = geometry
         self.stats[name] = set()
 
+    def prefilters(self):
+        """
+        Returns the native filters of pyosmium that drop, before they reach
+        the callbacks, the objects that can't match any tag. The location
+        handler runs before them, so the ways still get the locations of the
+        dropped nodes. With the cache every object is stored and nothing is
+        dropped.
+
+        :return: List of filters
+        :rtype: list
+        """
+        if not self.prefilter or self.cache_enabled or not self.tags or self.extract is not None or \
+                self.deleted_enabled:
+            # The extract needs every object inside the area and the
+            # deleted objects have no tags on the diff
+            return []
+        try:
+            from osmium.filter import EmptyTagFilter, KeyFilter
+        except ImportError:
+            return []
+        filters = [EmptyTagFilter()]
+        keys = []
+        for tag in self.tags.values():
+            key = literal_key(tag["key_re"].pattern)
+            if key is None:
+                # The key expression matches keys that can't be listed
+                return filters
+            keys.append(key)
+        filters.append(KeyFilter(*keys))
+        return filters
+
+    @property
+    def deleted_enabled(self):
+        """
+        Checks if the deleted elements without location are placed with their
+        previous version, by default only with the cache
+
+        :return: True if the deleted elements are kept to be resolved
+        :rtype: bool
+        """
+        enabled = self.cache_enabled if self.place_deleted is None else self.place_deleted
+        return enabled and (bool(self.tags) or self.extract is not None)
+
+    @property
+    def geometry_enabled(self):
+        """
+        Checks if any of the tags matches the geometry changes
+
+        :return: True if the geometry changes are checked
+        :rtype: bool
+        """
+        if not self.cache_enabled:
+            return False
+        for tag in self.tags.values():
+            if tag.get("geometry"):
+                return True
+        return False
+
     def set_bbox(self, north, east, south, west):
         """
         Sets the bounding box to check
@@ -334,51 +1205,382 @@ class ChangeHandler(osmium.SimpleHandler):
         self.south = float(south)
         self.west = float(west)
 
+    def cache_area(self):
+        """
+        Returns the bounding box of the elements stored on the cache, the
+        area grown by the cache buffer
+
+        :return: Tuple with north, east, south and west, None to store all the elements
+        :rtype: tuple
+        """
+        if self.cache_buffer is None:
+            return None
+        lat = self.cache_buffer / DEGREE_METERS
+        # A degree of longitude is shorter away from the equator
+        lon = lat / max(math.cos(math.radians(max(abs(self.north), abs(self.south)))), 0.01)
+        return (min(self.north + lat, 90.0), min(self.east + lon, 180.0),
+                max(self.south - lat, -90.0), max(self.west - lon, -180.0))
+
+    def way_near_area(self, nodes, area):
+        """
+        Checks if a way has to be stored on the cache. Without any location
+        on the diff the way can't be placed and it is stored.
+
+        :param nodes: Nodes of the way
+        :param area: Bounding box of the cache as returned by cache_area
+        :type area: tuple
+        :return: True if the envelope of the known nodes intersects the area
+        :rtype: bool
+        """
+        north, east, south, west = area
+        lats = []
+        lons = []
+        for node in nodes:
+            location = node.location
+            if location.valid():
+                lats.append(location.lat)
+                lons.append(location.lon)
+        if not lats:
+            return True
+        return min(lats) < north and max(lats) > south and min(lons) < east and max(lons) > west
+
+    def outside_version(self, identifier):
+        """
+        Returns the last version of a node of the diff that was not stored
+        because it is outside the area
+
+        :param identifier: Node id
+        :type identifier: int
+        :return: Version or None if the node was not skipped
+        :rtype: int
+        """
+        import numpy
+
+        if self.outside_index is None:
+            ids = numpy.frombuffer(self.outside_ids, dtype=numpy.int64)
+            order = numpy.argsort(ids, kind="mergesort")
+            self.outside_index = (ids[order], numpy.frombuffer(self.outside_versions, dtype=numpy.int64)[order])
+        ids, versions = self.outside_index
+        position = numpy.searchsorted(ids, identifier, side="right") - 1
+        if position < 0 or ids[position] != identifier:
+            return None
+        return int(versions[position])
+
+    def cache_referenced_nodes(self, nodes, area):
+        """
+        Stores the nodes outside the area of a way stored on the cache, so
+        its geometry can be rebuilt when they move. The tags of these nodes
+        are not kept.
+
+        :param nodes: Nodes of the way
+        :param area: Bounding box of the cache as returned by cache_area
+        :type area: tuple
+        :return: None
+        """
+        north, east, south, west = area
+        rows = []
+        for node in nodes:
+            location = node.location
+            if not location.valid() or (north > location.lat > south and east > location.lon > west):
+                continue
+            if node.ref in self.referenced_nodes:
+                continue
+            version = self.outside_version(node.ref)
+            if version is None:
+                continue
+            rows.append((node.ref, version, location.lat, location.lon, {}))
+            self.referenced_nodes.add(node.ref)
+            if version > 1:
+                self.modified_nodes.add(node.ref)
+        if rows:
+            self.cache.add_nodes(rows)
+            self.cache_referenced += len(rows)
+
+    def add_deleted(self, element_type, element):
+        """
+        Keeps a deleted element of the diff that can't be placed, they are
+        resolved together once the diff is processed
+
+        :param element_type: node, way or relation
+        :type element_type: str
+        :param element: Deleted osmium object
+        :return: None
+        """
+        tags = self.convert_osmium_tags_dict(element.tags) if len(element.tags) else None
+        self.deleted[element_type].append((element.id, element.version, element.changeset, element.user,
+                                           element.uid, element.timestamp, tags))
+
+    def resolve_deleted(self):
+        """
+        Places the deleted elements kept during the diff with their previous
+        version and matches the ones inside the bounding box. The previous
+        versions are read from the cache with a query per type and the
+        missing ones from the API in grouped requests, up to
+        deleted_api_limit elements per run.
+
+        :return: None
+        """
+        deleted = self.deleted
+        self.deleted = {"node": [], "way": [], "relation": []}
+        # The nodes of the deleted ways are usually deleted too
+        self.deleted_nodes = dict((element[0], element[1]) for element in deleted["node"])
+        api_limit = self.deleted_api_limit
+        for element_type in ("node", "way", "relation"):
+            elements = deleted[element_type]
+            if not elements:
+                continue
+            try:
+                previous, requested = self.previous_versions(element_type, elements, api_limit)
+            except Exception:
+                self.report_error(element_type)
+                continue
+            api_limit -= requested
+            for element in elements:
+                if element[0] not in previous:
+                    continue
+                tags, inside, location = previous[element[0]]
+                if not inside:
+                    continue
+                try:
+                    self.match_deleted(element_type, element, tags, location)
+                except Exception:
+                    self.report_error(element_type)
+        self.deleted_nodes = {}
+
+    def previous_versions(self, element_type, elements, api_limit):
+        """
+        Returns the tags and the placement of the previous version of some
+        deleted elements
+
+        :param element_type: node, way or relation
+        :type element_type: str
+        :param elements: Deleted elements as kept by add_deleted
+        :type elements: list
+        :param api_limit: Maximum number of elements looked up on the API
+        :type api_limit: int
+        :return: dict with the element id and a tuple with the tags, if it was inside the bounding box and the
+            location inside it, and the number of elements looked up on the API
+        :rtype: tuple
+        """
+        found = {}
+        if self.cache_enabled:
+            found = self.cache.get_previous_versions(
+                element_type, [element[0] for element in elements], [element[1] for element in elements])
+        ret = {}
+        missing = []
+        for element in elements:
+            previous = found.get(element[0])
+            if previous is None:
+                missing.append(element)
+            elif element_type != "relation":
+                location = self.coordinates_location_in_bbox(previous[2])
+                ret[element[0]] = (previous[1] or element[6] or {}, location is not None, location)
+            elif not self.envelope_in_bbox(previous[2]):
+                ret[element[0]] = ({}, False, None)
+            else:
+                # Placed by its members, the cache has no relation tags
+                missing.append(element)
+        self.deleted_resolved["cache"] += len(ret)
+        requested = missing[:max(api_limit, 0)]
+        if requested:
+            from_api = self.previous_from_api(element_type, requested)
+            self.deleted_resolved["api"] += len(from_api)
+            ret.update(from_api)
+        self.deleted_resolved["unresolved"] += len(elements) - len(ret)
+        return ret, len(requested)
+
+    def previous_from_api(self, element_type, elements):
+        """
+        Downloads the previous version of some deleted elements with a
+        request per group of API_CHUNK_SIZE
+
+        :param element_type: node, way or relation
+        :type element_type: str
+        :param elements: Deleted elements as kept by add_deleted
+        :type elements: list
+        :return: dict with the element id and a tuple with the tags, if it was inside the bounding box and the
+            location inside it
+        :rtype: dict
+        """
+        api = self.osm_api()
+        get = {"node": api.NodesGet, "way": api.WaysGet, "relation": api.RelationsGet}[element_type]
+        data = {}
+        for start in range(0, len(elements), API_CHUNK_SIZE):
+            ids = ["{}v{}".format(element[0], element[1] - 1) for element in elements[start:start + API_CHUNK_SIZE]
+                   if element[1] > 1]
+            try:
+                data.update(get(ids))
+            except Exception:
+                self.report_error(element_type)
+
+        ret = {}
+        if element_type == "node":
+            for identifier, element in data.items():
+                if element.get("lat") is not None:
+                    location = self.coordinates_location_in_bbox([[element["lat"], element["lon"]]])
+                    ret[identifier] = (element.get("tag") or {}, location is not None, location)
+        elif element_type == "way":
+            refs = set()
+            for element in data.values():
+                refs.update(element.get("nd") or [])
+            locations = self.node_locations(list(refs), api)
+            for identifier, element in data.items():
+                coordinates = [locations[ref] for ref in element.get("nd") or [] if ref in locations]
+                if coordinates:
+                    location = self.coordinates_location_in_bbox(coordinates)
+                    ret[identifier] = (element.get("tag") or {}, location is not None, location)
+        else:
+            for identifier, element in data.items():
+                members = [(member["type"][0], member["ref"]) for member in element.get("member") or []]
+                envelope, inside, cut = self.resolve_relation(identifier, element["version"], members, api)
+                ret[identifier] = (element.get("tag") or {}, inside, self.relation_location(identifier))
+        return ret
+
+    def node_locations(self, node_ids, api):
+        """
+        Returns the last known location of some nodes, from the cache with a
+        query and from the API in grouped requests. The nodes deleted on the
+        diff are read at their previous version.
+
+        :param node_ids: Node ids
+        :type node_ids: list
+        :param api: OSM API client
+        :return: dict with the node id and the location as [lat, lon]
+        :rtype: dict
+        """
+        deleted = self.deleted_nodes
+        locations = {}
+        if self.cache_enabled:
+            previous = self.cache.get_previous_locations(
+                node_ids, [deleted.get(identifier, MAX_VERSION) for identifier in node_ids])
+            for identifier, location in previous.items():
+                locations[identifier] = list(location)
+        missing = [identifier for identifier in node_ids if identifier not in locations]
+        for start in range(0, len(missing), API_CHUNK_SIZE):
+            ids = []
+            for identifier in missing[start:start + API_CHUNK_SIZE]:
+                if identifier in deleted:
+                    ids.append("{}v{}".format(identifier, deleted[identifier] - 1))
+                else:
+                    ids.append(identifier)
+            try:
+                nodes = api.NodesGet(ids)
+            except Exception:
+                self.report_error("node")
+                continue
+            for identifier, node in nodes.items():
+                if node.get("lat") is not None:
+                    locations[identifier] = [node["lat"], node["lon"]]
+        return locations
+
+    def coordinates_location_in_bbox(self, coordinates):
+        """
+        Returns the first of some coordinates inside the bounding box
+
+        :param coordinates: List of [lat, lon]
+        :type coordinates: list
+        :return: Tuple with lat and lon or None if all of them are outside
+        :rtype: tuple
+        """
+        for coordinate in coordinates:
+            if self.node_in_bbox(coordinate):
+                return coordinate[0], coordinate[1]
+        return None
+
+    def match_deleted(self, element_type, element, tags, location):
+        """
+        Matches a deleted element inside the bounding box with the tags of its
+        previous version
+
+        :param element_type: node, way or relation
+        :type element_type: str
+        :param element: Deleted element as kept by add_deleted
+        :type element: tuple
+        :param tags: Tags of the previous version
+        :type tags: dict
+        :param location: Tuple with lat and lon inside the bounding box
+        :type location: tuple
+        :return: None
+        """
+        identifier, version, changeset, user, uid, timestamp, diff_tags = element
+        if self.extract is not None:
+            if element_type == "node":
+                self.extract.add_node(identifier)
+            elif element_type == "way":
+                self.extract.add_way(identifier, [])
+            else:
+                self.extract.add_relation(identifier)
+        for tag_name in self.tags.keys():
+            if self.has_tag(tags, self.tags[tag_name]["key_re"], self.tags[tag_name]["value_re"]):
+                self.register_change(element_type, tag_name, changeset, user, uid, identifier, version, location,
+                                     timestamp)
+
     def node(self, node):
         """
         Attends the nodes in the file
 
-        :param node: Node to check 
+        :param node: Node to check
         :return: None
         """
+        if self.node_batch_size and self.cache_enabled:
+            # The batch saves the INSERT of each node, without cache it
+            # only adds the copy of the nodes
+            self.batch_node(node)
+            return
+        # Counted before the checks, the error rate includes the failed ones
+        self.num_nodes += 1
         try:
-
-            if self.cache_enabled:
+            if node.deleted and not node.location.valid() and self.deleted_enabled:
+                self.add_deleted("node", node)
+            area = self.cache_area() if self.cache_enabled else None
+            if area is not None and node.location.valid() and not (
+                    area[0] > node.location.lat > area[2] and area[1] > node.location.lon > area[3]):
+                self.outside_ids.append(node.id)
+                self.outside_versions.append(node.version)
+                self.outside_index = None
+                self.cache_skipped["node"] += 1
+            elif self.cache_enabled:
                 self.cache.add_node(node.id, node.version, node.location.lat, node.location.lon, self.convert_osmium_tags_dict(node.tags))
+                if node.version > 1:
+                    self.modified_nodes.add(node.id)
             if self.location_in_bbox(node.location):
-                for tag_name in self.tags.keys():
-                    key_re = self.tags[tag_name]["key_re"]
-                    value_re = self.tags[tag_name]["value_re"]
-                    if self.has_tag(node.tags, key_re, value_re):
-                        if node.deleted:
-                            add_node = True
-                        elif node.version == 1:
-                            add_node = True
-                        else:
-                            add_node = self.has_tag_changed(
-                                node.id, self.convert_osmium_tags_dict(node.tags), key_re, node.version, "node")
-                        if add_node:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(node.changeset)
-                            else:
-                                self.stats[tag_name] = [node.changeset]
-                            if node.changeset not in self.changeset:
-                                self.changeset[node.changeset] = {
-                                    "changeset": node.changeset,
-                                    "user": node.user,
-                                    "uid": node.uid,
-                                    "nids": {tag_name: [node.id]},
-                                    "wids": {},
-                                    "rids": {}
-                                }
-                            else:
-                                if tag_name not in self.changeset[node.changeset]["nids"]:
-                                    self.changeset[node.changeset]["nids"][tag_name] = []
-                                self.changeset[node.changeset]["nids"][tag_name].append(
-                                    node.id)
-            self.num_nodes += 1
+                if self.extract is not None:
+                    self.extract.add_node(node.id)
+                self.match_node(node.id, node.version, node.changeset, node.user, node.uid, node.deleted,
+                                self.convert_osmium_tags_dict(node.tags), (node.location.lat, node.location.lon),
+                                node.timestamp)
+        except Exception:
+            self.report_error("node")
+
+    def batch_node(self, node):
+        """
+        Copies the node into the pending batch of the cache, the spatial
+        filter and the INSERT are done when the batch is flushed
+
+        :param node: Node to check
+        :return: None
+        """
+        try:
+            location = node.location
+            if node.deleted and not location.valid() and self.deleted_enabled:
+                self.add_deleted("node", node)
+            tags = node.tags
+            has_tags = len(tags) > 0
+            if location.valid():
+                lat = location.lat
+                lon = location.lon
+            else:
+                lat = lon = float("nan")
+            if has_tags:
+                tags = self.convert_osmium_tags_dict(tags)
+            else:
+                tags = {}
+            self.node_batch.add(node.id, node.version, lat, lon,
+                                (node.changeset, node.user, node.uid, node.deleted, tags, node.timestamp))
+            if len(self.node_batch) >= self.node_batch_size:
+                self.flush_nodes()
         except Exception:
-            self.sentry_client.captureException()
+            self.report_error("node")
 
     def way(self, way):
         """
@@ -387,93 +1589,89 @@ class ChangeHandler(osmium.SimpleHandler):
         :param way: Way to check
         :return: None
         """
+        self.flush_nodes()
+        if self.lookups is not None:
+            self.lookups.collect()
         if self.cache and self.cache.get_pending_nodes() > 0:
             self.cache.commit()
+        self.num_ways += 1
         try:
             if self.cache:
-                self.cache.add_way(way.id, way.version, way.nodes, self.convert_osmium_tags_dict(way.tags))
-            if self.way_in_bbox(way.nodes):
+                area = self.cache_area()
+                if area is not None and not self.way_near_area(way.nodes, area):
+                    self.cache_skipped["way"] += 1
+                else:
+                    if area is not None:
+                        self.cache_referenced_nodes(way.nodes, area)
+                    if not self.cache.add_way(way.id, way.version, way.nodes, self.convert_osmium_tags_dict(way.tags)):
+                        self.incomplete_ways.add(way.id)
+            location = self.way_location_in_bbox(way.nodes)
+            if location is None and way.deleted and self.deleted_enabled:
+                self.add_deleted("way", way)
+            if location is not None:
+                if self.extract is not None:
+                    self.extract.add_way(way.id, [node.ref for node in way.nodes])
                 for tag_name in self.tags.keys():
                     key_re = self.tags[tag_name]["key_re"]
                     value_re = self.tags[tag_name]["value_re"]
                     if self.has_tag(way.tags, key_re, value_re):
-                        if way.deleted:
-                            add_way = True
-                        elif way.version == 1:
-                            add_way = True
-                        else:
-                            add_way = self.has_tag_changed(
-                                way.id, self.convert_osmium_tags_dict(way.tags), key_re, way.version, "way")
-                        if add_way:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(way.changeset)
-                            else:
-                                self.stats[tag_name] = [way.changeset]
-                            if way.changeset in self.changeset:
-                                if tag_name not in self.changeset[way.changeset]["wids"]:
-                                    self.changeset[way.changeset]["wids"][tag_name] = []
-                                self.changeset[way.changeset]["wids"][tag_name].append(way.id)
-                            else:
-                                self.changeset[way.changeset] = {
-                                    "changeset": way.changeset,
-                                    "user": way.user,
-                                    "uid": way.uid,
-                                    "nids": {},
-                                    "wids": {tag_name: [way.id]},
-                                    "rids": {}
-                                }
-            self.num_ways += 1
+                        change = partial(self.register_change, "way", tag_name, way.changeset, way.user, way.uid,
+                                         way.id, way.version, location, way.timestamp)
+                        if way.deleted or way.version == 1:
+                            change()
+                            continue
+                        unchanged = None
+                        if self.tags[tag_name]["geometry"] and self.cache_enabled:
+                            # Checked in batch against the cache once the
+                            # geometries of the diff are complete
+                            unchanged = partial(self.add_geometry_way, (
+                                way.id, way.version, tag_name, way.changeset, way.user, way.uid, location,
+                                way.timestamp))
+                        self.check_tags("way", way.id, self.convert_osmium_tags_dict(way.tags), key_re, way.version,
+                                        change, unchanged)
         except Exception:
-            self.sentry_client.captureException()
+            self.report_error("way")
 
     def relation(self, rel):
         # print 'rel:{}'.format(self.num_rel)
         # for member in r.members:
         #    print member
+        self.flush_nodes()
+        if self.lookups is not None:
+            self.lookups.collect()
+        self.num_rel += 1
         try:
             if self.cache_enabled:
-                if self.cache.get_pending_nodes > 0 or self.cache.get_pending_ways > 0:
+                if self.cache.get_pending_nodes() > 0 or self.cache.get_pending_ways() > 0:
                     self.cache.commit()
 
             print ("rel.id {} len:{}".format(rel.id,len(rel.members)))
-            if not rel.deleted and self.rel_in_bbox(rel):
+            if rel.deleted and self.deleted_enabled:
+                self.add_deleted("relation", rel)
+            # Nothing to match nor extract when only the cache is updated
+            if not rel.deleted and (self.tags or self.extract is not None) and self.rel_in_bbox(rel):
+                if self.extract is not None:
+                    self.extract.add_relation(rel.id)
                 for tag_name in self.tags.keys():
                     key_re = self.tags[tag_name]["key_re"]
                     value_re = self.tags[tag_name]["value_re"]
                     if self.has_tag(rel.tags, key_re, value_re):
-                        if rel.deleted:
-                            add_rel = True
-                        elif rel.version == 1:
-                            add_rel = True
+                        change = partial(self.register_change, "relation", tag_name, rel.changeset, rel.user,
+                                         rel.uid, rel.id, rel.version, self.relation_location(rel.id), rel.timestamp)
+                        if rel.deleted or rel.version == 1:
+                            change()
                         else:
                             rel_tags = self.convert_osmium_tags_dict(rel.tags)
-                            add_rel = self.has_tag_changed(rel.id, rel_tags, key_re, rel.version, "relation")
-                        if add_rel:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(rel.changeset)
-                            else:
-                                self.stats[tag_name] = [rel.changeset]
-                            if rel.changeset in self.changeset:
-                                if tag_name not in self.changeset[rel.changeset]["rids"]:
-                                    self.changeset[rel.changeset]["rids"][tag_name] = []
-                                self.changeset[rel.changeset]["rids"][
-                                    tag_name].append(rel.id)
-                            else:
-                                self.changeset[rel.changeset] = {
-                                    "changeset": rel.changeset,
-                                    "user": rel.user,
-                                    "uid": rel.uid,
-                                    "nids": {},
-                                    "wids": {},
-                                    "rids": {tag_name: [rel.id]}
-                                }
-            self.num_rel += 1
-        except Exception as e:
-            self.sentry_client.captureException()
+                            self.check_tags("relation", rel.id, rel_tags, key_re, rel.version, change)
+        except Exception:
+            self.report_error("relation")
 
 class DbCache(object):
 
-    def __init__(self, host, database, user, password):
+    # Key of the advisory lock that serializes the writes of overlapping runs
+    WRITE_LOCK = 0x636877
+
+    def __init__(self, host, database, user, password, pool_size=4):
         """
         Class constructor
 
@@ -485,15 +1683,111 @@ class DbCache(object):
         :type user: str
         :param password: Password to connect to the databse
         :type password: str
+        :param pool_size: Maximum number of connections, one per thread using the cache
+        :type pool_size: int
         """
         self.host = host
         self.database = database
         self.user = user
         self.password = password
-        self.con = psycopg2.connect(host=self.host, database=self.database, user=self.user,password=self.password)
-        psycopg2.extras.register_hstore(self.con)
+        import threading
+        import psycopg2.extras
+        import psycopg2.pool
+
+        self.pool_size = pool_size
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            1, pool_size, host=self.host, database=self.database, user=self.user, password=self.password)
+        self.local = threading.local()
+        self.main_con = self.pool.getconn()
+        self.local.con = self.main_con
+        psycopg2.extras.register_hstore(self.main_con, globally=True)
+        self.locked = False
         self.pending_nodes = 0
         self.pending_ways = 0
+        self.preloaded = None
+        from changewithin.tagdict import TagDictionary
+
+        self.tag_storage = "hstore"
+        self.tag_dictionary = TagDictionary()
+
+    @property
+    def con(self):
+        """
+        Connection of the current thread. The thread that created the cache
+        writes with its own transaction, the other threads take an
+        autocommit connection from the pool on first use, so the lookup
+        workers can query the cache in parallel
+
+        :return: Connection
+        """
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = self.pool.getconn()
+            con.autocommit = True
+            self.local.con = con
+        return con
+
+    def release(self):
+        """
+        Returns the connection of the current thread to the pool, called by
+        the lookup workers when they finish
+
+        :return: None
+        """
+        con = getattr(self.local, "con", None)
+        if con is not None and con is not self.main_con:
+            self.pool.putconn(con)
+            self.local.con = None
+
+    def close(self):
+        """
+        Releases the write lock and closes all the connections, a closed
+        cache is left as is
+
+        :return: None
+        """
+        if self.pool.closed:
+            return
+        try:
+            self.unlock_writes()
+        finally:
+            self.pool.closeall()
+
+    def lock_writes(self, wait=True):
+        """
+        Takes the advisory lock of the writers, so an overlapping run waits
+        until this one finishes instead of mixing its changes on the cache.
+        Readers don't take the lock and are never blocked by it.
+
+        :param wait: False to return immediately if another run holds the lock
+        :type wait: bool
+        :return: True if the lock was taken
+        :rtype: bool
+        """
+        if self.locked:
+            return True
+        cur = self.main_con.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (self.WRITE_LOCK,))
+        self.locked = cur.fetchone()[0]
+        if not self.locked and wait:
+            sys.stderr.write('waiting for another run to finish writing the cache...\n')
+            cur.execute("SELECT pg_advisory_lock(%s);", (self.WRITE_LOCK,))
+            self.locked = True
+        cur.close()
+        return self.locked
+
+    def unlock_writes(self):
+        """
+        Releases the advisory lock of the writers
+
+        :return: None
+        """
+        if not self.locked:
+            return
+        cur = self.main_con.cursor()
+        cur.execute("SELECT pg_advisory_unlock(%s);", (self.WRITE_LOCK,))
+        cur.close()
+        self.locked = False
 
     def commit(self):
         """
@@ -519,7 +1813,44 @@ class DbCache(object):
             cur.execute(sql)
             self.con.commit()
 
-    def add_node(self, identifier, version, x, y, tags):
+    def encode_tags(self, tag_sets):
+        """
+        Returns the values of the tag columns of some elements, the tags are
+        stored as hstore or as ids of the dictionary depending on
+        tag_storage
+
+        :param tag_sets: Tags of each element
+        :type tag_sets: list
+        :return: List of tuples with the hstore and the dictionary ids, one of them None
+        :rtype: list
+        """
+        if self.tag_storage != "dictionary":
+            return [(tags, None) for tags in tag_sets]
+        encoded = self.tag_dictionary.encode_many(self.con, tag_sets)
+        return [(None, None if tags is None else ids) for tags, ids in zip(tag_sets, encoded)]
+
+    def decode_tags(self, rows, column):
+        """
+        Replaces the tag columns of some rows by the tags, read from the
+        hstore or from the dictionary ids of the next column, so the rows
+        are the same whatever the storage
+
+        :param rows: Rows of the cache
+        :type rows: list
+        :param column: Position of the hstore column, followed by the dictionary ids
+        :type column: int
+        :return: Rows with the tags in place of both columns
+        :rtype: list
+        """
+        decoded = iter(self.tag_dictionary.decode_many(
+            self.con, [row[column + 1] for row in rows if row[column + 1] is not None]))
+        ret = []
+        for row in rows:
+            tags = next(decoded) if row[column + 1] is not None else row[column]
+            ret.append(tuple(row[:column]) + (tags,) + tuple(row[column + 2:]))
+        return ret
+
+    def add_node(self, identifier, version, lat, lon, tags):
         """
         Adds a node to the cache
 
@@ -527,22 +1858,49 @@ class DbCache(object):
         :type identifier: int
         :param version:
         :type version: int
-        :param x: X coordenate
-        :type x: float
-        :param y: Y coordenate
-        :type y: float
+        :param lat: Latitude
+        :type lat: float
+        :param lon: Longitude
+        :type lon: float
         :param tags: Tags to store
         :type tags: dict
         :return: None
         """
+        tag, tag_ids = self.encode_tags([tags])[0]
         cur = self.con.cursor()
-        insert_sql = """INSERT INTO cache_node
-                          VALUES (%s,%s,%s,ST_SetSRID(ST_MAKEPOINT(%s, %s),4326));
+        insert_sql = """INSERT INTO cache_node (id, version, tag, tag_ids, geom)
+                          VALUES (%s,%s,%s,%s,ST_SetSRID(ST_MAKEPOINT(%s, %s),4326));
                          
         """
-        cur.execute(insert_sql, (identifier, version, tags, x, y))
+        cur.execute(insert_sql, (identifier, version, tag, tag_ids, lon, lat))
         cur.close()
         self.pending_nodes += 1
+        if self.preloaded is not None:
+            self.preloaded.update_node(identifier, version, lat, lon, tags)
+
+    def add_nodes(self, nodes):
+        """
+        Adds a batch of nodes to the cache with a single statement
+
+        :param nodes: Tuples of identifier, version, lat, lon and tags
+        :type nodes: list
+        :return: None
+        """
+        import psycopg2.extras
+
+        if not nodes:
+            return
+        tags = self.encode_tags([n[4] for n in nodes])
+        cur = self.con.cursor()
+        insert_sql = """INSERT INTO cache_node (id, version, tag, tag_ids, geom) VALUES %s;"""
+        psycopg2.extras.execute_values(
+            cur, insert_sql, [(n[0], n[1], tag[0], tag[1], n[3], n[2]) for n, tag in zip(nodes, tags)],
+            template="(%s,%s,%s,%s,ST_SetSRID(ST_MAKEPOINT(%s, %s),4326))", page_size=1000)
+        cur.close()
+        self.pending_nodes += len(nodes)
+        if self.preloaded is not None:
+            for node in nodes:
+                self.preloaded.update_node(node[0], node[1], node[2], node[3], node[4])
 
     def get_pending_nodes(self):
         """
@@ -573,14 +1931,17 @@ class DbCache(object):
         :return: Data of the way
         :rtype: dict
         """
-        import json
+        if self.preloaded is not None:
+            data = self.preloaded.find_way(identifier, version)
+            if data is not None:
+                return self.way_data(data)
         sql_id = """
-                SELECT id,version,st_asgeojson(geom),tag
+                SELECT id,version,st_asbinary(geom),tag,tag_ids,nodes
                 FROM cache_way where id = %s;
                 """
 
         sql_version = """
-                SELECT id,version,st_asgeojson(geom),tag
+                SELECT id,version,st_asbinary(geom),tag,tag_ids,nodes
                 FROM cache_way WHERE id= %s AND version=%s;
                 """
         cur = self.con.cursor()
@@ -591,20 +1952,37 @@ class DbCache(object):
 
         data = cur.fetchone()
         if data:
-            coord = json.loads(data[2])["coordinates"]
-            pairs = []
-            for indx in range(len(coord))[::2]:
-                pairs.append([coord[indx],coord[indx + 1]])
-            return {"data":
-                {
-                    "id": data[0],
-                    "version": data[1],
-                    "coordinates": pairs,
-                    "tag": data[3]
-                }
-            }
+            from changewithin.wkb import decode_linestring
+
+            data = self.decode_tags([data], 3)[0]
+            coord = decode_linestring(data[2]).tolist() if data[2] is not None else None
+            return self.way_data((data[0], data[1], coord, data[3], data[4]))
         return None
 
+    def way_data(self, data):
+        """
+        Returns the data of a way from its row
+
+        :param data: Row with id, version, coordinates as [lat, lon] lists or None, tags and node ids
+        :type data: tuple
+        :return: Data of the way
+        :rtype: dict
+        """
+        pairs = []
+        if data[2] is not None:
+            coord = data[2]
+            for indx in range(0, len(coord), 2):
+                pairs.append(coord[indx:indx + 2])
+        return {"data":
+            {
+                "id": data[0],
+                "version": data[1],
+                "coordinates": pairs,
+                "tag": data[3],
+                "nodes": data[4] or []
+            }
+        }
+
     def get_node(self, identifier, version=None):
         """
         Returns a node of the cache, if version is not specified returns the last version avaible
@@ -616,13 +1994,25 @@ class DbCache(object):
         :return: dict with identifier, verison,x,y
         :rtype:dict
         """
+        if self.preloaded is not None:
+            data = self.preloaded.find_node(identifier, version)
+            if data is not None:
+                return {
+                    "data": {
+                        "id": data[0],
+                        "version": data[1],
+                        "lat": data[2],
+                        "lon": data[3],
+                        "tag": data[4]
+                    }
+                }
         sql_id = """
-        SELECT id,version,st_x(geom),st_y(geom),tag
+        SELECT id,version,st_y(geom),st_x(geom),tag,tag_ids
         FROM cache_node where id = %s;
         """
 
         sql_version = """
-        SELECT id,version,st_x(geom),st_y(geom),tag
+        SELECT id,version,st_y(geom),st_x(geom),tag,tag_ids
         FROM cache_node WHERE id= %s AND version=%s;
         """
         cur = self.con.cursor()
@@ -633,6 +2023,7 @@ class DbCache(object):
 
         data = cur.fetchone()
         if data:
+            data = self.decode_tags([data], 4)[0]
             return {
                 "data": {
                     "id": data[0],
@@ -644,37 +2035,594 @@ class DbCache(object):
             }
         return None
 
-    def add_way(self, identifier, version, nodes, tags):
+    def add_way(self, identifier, version, nodes, tags, refs=None):
         """
-        Adds a way into the cache
+        Adds a way into the cache with its node refs, the geometry is only
+        stored when all the nodes have location
 
         :param identifier: identifier of the way to store
         :type identifier: int
         :param version: version of the way
         :type version: int
-        :param nodes: Nodes to store
+        :param nodes: Nodes to store, osmium nodes or [lat, lon] lists
         :param tags: Tags to store
         :type tags: dict
-        :return: None
-        :rtype: None
+        :param refs: Node ids of the way, taken from the osmium nodes if not specified
+        :type refs: list
+        :return: True if the geometry was stored
+        :rtype: bool
         """
+        from psycopg2 import Binary
+        from changewithin.wkb import encode_linestring
+
         cur = self.con.cursor()
-        insert_sql = """INSERT INTO cache_way
-                          VALUES (%s,%s,%s,ST_SetSRID(ST_MakeLine(ARRAY[%s]),4326));
+        insert_sql = """INSERT INTO cache_way (id, version, tag, tag_ids, nodes, geom)
+                          VALUES (%s,%s,%s,%s,%s,ST_GeomFromWKB(%s, 4326));
 
         """
-        geom = []
-        has_geom = False
+        insert_no_geom_sql = """INSERT INTO cache_way (id, version, tag, tag_ids, nodes)
+                          VALUES (%s,%s,%s,%s,%s);
+        """
+        points = []
+        has_geom = True
+        node_refs = []
         for node in nodes:
-            if node.location.valid():
-                geom.append( "ST_MAKEPOINT({},{})".format(node.location.lat, node.location.lon))
-                has_geom = True
+            if isinstance(node, (list, tuple)):
+                points.append((node[0], node[1]))
             else:
-                return False
+                node_refs.append(node.ref)
+                if node.location.valid():
+                    points.append((node.location.lat, node.location.lon))
+                else:
+                    has_geom = False
+        # A line needs two points
+        has_geom = has_geom and len(points) > 1
+        if refs is None:
+            refs = node_refs
 
+        tag, tag_ids = self.encode_tags([tags])[0]
         if has_geom:
-            cur.execute(insert_sql, (identifier, version, tags, AsIs(",".join(geom))))
-            self.pending_ways += 1
+            cur.execute(insert_sql, (identifier, version, tag, tag_ids, refs or None,
+                                     Binary(encode_linestring(points))))
+        else:
+            cur.execute(insert_no_geom_sql, (identifier, version, tag, tag_ids, refs or None))
+        cur.close()
+        self.pending_ways += 1
+        if self.preloaded is not None:
+            self.preloaded.update_way(identifier, version, points if has_geom else None, tags, refs)
+        return has_geom
+
+    def get_ways_by_nodes(self, node_ids, chunk_size=10000):
+        """
+        Returns the ways whose last cached version uses any of the nodes
+
+        :param node_ids: Node ids
+        :type node_ids: list
+        :param chunk_size: Node ids sent on each query
+        :type chunk_size: int
+        :return: Way ids
+        :rtype: set
+        """
+        sql = """
+        SELECT w.id FROM cache_way w
+        WHERE w.nodes && %s::bigint[]
+        AND w.version = (SELECT max(version) FROM cache_way WHERE id = w.id);
+        """
+        node_ids = list(node_ids)
+        ways = set()
+        cur = self.con.cursor()
+        for start in range(0, len(node_ids), chunk_size):
+            cur.execute(sql, (node_ids[start:start + chunk_size],))
+            ways.update(row[0] for row in cur.fetchall())
+        cur.close()
+        return ways
+
+    def area_envelope(self, bbox):
+        """
+        Returns the parameters of ST_MakeEnvelope for a bounding box, in the
+        axis order of the cached geometries
+
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :return: Tuple with xmin, ymin, xmax and ymax
+        :rtype: tuple
+        """
+        north, east, south, west = bbox
+        return west, south, east, north
+
+    def ids_in_bbox(self, table, ids, bbox, chunk_size=10000):
+        """
+        Returns which of the elements intersect the bounding box, checking the
+        last cached version of each one
+
+        :param table: Cache table, cache_node or cache_way
+        :type table: str
+        :param ids: Element ids
+        :type ids: list
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :param chunk_size: Ids sent on each query
+        :type chunk_size: int
+        :return: Ids of the elements that intersect the bounding box
+        :rtype: set
+        """
+        sql = """
+        WITH area AS (SELECT ST_MakeEnvelope(%s, %s, %s, %s, 4326) AS geom)
+        SELECT e.id FROM {0} e, area
+        WHERE e.id = ANY(%s) AND e.geom && area.geom AND ST_Intersects(e.geom, area.geom)
+        AND e.version = (SELECT max(version) FROM {0} WHERE id = e.id);
+        """.format(table)
+        ids = list(ids)
+        ret = set()
+        if self.preloaded is not None:
+            # Only the elements that can't be decided in memory are queried
+            pending = []
+            for identifier in ids:
+                inside = self.preloaded.in_bbox("n" if table == "cache_node" else "w", identifier, bbox)
+                if inside is None:
+                    pending.append(identifier)
+                elif inside:
+                    ret.add(identifier)
+            ids = pending
+        cur = self.con.cursor()
+        for start in range(0, len(ids), chunk_size):
+            cur.execute(sql, self.area_envelope(bbox) + (ids[start:start + chunk_size],))
+            ret.update(row[0] for row in cur.fetchall())
+        cur.close()
+        return ret
+
+    def nodes_in_bbox(self, node_ids, bbox):
+        """
+        Returns which of the nodes are inside the bounding box
+
+        :param node_ids: Node ids
+        :type node_ids: list
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :return: Ids of the nodes inside the bounding box
+        :rtype: set
+        """
+        return self.ids_in_bbox("cache_node", node_ids, bbox)
+
+    def ways_in_bbox(self, way_ids, bbox):
+        """
+        Returns which of the ways intersect the bounding box
+
+        :param way_ids: Way ids
+        :type way_ids: list
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :return: Ids of the ways that intersect the bounding box
+        :rtype: set
+        """
+        return self.ids_in_bbox("cache_way", way_ids, bbox)
+
+    def get_extent(self, node_ids, way_ids):
+        """
+        Returns which nodes and ways are on the cache with geometry and the
+        envelope of all of them
+
+        :param node_ids: Node ids
+        :type node_ids: list
+        :param way_ids: Way ids
+        :type way_ids: list
+        :return: Set of cached node ids, set of cached way ids and the envelope as (south, west, north, east)
+            or None
+        :rtype: tuple
+        """
+        sql = """
+        WITH elements AS (
+            SELECT 'n' AS type, n.id, n.geom FROM cache_node n
+            WHERE n.id = ANY(%s) AND n.version = (SELECT max(version) FROM cache_node WHERE id = n.id)
+            UNION ALL
+            SELECT 'w' AS type, w.id, w.geom FROM cache_way w
+            WHERE w.id = ANY(%s) AND w.geom IS NOT NULL
+            AND w.version = (SELECT max(version) FROM cache_way WHERE id = w.id)
+        )
+        SELECT type, array_agg(id), ST_YMin(ST_Extent(geom)), ST_XMin(ST_Extent(geom)),
+               ST_YMax(ST_Extent(geom)), ST_XMax(ST_Extent(geom))
+        FROM elements GROUP BY type;
+        """
+        nodes = set()
+        ways = set()
+        extents = []
+        if self.preloaded is not None:
+            pending = {"n": [], "w": []}
+            for element_type, ids, found in (("n", node_ids, nodes), ("w", way_ids, ways)):
+                for identifier in ids:
+                    extent = self.preloaded.envelope(element_type, identifier)
+                    if extent is None:
+                        pending[element_type].append(identifier)
+                    else:
+                        found.add(identifier)
+                        extents.append(extent)
+            node_ids = pending["n"]
+            way_ids = pending["w"]
+        if not node_ids and not way_ids:
+            return nodes, ways, self.merge_extents(extents)
+        cur = self.con.cursor()
+        cur.execute(sql, (list(node_ids), list(way_ids)))
+        for element_type, ids, south, west, north, east in cur.fetchall():
+            if element_type == "n":
+                nodes.update(ids)
+            else:
+                ways.update(ids)
+            extents.append((south, west, north, east))
+        cur.close()
+        return nodes, ways, self.merge_extents(extents)
+
+    def merge_extents(self, extents):
+        """
+        Returns the envelope of several extents
+
+        :param extents: Tuples with south, west, north and east
+        :type extents: list
+        :return: Tuple with south, west, north and east or None if there are no extents
+        :rtype: tuple
+        """
+        if not extents:
+            return None
+        return (
+            min(e[0] for e in extents),
+            min(e[1] for e in extents),
+            max(e[2] for e in extents),
+            max(e[3] for e in extents)
+        )
+
+    def rebuild_way_geometries(self, way_ids, bbox=None):
+        """
+        Rebuilds the geometry of the last version of the ways from the last
+        cached version of their nodes. Ways with nodes missing on the cache
+        are left as they are.
+
+        :param way_ids: Way ids
+        :type way_ids: list
+        :param bbox: Tuple with north, east, south and west to check if the ways entered or left it
+        :type bbox: tuple
+        :return: List of tuples with the way id, if it was inside the bbox before, if it is inside now, the
+            distance between the old and the new geometry in degrees, the tags, the node ids and the version
+        :rtype: list
+        """
+        if not way_ids:
+            return []
+        if bbox is None:
+            bbox = (90, 180, -90, -180)
+        sql = """
+        WITH area AS (SELECT ST_MakeEnvelope(%s, %s, %s, %s, 4326) AS geom),
+        rebuilt AS (
+            SELECT w.id, w.version, w.geom AS old_geom,
+                   ST_SetSRID(ST_MakeLine(n.geom ORDER BY u.ord), 4326) AS geom,
+                   count(n.geom) AS found, count(*) AS total
+            FROM cache_way w
+            CROSS JOIN LATERAL unnest(w.nodes) WITH ORDINALITY AS u(ref, ord)
+            LEFT JOIN LATERAL (
+                SELECT geom FROM cache_node WHERE id = u.ref ORDER BY version DESC LIMIT 1
+            ) n ON true
+            WHERE w.id = ANY(%s)
+            AND w.version = (SELECT max(version) FROM cache_way WHERE id = w.id)
+            GROUP BY w.id, w.version, w.geom
+        )
+        UPDATE cache_way w SET geom = rebuilt.geom
+        FROM rebuilt, area
+        WHERE w.id = rebuilt.id AND w.version = rebuilt.version
+        AND rebuilt.found = rebuilt.total AND rebuilt.total > 1
+        RETURNING w.id, COALESCE(ST_Intersects(rebuilt.old_geom, area.geom), false),
+                  ST_Intersects(rebuilt.geom, area.geom), ST_HausdorffDistance(rebuilt.old_geom, rebuilt.geom),
+                  w.tag, w.tag_ids, w.nodes, w.version;
+        """
+        cur = self.con.cursor()
+        cur.execute(sql, self.area_envelope(bbox) + (list(way_ids),))
+        data = cur.fetchall()
+        cur.close()
+        data = self.decode_tags(data, 4)
+        if self.preloaded is not None:
+            for way_id in way_ids:
+                self.preloaded.forget_way(way_id)
+        return data
+
+    def preload(self, bbox):
+        """
+        Loads in memory the last versions of the cached nodes and ways of a
+        bounding box, the lookups of those elements are then answered
+        without queries
+
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :return: Loaded elements
+        :rtype: changewithin.preload.AreaPreload
+        """
+        from changewithin.preload import AreaPreload
+
+        preloaded = AreaPreload()
+        # The tags of the area are decoded without a query each
+        self.tag_dictionary.load(self.con)
+        preloaded.load(self.con, self.area_envelope(bbox), tags=self.tag_dictionary)
+        self.preloaded = preloaded
+        return preloaded
+
+    def get_previous_locations(self, node_ids, versions, chunk_size=10000):
+        """
+        Returns the location of the last cached version of the nodes older
+        than the given ones
+
+        :param node_ids: Node ids
+        :type node_ids: list
+        :param versions: Current version of each node
+        :type versions: list
+        :param chunk_size: Nodes sent on each query
+        :type chunk_size: int
+        :return: dict with the node id and a tuple with lat and lon
+        :rtype: dict
+        """
+        sql = """
+        SELECT q.id, st_y(p.geom), st_x(p.geom)
+        FROM unnest(%s::bigint[], %s::integer[]) AS q(id, version)
+        JOIN LATERAL (
+            SELECT geom FROM cache_node
+            WHERE id = q.id AND version < q.version AND geom IS NOT NULL
+            ORDER BY version DESC LIMIT 1
+        ) p ON true;
+        """
+        ret = {}
+        cur = self.con.cursor()
+        for start in range(0, len(node_ids), chunk_size):
+            cur.execute(sql, (list(node_ids[start:start + chunk_size]), list(versions[start:start + chunk_size])))
+            for identifier, lat, lon in cur.fetchall():
+                ret[identifier] = (lat, lon)
+        cur.close()
+        return ret
+
+    def get_previous_versions(self, element_type, ids, versions, chunk_size=10000):
+        """
+        Returns the last cached version older than the given one of some
+        elements, with a query per chunk. Used to place the deleted
+        elements, that have neither location nor tags on the diff.
+
+        :param element_type: node, way or relation
+        :type element_type: str
+        :param ids: Element ids
+        :type ids: list
+        :param versions: Version of each element on the diff
+        :type versions: list
+        :param chunk_size: Elements sent on each query
+        :type chunk_size: int
+        :return: dict with the element id and a tuple with the version, the tags and the coordinates as [lat, lon]
+            lists for the nodes and ways, the version, None and the envelope as (south, west, north, east) for the
+            relations, that have no cached tags
+        :rtype: dict
+        """
+        from changewithin.wkb import decode_linestring
+
+        sql = {
+            "node": """
+            SELECT q.id, p.version, st_y(p.geom), st_x(p.geom), p.tag, p.tag_ids
+            FROM unnest(%s::bigint[], %s::integer[]) AS q(id, version)
+            JOIN LATERAL (
+                SELECT version, geom, tag, tag_ids FROM cache_node
+                WHERE id = q.id AND version < q.version AND geom IS NOT NULL
+                ORDER BY version DESC LIMIT 1
+            ) p ON true;
+            """,
+            "way": """
+            SELECT q.id, p.version, st_asbinary(p.geom), p.tag, p.tag_ids
+            FROM unnest(%s::bigint[], %s::integer[]) AS q(id, version)
+            JOIN LATERAL (
+                SELECT version, geom, tag, tag_ids FROM cache_way
+                WHERE id = q.id AND version < q.version AND geom IS NOT NULL
+                ORDER BY version DESC LIMIT 1
+            ) p ON true;
+            """,
+            "relation": """
+            SELECT q.id, p.version, st_ymin(p.envelope), st_xmin(p.envelope), st_ymax(p.envelope),
+                   st_xmax(p.envelope)
+            FROM unnest(%s::bigint[], %s::integer[]) AS q(id, version)
+            JOIN LATERAL (
+                SELECT version, envelope FROM cache_relation
+                WHERE id = q.id AND version < q.version
+                ORDER BY version DESC LIMIT 1
+            ) p ON true;
+            """
+        }[element_type]
+        ret = {}
+        cur = self.con.cursor()
+        for start in range(0, len(ids), chunk_size):
+            cur.execute(sql, (list(ids[start:start + chunk_size]), list(versions[start:start + chunk_size])))
+            rows = cur.fetchall()
+            if element_type == "node":
+                for identifier, version, lat, lon, tags in self.decode_tags(rows, 4):
+                    ret[identifier] = (version, tags or {}, [[lat, lon]])
+            elif element_type == "way":
+                for identifier, version, wkb, tags in self.decode_tags(rows, 3):
+                    ret[identifier] = (version, tags or {}, decode_linestring(wkb).tolist())
+            else:
+                for row in rows:
+                    ret[row[0]] = (row[1], None, tuple(row[2:6]))
+        cur.close()
+        return ret
+
+    def get_reshaped_ways(self, way_ids, versions, tolerance, chunk_size=10000):
+        """
+        Returns which of the ways differ from their previous cached version
+        further than the tolerance
+
+        :param way_ids: Way ids
+        :type way_ids: list
+        :param versions: Current version of each way
+        :type versions: list
+        :param tolerance: Maximum distance between the geometries in degrees
+        :type tolerance: float
+        :param chunk_size: Ways sent on each query
+        :type chunk_size: int
+        :return: Ids of the reshaped ways
+        :rtype: set
+        """
+        sql = """
+        SELECT q.id
+        FROM unnest(%s::bigint[], %s::integer[]) AS q(id, version)
+        JOIN cache_way w ON w.id = q.id AND w.version = q.version
+        JOIN LATERAL (
+            SELECT geom FROM cache_way
+            WHERE id = q.id AND version < q.version AND geom IS NOT NULL
+            ORDER BY version DESC LIMIT 1
+        ) p ON true
+        WHERE w.geom IS NOT NULL AND ST_HausdorffDistance(p.geom, w.geom) > %s;
+        """
+        ret = set()
+        cur = self.con.cursor()
+        for start in range(0, len(way_ids), chunk_size):
+            cur.execute(sql, (list(way_ids[start:start + chunk_size]), list(versions[start:start + chunk_size]),
+                              tolerance))
+            ret.update(row[0] for row in cur.fetchall())
+        cur.close()
+        return ret
+
+    def add_relation(self, identifier, version, envelope, inside=None):
+        """
+        Adds the envelope of a relation version into the cache, a version
+        already cached is kept
+
+        :param identifier: identifier of the relation
+        :type identifier: int
+        :param version: version of the relation
+        :type version: int
+        :param envelope: Tuple with south, west, north and east
+        :type envelope: tuple
+        :param inside: True if a member is inside the bbox, None if unknown
+        :type inside: bool
+        :return: None
+        :rtype: None
+        """
+        south, west, north, east = envelope
+        cur = self.con.cursor()
+        insert_sql = """INSERT INTO cache_relation (id, version, envelope, inside)
+                          VALUES (%s,%s,ST_MakeEnvelope(%s, %s, %s, %s, 4326),%s)
+                          ON CONFLICT DO NOTHING;
+        """
+        cur.execute(insert_sql, (identifier, version, west, south, east, north, inside))
+        cur.close()
+
+    def get_relation(self, identifier, version=None):
+        """
+        Gets the envelope of a relation from the cache, if version is not
+        specified returns the last version avaible
+
+        :param identifier: Identifier of the relation
+        :type identifier: int
+        :param version: Version of the relation
+        :type version: int
+        :return: dict with identifier, version, envelope as (south, west, north, east) and inside, True if a
+            member is inside the bbox or None if unknown
+        :rtype: dict
+        """
+        sql_id = """
+        SELECT id,version,st_ymin(envelope),st_xmin(envelope),st_ymax(envelope),st_xmax(envelope),inside
+        FROM cache_relation WHERE id = %s ORDER BY version DESC LIMIT 1;
+        """
+
+        sql_version = """
+        SELECT id,version,st_ymin(envelope),st_xmin(envelope),st_ymax(envelope),st_xmax(envelope),inside
+        FROM cache_relation WHERE id = %s AND version = %s;
+        """
+        cur = self.con.cursor()
+        if version is None:
+            cur.execute(sql_id, (identifier,))
+        else:
+            cur.execute(sql_version, (identifier, version))
+        data = cur.fetchone()
+        cur.close()
+        if data:
+            return {
+                "data": {
+                    "id": data[0],
+                    "version": data[1],
+                    "envelope": (data[2], data[3], data[4], data[5]),
+                    "inside": data[6]
+                }
+            }
+        return None
+
+    def start_run(self, source=None):
+        """
+        Registers a run whose matched changes are stored in the results table
+
+        :param source: Name of the processed file or state url
+        :type source: str
+        :return: Identifier of the run
+        :rtype: int
+        """
+        cur = self.con.cursor()
+        cur.execute("INSERT INTO result_run (source) VALUES (%s) RETURNING id;", (source,))
+        run_id = cur.fetchone()[0]
+        cur.close()
+        return run_id
+
+    def add_results(self, run_id, changes):
+        """
+        Stores the matched changes of a run, the changes already stored by
+        a previous run are skipped
+
+        :param run_id: Identifier of the run
+        :type run_id: int
+        :param changes: List of changes as written to the exporters
+        :type changes: list
+        :return: None
+        :rtype: None
+        """
+        from psycopg2.extras import execute_values
+
+        rows = []
+        for change in changes:
+            day = change.get("timestamp")
+            rows.append((run_id, change["changeset"], change["uid"], change["user"], change["type"], change["id"],
+                         change["version"], change["rule"], change["lat"], change["lon"],
+                         day[:10] if day else None))
+        cur = self.con.cursor()
+        insert_sql = """INSERT INTO result_change
+                          (run_id, changeset, uid, username, element_type, element_id, version, rule, lat, lon, day)
+                          VALUES %s ON CONFLICT DO NOTHING;
+        """
+        execute_values(cur, insert_sql, rows,
+                       template="(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,COALESCE(%s::date, CURRENT_DATE))")
+        cur.close()
+
+    def get_rollup(self, period="day", start=None, end=None):
+        """
+        Summarizes the stored changes by period, rule and type of element
+
+        :param period: Length of the periods, one of day, week or month
+        :type period: str
+        :param start: First day included, None for no limit
+        :type start: str
+        :param end: Last day included, None for no limit
+        :type end: str
+        :return: List of dicts with period, rule, type, changes, changesets and users
+        :rtype: list
+        """
+        if period not in ("day", "week", "month"):
+            raise ValueError("Unknown period {}, expected one of day, week or month".format(period))
+        sql = """
+        SELECT date_trunc(%s, day)::date AS period, rule, element_type,
+               count(*), count(DISTINCT changeset), count(DISTINCT uid)
+        FROM result_change
+        WHERE (%s::date IS NULL OR day >= %s::date) AND (%s::date IS NULL OR day <= %s::date)
+        GROUP BY period, rule, element_type
+        ORDER BY period, rule, element_type;
+        """
+        cur = self.con.cursor()
+        cur.execute(sql, (period, start, start, end, end))
+        data = cur.fetchall()
+        cur.close()
+        return [
+            {
+                "period": row[0].isoformat(),
+                "rule": row[1],
+                "type": row[2],
+                "changes": row[3],
+                "changesets": row[4],
+                "users": row[5]
+            }
+            for row in data
+        ]
 
 
 
@@ -684,7 +2632,7 @@ class ChangeWithin(object):
     Class that process the OSC files
     """
 
-    def __init__(self, host=None, db=None, user=None, password=None):
+    def __init__(self, host=None, db=None, user=None, password=None, pool_size=4):
         """
         Initiliazes the class
 
@@ -692,26 +2640,78 @@ class ChangeWithin(object):
         :param db: Database name
         :param user: Database user
         :param password: Databse password
+        :param pool_size: Maximum number of connections to the database
         """
 
         self.conf = {}
         self.env_vars = {}
         self.handler = ChangeHandler()
         self.osc_file = None
+        self.store_results = True
+        self.mirror = None
+        self.replication_url = None
+        self.notifier = None
+        self.preload = False
+        self.lookup_workers = 0
+        self.lookup_queue = 1000
+        self.prefetch = 2
+        self.pipeline_report = False
+        self.pipeline_stats = []
         self.changesets = []
         self.stats = {}
 
+        # Only the cache created here is closed by close, a shared one is
+        # closed by its owner
+        self.owns_cache = False
         if host is not None and db is not None and user is not None and password is not None:
             self.has_cache = True
-            self.handler.set_cache(host, db, user, password)
+            self.handler.set_cache(host, db, user, password, pool_size)
+            self.owns_cache = True
         else:
             self.has_cache = False
             self.cache = None
 
-        self.jinja_env = Environment(extensions=['jinja2.ext.i18n'])
-        pkg_dir, this_filename = os.path.split(__file__)
-        self.text_tmpl = self.get_template(os.path.join(pkg_dir, 'templates', 'text_template.txt'))
-        self.html_tmpl = self.get_template(os.path.join(pkg_dir, 'templates', 'html_template.html'))
+        # The templates are compiled on the first render
+        self.translations = None
+        self.env = None
+        self.templates = {}
+
+    @property
+    def jinja_env(self):
+        """
+        Jinja environment, created on first use
+
+        :return: Environment
+        """
+        if self.env is None:
+            from jinja2 import Environment
+
+            self.env = Environment(extensions=['jinja2.ext.i18n'])
+            if self.translations is not None:
+                self.env.install_gettext_translations(self.translations)
+        return self.env
+
+    @property
+    def text_tmpl(self):
+        """
+        Text template of the report
+
+        :return: Template
+        """
+        if "text" not in self.templates:
+            self.templates["text"] = self.get_template('text_template.txt')
+        return self.templates["text"]
+
+    @property
+    def html_tmpl(self):
+        """
+        HTML template of the report
+
+        :return: Template
+        """
+        if "html" not in self.templates:
+            self.templates["html"] = self.get_template('html_template.html')
+        return self.templates["html"]
 
     def initialize_db(self):
         """
@@ -720,7 +2720,7 @@ class ChangeWithin(object):
         :return:
         """
         if self.has_cache:
-            self.cache.initialize()
+            self.handler.cache.initialize()
 
     def get_template(self, template_name):
         """
@@ -743,6 +2743,9 @@ class ChangeWithin(object):
         :return: None
         """
         if not config:
+            from configobj import ConfigObj
+            from osconf import config_from_environment
+
             self.env_vars = config_from_environment('bard', ['config'])
             self.conf = ConfigObj(self.env_vars["config"])
         else:
@@ -768,14 +2771,113 @@ class ChangeWithin(object):
             'messages',
             localedir=url_locales,
             languages=languages)
-        self.jinja_env.install_gettext_translations(translations)
+        self.translations = translations
+        if self.env is not None:
+            self.env.install_gettext_translations(translations)
 
         self.handler.set_bbox(*self.conf["area"]["bbox"])
         for name in self.conf["tags"]:
             key, value = self.conf["tags"][name]["tags"].split("=")
             types = self.conf["tags"][name]["tags"].split(",")
             self.stats["name"] = 0
-            self.handler.set_tags(name, key, value, types)
+            geometry = self.conf["tags"][name].get("geometry", "no").lower() in ("yes", "true", "1")
+            self.handler.set_tags(name, key, value, types, geometry)
+        if "osm" in self.conf and "api_url" in self.conf["osm"]:
+            self.handler.api_url = self.conf["osm"]["api_url"]
+        if "replication" in self.conf and "url" in self.conf["replication"]:
+            self.replication_url = self.conf["replication"]["url"]
+        if "memory" in self.conf and "budget" in self.conf["memory"]:
+            from changewithin.spill import ChangeSpill
+
+            memory = self.conf["memory"]
+            self.handler.spill = ChangeSpill(
+                int(float(memory["budget"]) * 1024 * 1024), memory.get("directory"))
+        if "stats" in self.conf and "mode" in self.conf["stats"]:
+            stats = self.conf["stats"]
+            mode = str(stats["mode"]).lower()
+            if mode not in ("exact", "approximate"):
+                raise ValueError("Unknown stats mode: {}".format(mode))
+            if mode == "approximate":
+                from changewithin.sketch import ApproximateStats
+
+                self.handler.sketch = ApproximateStats(int(stats.get("precision", 14)), top=int(stats.get("top", 10)))
+        if "mirror" in self.conf and "path" in self.conf["mirror"]:
+            from changewithin.mirror import ReplicationMirror, REPLICATION_URL
+
+            mirror = self.conf["mirror"]
+            max_size = mirror.get("max_size")
+            self.mirror = ReplicationMirror(
+                mirror["path"], mirror.get("url", self.replication_url or REPLICATION_URL),
+                int(float(max_size) * 1024 * 1024) if max_size else None, float(mirror.get("timeout", 60.0)))
+        if self.notifier is None:
+            from changewithin.notify import webhook_notifier
+
+            self.notifier = webhook_notifier(self.conf)
+            self.handler.notifier = self.notifier
+        if "cache" in self.conf and "buffer" in self.conf["cache"]:
+            self.handler.cache_buffer = float(self.conf["cache"]["buffer"])
+        if "cache" in self.conf and "tags" in self.conf["cache"] and self.handler.cache_enabled:
+            tag_storage = str(self.conf["cache"]["tags"]).lower()
+            if tag_storage not in ("hstore", "dictionary"):
+                raise ValueError("Unknown tag storage of the cache: {}".format(tag_storage))
+            self.handler.cache.tag_storage = tag_storage
+        if "pipeline" in self.conf:
+            pipeline = self.conf["pipeline"]
+            if "lookup_workers" in pipeline:
+                self.lookup_workers = int(pipeline["lookup_workers"])
+            if "lookup_queue" in pipeline:
+                self.lookup_queue = int(pipeline["lookup_queue"])
+            if "prefetch" in pipeline:
+                self.prefetch = int(pipeline["prefetch"])
+            if "stats" in pipeline:
+                self.pipeline_report = str(pipeline["stats"]).lower() in ("yes", "true", "1")
+        if "deleted" in self.conf:
+            deleted = self.conf["deleted"]
+            if "place" in deleted:
+                self.handler.place_deleted = str(deleted["place"]).lower() in ("yes", "true", "1")
+            if "api_limit" in deleted:
+                self.handler.deleted_api_limit = int(deleted["api_limit"])
+        if "cache" in self.conf and "preload" in self.conf["cache"]:
+            self.preload = str(self.conf["cache"]["preload"]).lower() in ("yes", "true", "1")
+        if "geometry" in self.conf and "tolerance" in self.conf["geometry"]:
+            self.handler.geometry_tolerance = float(self.conf["geometry"]["tolerance"])
+
+        if "errors" in self.conf:
+            errors = self.conf["errors"]
+            if "max_error_rate" in errors:
+                self.handler.errors.max_error_rate = float(errors["max_error_rate"])
+            if "min_elements" in errors:
+                self.handler.errors.min_elements = int(errors["min_elements"])
+            if "report_interval" in errors:
+                self.handler.errors.report_interval = float(errors["report_interval"])
+            if "samples" in errors:
+                self.handler.errors.samples = int(errors["samples"])
+
+    def add_export(self, export_format, path):
+        """
+        Adds an output where the matched changes are written while the file
+        is processed
+
+        :param export_format: Format, one of jsonl, csv or geojsonseq
+        :type export_format: str
+        :param path: Path of the output file, - for stdout
+        :type path: str
+        :return: None
+        """
+        self.handler.exporters.append(get_exporter(export_format, path))
+
+    def add_extract(self, path):
+        """
+        Writes the objects of the diff inside the area to a clipped change
+        file
+
+        :param path: Path of the output, .osc or .osc.gz
+        :type path: str
+        :return: None
+        """
+        from changewithin.extract import ChangeExtract
+
+        self.handler.extract = ChangeExtract(path)
 
     def process_file(self, filename=None):
         """
@@ -783,76 +2885,259 @@ class ChangeWithin(object):
         :param filename: 
         :return: 
         """
-        if filename is None:
-            self.osc_file = get_osc()
-            self.handler.apply_file(self.osc_file,
-                                    osmium.osm.osm_entity_bits.CHANGESET)
+        from changewithin.pipeline import Prefetch, StageStats
+
+        self.pipeline_stats = []
+        results = None
+        fetch = None
+        try:
+            if filename is None:
+                # Downloaded while the cache is locked and preloaded
+                fetch = Prefetch(lambda item: get_osc(mirror=self.mirror, url=self.replication_url), [None], 1)
+            if self.handler.cache_enabled:
+                self.handler.cache.lock_writes()
+            if self.handler.cache_enabled and self.preload:
+                self.preload_area()
+            if fetch is not None:
+                item, self.osc_file, exc_info = next(iter(fetch))
+                fetch.close()
+                self.pipeline_stats.append(fetch.stats.summary())
+                fetch = None
+                if exc_info is not None:
+                    raise exc_info[1]
+            if self.handler.cache_enabled and self.store_results:
+                source = filename if filename is not None else self.osc_file
+                # Only for this run, the instance may process more files
+                results = ResultWriter(self.handler.cache, source)
+                self.handler.exporters.append(results)
+            osc_file = self.osc_file if filename is None else filename
+            workers = self.lookup_workers
+            if self.handler.cache_enabled:
+                # Each worker takes a connection of the cache pool
+                workers = min(workers, self.handler.cache.pool_size - 1)
+            if workers > 0 and self.handler.tags:
+                self.handler.start_lookups(workers, self.lookup_queue)
+            parse = StageStats("parse")
+            filters = self.handler.prefilters()
+            if filters:
+                self.handler.apply_file(osc_file, osmium.osm.osm_entity_bits.CHANGESET, filters=filters)
+            else:
+                self.handler.apply_file(osc_file, osmium.osm.osm_entity_bits.CHANGESET)
+            self.handler.flush_nodes()
+            parse.done(time.time() - parse.started,
+                       self.handler.num_nodes + self.handler.num_ways + self.handler.num_rel)
+            parse.finish()
+            self.pipeline_stats.append(parse.summary())
+            # The matching waits here for the lookups still running
+            self.pipeline_stats.extend(self.handler.finish_lookups())
+            self.handler.resolve_deleted()
+            if self.handler.extract is not None:
+                self.handler.extract.write(osc_file)
+            if self.handler.cache_enabled:
+                self.handler.cache.commit()
+                self.handler.update_way_geometries()
+                self.handler.check_way_geometries()
+                self.handler.cache.commit()
+                if self.handler.cache_buffer is not None:
+                    sys.stderr.write('cache: {} nodes and {} ways outside the area skipped, {} nodes of the ways '
+                                     'of the area stored\n'.format(self.handler.cache_skipped["node"],
+                                                                   self.handler.cache_skipped["way"],
+                                                                   self.handler.cache_referenced))
+            resolved = self.handler.deleted_resolved
+            if any(resolved.values()):
+                sys.stderr.write('deleted elements: {} placed from the cache, {} from the API, {} unresolved\n'.format(
+                    resolved["cache"], resolved["api"], resolved["unresolved"]))
+            if self.pipeline_report:
+                from changewithin.pipeline import write_stats
+
+                write_stats(self.pipeline_stats)
+        finally:
+            if fetch is not None:
+                fetch.close()
+            if self.handler.lookups is not None:
+                # The run failed, the workers are stopped before the cache is used again
+                self.handler.finish_lookups(discard=True)
+            for exporter in self.handler.exporters:
+                exporter.close()
+            if results is not None:
+                self.handler.exporters.remove(results)
+            if self.handler.cache_enabled:
+                self.handler.cache.unlock_writes()
+            self.handler.errors.report()
+
+        if self.handler.sketch is not None:
+            self.changesets = {}
+            self.stats = self.handler.sketch.report_stats()
+        elif self.handler.spill is not None:
+            try:
+                self.changesets, self.stats, total = self.handler.spill.summary(list(self.handler.tags.keys()))
+            finally:
+                self.handler.spill.close()
+            self.stats["total"] = total
         else:
-            self.handler.apply_file(filename,
-                                    osmium.osm.osm_entity_bits.CHANGESET)
+            self.changesets = self.handler.changeset
+            self.stats = self.handler.stats
+            self.stats["total"] = len(self.changesets)
 
-        self.changesets = self.handler.changeset
-        self.stats = self.handler.stats
-        self.stats["total"] = len(self.changesets)
+    def preload_area(self):
+        """
+        Loads in memory the cached elements of the area, with the cache
+        buffer if there is one
 
-    def report(self):
+        :return: Loaded elements
+        :rtype: changewithin.preload.AreaPreload
         """
-        Generates the report and sends it
+        handler = self.handler
+        area = handler.cache_area() or (handler.north, handler.east, handler.south, handler.west)
+        preloaded = handler.cache.preload(area)
+        sys.stderr.write('preload: {} nodes and {} ways in {:.1f}s, {:.1f} MB\n'.format(
+            len(preloaded.node_ids), len(preloaded.ways), preloaded.load_time, preloaded.size / 1048576.0))
+        return preloaded
+
+    def close(self):
+        """
+        Sends the changes still queued for the webhooks, then releases the
+        write lock and the connections of the cache created by the instance
 
         :return: None
         """
-        from datetime import datetime
-        print ("self.changesets:{}".format(self.changesets))
-        if len(self.changesets) > 1000:
-            self.changesets = self.changesets[:999]
-            self.stats[
-                'limit_exceed'] = 'Note: For performance reasons only the first 1000 changesets are displayed.'
-
-        now = datetime.now()
+        try:
+            if self.notifier is not None:
+                self.notifier.close()
+                self.notifier = None
+                self.handler.notifier = None
+        finally:
+            if self.owns_cache:
+                self.handler.cache.close()
+
+    def cache_file(self, filename):
+        """
+        Stores the elements of a file on the cache without matching them,
+        used to keep the cache up to date with diffs matched elsewhere
 
-        for state in self.stats:
-            if state != "total":
-                self.stats[state] = len(set(self.stats[state]))
+        :param filename: Path of the osc file
+        :type filename: str
+        :return: None
+        """
+        if not self.handler.cache_enabled:
+            return
+        tags = self.handler.tags
+        self.handler.tags = {}
+        self.handler.cache.lock_writes()
+        try:
+            self.handler.apply_file(filename, osmium.osm.osm_entity_bits.CHANGESET)
+            self.handler.flush_nodes()
+            self.handler.cache.commit()
+            self.handler.update_way_geometries()
+            self.handler.cache.commit()
+        finally:
+            self.handler.tags = tags
+            self.handler.cache.unlock_writes()
+
+    def render(self, changesets, stats, date):
+        """
+        Renders the report of some changesets
+
+        :param changesets: Changesets as ChangeHandler.changeset
+        :type changesets: dict
+        :param stats: Changesets by tag name, as sets or counts, and the total
+        :type stats: dict
+        :param date: Date of the report
+        :type date: datetime.date
+        :return: Tuple with the HTML and the text versions
+        :rtype: tuple
+        """
+        stats = dict(stats)
+        for state in stats:
+            if state != "total" and not isinstance(stats[state], int):
+                stats[state] = len(set(stats[state]))
+
+        if stats.get("total", len(changesets)) > 1000:
+            changesets = dict(list(changesets.items())[:999])
+            stats[
+                'limit_exceed'] = 'Note: For performance reasons only the first 1000 changesets are displayed.'
 
         template_data = {
-            'changesets': self.changesets,
-            'stats': self.stats,
-            'date': now.strftime("%B %d, %Y"),
+            'changesets': changesets,
+            'stats': stats,
+            'date': date.strftime("%B %d, %Y"),
             'tags': self.conf['tags'].keys()
         }
-        html_version = self.html_tmpl.render(**template_data)
-        text_version = self.text_tmpl.render(**template_data)
+        return self.html_tmpl.render(**template_data), self.text_tmpl.render(**template_data)
+
+    def report(self):
+        """
+        Generates the report and sends it
+
+        :return: None
+        """
+        from datetime import datetime
+        import io
+        import requests
 
+        from changewithin.pipeline import Prefetch, StageStats
+
+        print ("self.changesets:{}".format(self.changesets))
+        now = datetime.now()
+        first = len(self.pipeline_stats)
+        render = StageStats("render")
+        html_version, text_version = self.render(self.changesets, self.stats, now)
+        render.done(time.time() - render.started)
+        render.finish()
+        self.pipeline_stats.append(render.summary())
+
+        send = None
         if 'domain' in self.conf['mailgun'] and 'api_key' in self.conf['mailgun']:
             if "api_url" in self.conf["mailgun"]:
                 url = self.conf["mailgun"]["api_url"]
             else:
                 url = 'https://api.mailgun.net/v3/{0}/messages'.format(
                     self.conf['mailgun']['domain'])
-            resp = requests.post(
-                url,
-                auth=("api", self.conf['mailgun']['api_key']),
-                data={"from": "OSM Changes <mailgun@{}>".format(
-                    self.conf['mailgun']['domain']),
-                      "to": self.conf["email"]["recipients"].split(),
-                      "subject": 'OSM building and address changes {0}'.format(
-                          now.strftime("%B %d, %Y")),
-                      "text": text_version,
-                      "html": html_version})
-            print("response:{}".format(resp.status_code))
-            print("mailgun response:{}".format(resp.content))
-
-        file_name = 'osm_change_report_{0}.html'.format(
-            now.strftime('%m-%d-%y'))
-        f_out = open(file_name, 'w')
-        f_out.write(html_version.encode('utf-8'))
-        f_out.close()
-        print('Wrote {0}'.format(file_name))
+            data = {"from": "OSM Changes <mailgun@{}>".format(
+                self.conf['mailgun']['domain']),
+                    "to": self.conf["email"]["recipients"].split(),
+                    "subject": 'OSM building and address changes {0}'.format(
+                        now.strftime("%B %d, %Y")),
+                    "text": text_version,
+                    "html": html_version}
+            # Sent while the report files are written
+            send = Prefetch(lambda item: requests.post(url, auth=("api", self.conf['mailgun']['api_key']), data=data),
+                            [None], 1, name="send")
+
+        try:
+            file_name = 'osm_change_report_{0}.html'.format(
+                now.strftime('%m-%d-%y'))
+            with io.open(file_name, 'w', encoding='utf-8') as f_out:
+                f_out.write(html_version)
+            print('Wrote {0}'.format(file_name))
+            if self.handler.sketch is not None:
+                # Merged with the stats of other days by merge-stats
+                file_name = 'osm_change_stats_{0}.json'.format(now.strftime('%m-%d-%y'))
+                with io.open(file_name, 'w', encoding='utf-8') as f_out:
+                    f_out.write(u"{}".format(self.handler.sketch.dumps()))
+                print('Wrote {0}'.format(file_name))
+            if send is not None:
+                item, resp, exc_info = next(iter(send))
+                if exc_info is not None:
+                    raise exc_info[1]
+                print("response:{}".format(resp.status_code))
+                print("mailgun response:{}".format(resp.content))
+        finally:
+            if send is not None:
+                send.close()
+                self.pipeline_stats.append(send.stats.summary())
+        if self.pipeline_report:
+            from changewithin.pipeline import write_stats
+
+            write_stats(self.pipeline_stats[first:])
         # os.unlink(self.osc_file)
 
 
 if __name__ == '__main__':
+    from raven import Client
+
     client = Client()
+    c = None
     try:
         c = ChangeWithin()
         c.load_config()
@@ -860,3 +3145,6 @@ if __name__ == '__main__':
         c.report()
     except Exception:
         client.captureException()
+    finally:
+        if c is not None:
+            c.close()
@@ -1,22 +1,24 @@
 # -*- coding: utf-8 -*-
 import click
-from raven import Client
-from changewithin import ChangeWithin
 
 
-@click.group()
-def changeswithin():
-    pass
-
-
-@changeswithin.command()
+@click.group(invoke_without_command=True)
 @click.option('--host', default=None)
 @click.option('--db', default=None)
 @click.option('--user', default=None)
 @click.option('--password', default=None)
 @click.option('--initialize/--no-initialize', default=False)
+@click.option("--pool-size", default=4, help="Maximum number of connections to the database")
 @click.option("--file",default=None)
-def changeswithin(host, db, user, password, initialize, file):
+@click.option("--export", default=None, help="File where the matched changes are written, - for stdout")
+@click.option("--export-format", default="jsonl", type=click.Choice(["jsonl", "csv", "geojsonseq"]))
+@click.option("--extract", default=None, help="File where the objects inside the area are written, .osc or .osc.gz")
+@click.option('--report/--no-report', default=True)
+@click.option("--store-results/--no-store-results", default=True,
+              help="Store the matched changes in the database for the rollup reports")
+@click.pass_context
+def changeswithin(ctx, host, db, user, password, initialize, pool_size, file, export, export_format, extract, report,
+                  store_results):
     """
     Client entry
 
@@ -25,26 +27,238 @@ def changeswithin(host, db, user, password, initialize, file):
     :param user:
     :param password:
     :param initialize:
+    :param pool_size:
     :param file:
+    :param export:
+    :param export_format:
+    :param extract:
+    :param report:
+    :param store_results:
     :return:
     """
 
+    if ctx.invoked_subcommand is not None:
+        return
+    from raven import Client
+    from changewithin.changewithin import ChangeWithin
+
     client = Client()
+    c = None
     try:
-        c = ChangeWithin(host, db, user, password)
+        c = ChangeWithin(host, db, user, password, pool_size)
         if initialize:
             c.initialize_db()
         else:
             c.load_config()
+            if export is not None:
+                c.add_export(export_format, export)
+            if extract is not None:
+                c.add_extract(extract)
+            c.handler.keep_changesets = report
+            c.store_results = store_results
             if file is not None:
                 c.process_file(str(file))
             else:
                 c.process_file()
-            c.report()
+            if report:
+                c.report()
     except Exception as e:
-        print(e.message)
+        print(e)
         client.captureException()
+    finally:
+        if c is not None:
+            c.close()
+
+
+@changeswithin.command()
+@click.option('--host', default=None)
+@click.option('--db', default=None)
+@click.option('--user', default=None)
+@click.option('--password', default=None)
+@click.option("--pool-size", default=4, help="Maximum number of connections to the database")
+@click.option("--state-file", default=None, help="File where the last processed sequence is kept")
+@click.option("--interval", default=15.0, help="Seconds between the checks of the replication state")
+@click.option("--once/--forever", default=False, help="Stop when there are no new diffs")
+def stream(host, db, user, password, pool_size, state_file, interval, once):
+    """
+    Processes the diffs as they are published and pushes the matched changes to the webhooks
+
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param pool_size:
+    :param state_file:
+    :param interval:
+    :param once:
+    :return:
+    """
+    from configobj import ConfigObj
+    from osconf import config_from_environment
+    from changewithin.changewithin import DbCache
+    from changewithin.notify import stream as run_stream
+
+    conf = ConfigObj(config_from_environment('bard', ['config'])["config"])
+    cache = None
+    if host is not None and db is not None and user is not None and password is not None:
+        cache = DbCache(host, db, user, password, pool_size)
+    try:
+        run_stream(conf, cache, state_file, interval, once)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+@changeswithin.command()
+@click.option('--host', default=None)
+@click.option('--db', default=None)
+@click.option('--user', default=None)
+@click.option('--password', default=None)
+@click.option("--file", required=True)
+@click.option("--output", default="changewithin.prof", help="File where the raw profile is saved")
+@click.option("--top", default=20, help="Number of functions and allocations to report")
+def profile(host, db, user, password, file, output, top):
+    """
+    Processes a file under the profiler and reports where the time and the memory are spent
+
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param file:
+    :param output:
+    :param top:
+    :return:
+    """
+    from changewithin.changewithin import ChangeWithin
+    from changewithin.profiling import profile_file
+
+    c = ChangeWithin(host, db, user, password)
+    try:
+        c.load_config()
+        click.echo(profile_file(c, str(file), output, top))
+    finally:
+        c.close()
+
+
+@changeswithin.command()
+@click.option('--host', required=True)
+@click.option('--db', required=True)
+@click.option('--user', required=True)
+@click.option('--password', required=True)
+@click.option("--period", default="day", type=click.Choice(["day", "week", "month"]))
+@click.option("--from", "start", default=None, help="First day included, as YYYY-MM-DD")
+@click.option("--to", "end", default=None, help="Last day included, as YYYY-MM-DD")
+@click.option("--output", default=None, help="File where the rollup is written as JSON")
+def rollup(host, db, user, password, period, start, end, output):
+    """
+    Summarizes the changes stored by previous runs by day, week or month
+
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param period:
+    :param start:
+    :param end:
+    :param output:
+    :return:
+    """
+    from changewithin.changewithin import DbCache
+
+    cache = DbCache(host, db, user, password)
+    try:
+        rows = cache.get_rollup(period, start, end)
+    finally:
+        cache.close()
+    if output is not None:
+        import json
+
+        with open(output, "w") as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+    click.echo("{:<12} {:<20} {:<10} {:>8} {:>10} {:>6}".format(
+        period, "rule", "type", "changes", "changesets", "users"))
+    for row in rows:
+        click.echo("{period:<12} {rule:<20} {type:<10} {changes:>8} {changesets:>10} {users:>6}".format(**row))
+
+
+@changeswithin.command()
+@click.option('--host', default=None)
+@click.option('--db', default=None)
+@click.option('--user', default=None)
+@click.option('--password', default=None)
+@click.option("--from", "start", required=True, help="First day included, as YYYY-MM-DD")
+@click.option("--to", "end", required=True, help="Last day included, as YYYY-MM-DD")
+@click.option("--workers", default=None, type=int, help="Number of processes, the number of CPUs by default")
+@click.option("--output-dir", default=".", help="Directory where the reports are written")
+def backfill(host, db, user, password, start, end, workers, output_dir):
+    """
+    Matches the diffs of a range of days in parallel and writes a report for each day and a summary
+
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param start:
+    :param end:
+    :param workers:
+    :param output_dir:
+    :return:
+    """
+    from datetime import datetime
+    from changewithin.backfill import backfill as run_backfill
+    from changewithin.changewithin import ChangeWithin
+
+    c = ChangeWithin(host, db, user, password)
+    try:
+        c.load_config()
+        reports = run_backfill(c, datetime.strptime(start, "%Y-%m-%d").date(),
+                               datetime.strptime(end, "%Y-%m-%d").date(), workers, output_dir)
+    finally:
+        c.close()
+    for report in reports:
+        click.echo('Wrote {0}'.format(report))
+
+
+@changeswithin.command("merge-stats")
+@click.argument("files", nargs=-1, required=True)
+@click.option("--output", default=None, help="File where the merged sketches are written")
+def merge_stats(files, output):
+    """
+    Merges the approximate stats of several runs or days and prints their estimates
+
+    :param files:
+    :param output:
+    :return:
+    """
+    import io
+    from changewithin.sketch import ApproximateStats
+
+    merged = None
+    for path in files:
+        with io.open(path, encoding="utf-8") as f:
+            stats = ApproximateStats.loads(f.read())
+        if merged is None:
+            merged = stats
+        else:
+            merged.merge(stats)
+    if output is not None:
+        with io.open(output, "w", encoding="utf-8") as f:
+            f.write(u"{}".format(merged.dumps()))
+    summary = merged.summary()
+    click.echo("{:<20} {:>10} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+        "rule", "changesets", "users", "nodes", "ways", "rels", "matches"))
+    for name in sorted(summary["rules"]):
+        rule = summary["rules"][name]
+        click.echo("{:<20} {:>10} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+            name, rule["changesets"], rule["users"], rule["elements"]["node"], rule["elements"]["way"],
+            rule["elements"]["relation"], sum(rule["matches"].values())))
+    click.echo("changesets: {}, distinct counts within {:.2%} (one standard error)".format(
+        summary["changesets"], summary["distinct_error"]))
+    for user in summary["users"]:
+        click.echo("{:<20} {:>8}".format(user["user"], user["matches"]))
+    click.echo("user matches overestimated by at most {}".format(summary["matches_error"]))
+
 
-        
 def cli_generate_report():
     changeswithin()
\ No newline at end of file
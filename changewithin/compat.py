@@ -0,0 +1,10 @@
+from __future__ import absolute_import
+from array import array
+
+try:
+    array('q')
+    # Type code of the arrays of 64 bit integers, like the OSM ids
+    INT64 = 'q'
+except ValueError:
+    # Python 2 has no 'q', its 'l' is 64 bit on the 64 bit Unix builds
+    INT64 = 'l'
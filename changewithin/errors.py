@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+import time
+import traceback
+
+
+class ErrorRateExceeded(Exception):
+    """
+    Raised when the rate of failed elements is over the configured limit
+    """
+    pass
+
+
+class ErrorAggregator(object):
+    """
+    Groups the errors raised while processing the elements by type and
+    location and reports a summary to Sentry, instead of one event per
+    failed element
+    """
+
+    def __init__(self, max_error_rate=None, min_elements=1000, report_interval=None, samples=3):
+        """
+        Class constructor
+
+        :param max_error_rate: Ratio of failed elements that aborts the run, None to never abort
+        :type max_error_rate: float
+        :param min_elements: Elements to process before the error rate is checked
+        :type min_elements: int
+        :param report_interval: Seconds between partial reports, None to report only at the end
+        :type report_interval: float
+        :param samples: Number of groups sent with traceback on each report
+        :type samples: int
+        """
+        self.max_error_rate = max_error_rate
+        self.min_elements = min_elements
+        self.report_interval = report_interval
+        self.samples = samples
+        self.client = None
+        self.groups = {}
+        self.total = 0
+        self.failed = 0
+        self.last_report = time.time()
+
+    @property
+    def sentry_client(self):
+        """
+        Sentry client, created on the first report
+
+        :return: Client
+        """
+        if self.client is None:
+            from raven import Client
+
+            self.client = Client()
+        return self.client
+
+    def record(self, elem, exc_info, count=1):
+        """
+        Counts an error
+
+        :param elem: Type of element that failed
+        :type elem: str
+        :param exc_info: Exception info as returned by sys.exc_info
+        :type exc_info: tuple
+        :param count: Number of elements lost by the error, more than one when a batch fails
+        :type count: int
+        :return: None
+        """
+        exc_type, exc_value, exc_traceback = exc_info
+        frames = traceback.extract_tb(exc_traceback)
+        if frames:
+            filename, lineno, function = frames[-1][0], frames[-1][1], frames[-1][2]
+            location = "{}:{} in {}".format(filename, lineno, function)
+        else:
+            location = "unknown"
+        key = (exc_type.__name__, location, elem)
+        if key not in self.groups:
+            self.groups[key] = {
+                "count": 0,
+                "message": str(exc_value),
+                "traceback": "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+            }
+        self.groups[key]["count"] += count
+        self.total += count
+        self.failed += count
+        if self.report_interval is not None and time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def exceeded(self, elements):
+        """
+        Checks if the error rate is over the limit
+
+        :param elements: Elements handled so far, the failed ones included
+        :type elements: int
+        :return: True if the run must be aborted
+        :rtype: bool
+        """
+        if self.max_error_rate is None:
+            return False
+        if elements < max(self.min_elements, 1):
+            return False
+        return float(self.failed) / elements > self.max_error_rate
+
+    def summary(self):
+        """
+        Returns the groups of errors sorted by occurrences
+
+        :return: List of dicts with type, location, element, count, message and traceback
+        :rtype: list
+        """
+        ret = []
+        for (exc_type, location, elem), group in self.groups.items():
+            ret.append({
+                "type": exc_type,
+                "location": location,
+                "element": elem,
+                "count": group["count"],
+                "message": group["message"],
+                "traceback": group["traceback"]
+            })
+        ret.sort(key=lambda x: x["count"], reverse=True)
+        return ret
+
+    def report(self):
+        """
+        Sends the summary of the errors to Sentry and starts a new period
+
+        :return: None
+        """
+        self.last_report = time.time()
+        if not self.groups:
+            return
+        summary = self.summary()
+        message = "{} failed elements in {} groups while processing the changes".format(self.total, len(summary))
+        extra = {
+            "groups": [
+                "{count} x {type} ({element}) at {location}: {message}".format(**group) for group in summary
+            ]
+        }
+        for indx, group in enumerate(summary[:self.samples]):
+            extra["traceback_{}".format(indx)] = group["traceback"]
+        self.sentry_client.captureMessage(message, extra=extra)
+        self.groups = {}
+        self.total = 0
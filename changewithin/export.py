@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+import csv
+import io
+import json
+import sys
+
+
+FIELDS = ["changeset", "user", "uid", "type", "id", "version", "rule", "lat", "lon", "timestamp"]
+
+
+class ChangeExporter(object):
+    """
+    Base class of the file exporters, writes each matched change as soon as
+    it is found so the output can be read while the file is processed.
+
+    The handler only needs write(change), called with a dict with the keys
+    of FIELDS for each matched change, and close(), called once at the end
+    of the file. Each subclass implements write for its format, the
+    ResultWriter and the ChangeList follow the same interface without a
+    file.
+    """
+
+    def __init__(self, path):
+        """
+        Class constructor
+
+        :param path: Path of the output file, - for stdout
+        :type path: str
+        """
+        self.path = path
+        self.output = self.open(path)
+        self.count = 0
+        self.start()
+
+    def open(self, path):
+        """
+        Opens the output as text
+
+        :param path: Path of the output file, - for stdout
+        :type path: str
+        :return: File
+        """
+        if path == "-":
+            return sys.stdout
+        return io.open(path, "w", encoding="utf-8", newline="", buffering=1)
+
+    def start(self):
+        """
+        Writes the header of the output
+
+        :return: None
+        """
+        pass
+
+    def close(self):
+        """
+        Flushes and closes the output
+
+        :return: None
+        """
+        self.output.flush()
+        if self.output is not sys.stdout:
+            self.output.close()
+
+
+class JsonLinesExporter(ChangeExporter):
+    """
+    Writes the changes as JSON Lines, one object per line
+    """
+
+    def write(self, change):
+        self.output.write(u"{}\n".format(json.dumps(change, sort_keys=True)))
+        self.count += 1
+
+
+class CsvExporter(ChangeExporter):
+    """
+    Writes the changes as CSV with a header row
+    """
+
+    def open(self, path):
+        if sys.version_info[0] > 2:
+            return super(CsvExporter, self).open(path)
+        # The csv module of Python 2 writes str, the values are encoded
+        if path == "-":
+            return sys.stdout
+        return open(path, "wb")
+
+    def start(self):
+        self.writer = csv.DictWriter(self.output, fieldnames=FIELDS, lineterminator="\n")
+        self.writer.writeheader()
+
+    def write(self, change):
+        if sys.version_info[0] == 2:
+            change = dict((key, value.encode("utf-8") if isinstance(value, type(u"")) else value)
+                          for key, value in change.items())
+        self.writer.writerow(change)
+        self.count += 1
+
+
+class GeoJsonSeqExporter(ChangeExporter):
+    """
+    Writes the changes as a GeoJSON text sequence (RFC 8142), one feature
+    per record
+    """
+
+    def write(self, change):
+        if change.get("lat") is None or change.get("lon") is None:
+            geometry = None
+        else:
+            geometry = {"type": "Point", "coordinates": [change["lon"], change["lat"]]}
+        properties = dict((key, value) for key, value in change.items() if key not in ("lat", "lon"))
+        feature = {"type": "Feature", "geometry": geometry, "properties": properties}
+        self.output.write(u"\x1e{}\n".format(json.dumps(feature, sort_keys=True)))
+        self.count += 1
+
+
+class ResultWriter(object):
+    """
+    Stores the changes in the results table of the cache, in batches, so
+    the rollup reports don't need to reprocess the files
+    """
+
+    def __init__(self, cache, source=None, batch_size=1000):
+        """
+        Class constructor
+
+        :param cache: Cache of the handler
+        :type cache: DbCache
+        :param source: Name of the processed file or state url
+        :type source: str
+        :param batch_size: Number of changes inserted at once
+        :type batch_size: int
+        """
+        self.cache = cache
+        self.batch_size = batch_size
+        self.run_id = cache.start_run(source)
+        self.pending = []
+        self.count = 0
+
+    def write(self, change):
+        """
+        Queues a matched change, the queue is stored when it is full
+
+        :param change: Change with the keys of FIELDS
+        :type change: dict
+        :return: None
+        """
+        self.pending.append(change)
+        self.count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Stores the queued changes
+
+        :return: None
+        """
+        if self.pending:
+            self.cache.add_results(self.run_id, self.pending)
+            self.pending = []
+
+    def close(self):
+        """
+        Stores the queued changes and commits them
+
+        :return: None
+        """
+        self.flush()
+        self.cache.commit()
+
+
+class ChangeList(object):
+    """
+    Keeps the changes in memory, to store them later from another process
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.changes = []
+        self.count = 0
+
+    def write(self, change):
+        """
+        Keeps a matched change
+
+        :param change: Change with the keys of FIELDS
+        :type change: dict
+        :return: None
+        """
+        self.changes.append(change)
+        self.count += 1
+
+    def close(self):
+        """
+        Nothing to close, the changes are kept
+
+        :return: None
+        """
+        pass
+
+
+EXPORTERS = {
+    "jsonl": JsonLinesExporter,
+    "csv": CsvExporter,
+    "geojsonseq": GeoJsonSeqExporter
+}
+
+
+def get_exporter(export_format, path):
+    """
+    Returns the exporter of the format
+
+    :param export_format: Format, one of jsonl, csv or geojsonseq
+    :type export_format: str
+    :param path: Path of the output file, - for stdout
+    :type path: str
+    :return: Exporter
+    :rtype: ChangeExporter
+    """
+    if export_format not in EXPORTERS:
+        raise ValueError("Unknown export format {}, expected one of {}".format(
+            export_format, ", ".join(sorted(EXPORTERS))))
+    return EXPORTERS[export_format](path)
@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+import os
+
+
+class ChangeExtract(object):
+    """
+    Collects the objects of the diff inside the area and writes them as a
+    clipped change file. The handler decides which objects are inside while
+    it processes the diff, the file is then copied with the native filters
+    of osmium, without Python callbacks.
+    """
+
+    def __init__(self, path):
+        """
+        Class constructor
+
+        :param path: Path of the output, .osc or .osc.gz
+        :type path: str
+        """
+        self.path = path
+        self.nodes = set()
+        self.ways = set()
+        self.relations = set()
+        self.count = 0
+
+    def add_node(self, identifier):
+        """
+        Adds a node inside the area
+
+        :param identifier: Node id
+        :type identifier: int
+        :return: None
+        """
+        self.nodes.add(identifier)
+
+    def add_way(self, identifier, refs):
+        """
+        Adds a way inside the area with its nodes, so the extract has the
+        locations needed to build its geometry
+
+        :param identifier: Way id
+        :type identifier: int
+        :param refs: Node ids of the way
+        :type refs: list
+        :return: None
+        """
+        self.ways.add(identifier)
+        self.nodes.update(refs)
+
+    def add_relation(self, identifier):
+        """
+        Adds a relation inside the area
+
+        :param identifier: Relation id
+        :type identifier: int
+        :return: None
+        """
+        self.relations.add(identifier)
+
+    def write(self, source):
+        """
+        Copies the collected objects of the diff to the output
+
+        :param source: Path of the processed diff
+        :type source: str
+        :return: Number of objects collected
+        :rtype: int
+        """
+        import osmium
+        from osmium.filter import IdFilter
+        from osmium.io import Reader
+        from osmium.osm import osm_entity_bits
+
+        filters = []
+        for ids, entity in ((self.nodes, osm_entity_bits.NODE), (self.ways, osm_entity_bits.WAY),
+                            (self.relations, osm_entity_bits.RELATION)):
+            id_filter = IdFilter(ids)
+            id_filter.enable_for(entity)
+            filters.append(id_filter)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        writer = osmium.SimpleWriter(self.path)
+        try:
+            with Reader(source) as reader:
+                osmium.apply(reader, *(filters + [writer]))
+        finally:
+            writer.close()
+        self.count = len(self.nodes) + len(self.ways) + len(self.relations)
+        return self.count
@@ -0,0 +1,306 @@
+from __future__ import absolute_import
+import gzip
+import hashlib
+import json
+import os
+import sys
+import zlib
+from tempfile import mkstemp
+
+
+REPLICATION_URL = "http://planet.openstreetmap.org/replication/day"
+
+
+def sequence_path(sequence):
+    """
+    Returns the path of a replication sequence, as used on the server
+
+    :param sequence: Sequence number
+    :type sequence: str
+    :return: Path like 000/001/234
+    :rtype: str
+    """
+    # zero-pad state so it can be safely split.
+    state = '000000000' + str(sequence)
+    return '{0}/{1}/{2}'.format(state[-9:-6], state[-6:-3], state[-3:])
+
+
+def parse_state(text):
+    """
+    Returns the sequence number of a state.txt
+
+    :param text: Content of the state file
+    :type text: str
+    :return: Sequence number
+    :rtype: str
+    """
+    for line in text.splitlines():
+        if line.startswith("sequenceNumber="):
+            return line.split("=", 1)[1].strip()
+    raise ValueError("state.txt without sequenceNumber")
+
+
+class ReplicationMirror(object):
+    """
+    Local copy of the replication files. The state is revalidated with
+    conditional requests and the diffs, that never change once published,
+    are only downloaded once and served from disk on the next runs
+    """
+
+    def __init__(self, path, url=REPLICATION_URL, max_size=None, timeout=60.0):
+        """
+        Class constructor
+
+        :param path: Directory of the mirror
+        :type path: str
+        :param url: Base url of the replication files
+        :type url: str
+        :param max_size: Maximum bytes of diffs kept, None for no limit
+        :type max_size: int
+        :param timeout: Seconds to wait for the server on each request
+        :type timeout: float
+        """
+        self.path = path
+        self.url = url.rstrip("/")
+        self.max_size = max_size
+        self.timeout = timeout
+        self.session = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_session(self):
+        """
+        HTTP session, created on the first request
+
+        :return: Session
+        """
+        if self.session is None:
+            import requests
+
+            self.session = requests.Session()
+        return self.session
+
+    def read_meta(self, filename):
+        """
+        Returns the metadata stored with a file of the mirror
+
+        :param filename: Path of the file
+        :type filename: str
+        :return: dict with etag, last_modified, size and sha256, empty if unknown
+        :rtype: dict
+        """
+        try:
+            with open(filename + ".json") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_meta(self, filename, meta):
+        """
+        Stores the metadata of a file of the mirror
+
+        :param filename: Path of the file
+        :type filename: str
+        :param meta: Metadata
+        :type meta: dict
+        :return: None
+        """
+        with open(filename + ".json", "w") as f:
+            json.dump(meta, f, sort_keys=True)
+
+    def is_valid(self, filename, meta=None):
+        """
+        Checks a stored file against the size and hash of its metadata
+
+        :param filename: Path of the file
+        :type filename: str
+        :param meta: Metadata of the file, read from disk if not specified
+        :type meta: dict
+        :return: True if the file is complete
+        :rtype: bool
+        """
+        if meta is None:
+            meta = self.read_meta(filename)
+        if not meta or not os.path.exists(filename):
+            return False
+        if os.path.getsize(filename) != meta.get("size"):
+            return False
+        return file_sha256(filename) == meta.get("sha256")
+
+    def fetch(self, url, filename, check=None):
+        """
+        Downloads a file into the mirror, sending the validators of the
+        stored copy so an unchanged file is not downloaded again
+
+        :param url: Url of the file
+        :type url: str
+        :param filename: Path of the file on the mirror
+        :type filename: str
+        :param check: Function that raises ValueError if the downloaded file is not valid
+        :return: True if the file was downloaded, False if the stored copy is still valid
+        :rtype: bool
+        """
+        meta = self.read_meta(filename)
+        headers = {}
+        if self.is_valid(filename, meta):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        resp = self.get_session().get(url, headers=headers, stream=True, timeout=self.timeout)
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, tmp = mkstemp(dir=directory, prefix=".download-")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(handle, "wb") as f:
+                for chunk in resp.iter_content(65536):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            expected = resp.headers.get("Content-Length")
+            if expected is not None and resp.headers.get("Content-Encoding") is None and int(expected) != size:
+                raise ValueError("Truncated download of {}: {} of {} bytes".format(url, size, expected))
+            if check is not None:
+                check(tmp)
+            os.rename(tmp, filename)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.write_meta(filename, {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "size": size,
+            "sha256": digest.hexdigest()
+        })
+        return True
+
+    def state(self):
+        """
+        Returns the last sequence number of the replication. The state is
+        revalidated on each call, the stored copy is used if the server
+        can't be reached
+
+        :return: Sequence number
+        :rtype: str
+        """
+        filename = os.path.join(self.path, "state.txt")
+        try:
+            self.fetch("{}/state.txt".format(self.url), filename, check=check_state)
+        except Exception:
+            if not self.is_valid(filename):
+                raise
+            sys.stderr.write('using the stored state, the server failed: {}\n'.format(sys.exc_info()[1]))
+        with open(filename) as f:
+            return parse_state(f.read())
+
+    def diff(self, sequence):
+        """
+        Returns the path of the diff of a sequence, downloading it only if
+        the mirror has no complete copy
+
+        :param sequence: Sequence number
+        :type sequence: str
+        :return: Path of the osc.gz file
+        :rtype: str
+        """
+        path = sequence_path(sequence)
+        filename = os.path.join(self.path, *path.split("/")) + ".osc.gz"
+        if self.is_valid(filename):
+            return filename
+        url = "{}/{}.osc.gz".format(self.url, path)
+        sys.stderr.write('downloading {0}...\n'.format(url))
+        self.fetch(url, filename, check=check_gzip)
+        self.prune(keep=filename)
+        return filename
+
+    def diffs(self):
+        """
+        Returns the diffs stored on the mirror, oldest sequence first
+
+        :return: List of paths
+        :rtype: list
+        """
+        ret = []
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".osc.gz"):
+                    ret.append(os.path.join(root, name))
+        ret.sort(key=lambda x: os.path.relpath(x, self.path))
+        return ret
+
+    def prune(self, keep=None):
+        """
+        Removes the oldest diffs while the mirror is over its size budget
+
+        :param keep: Path that is never removed
+        :type keep: str
+        :return: Paths removed
+        :rtype: list
+        """
+        if self.max_size is None:
+            return []
+        diffs = self.diffs()
+        total = sum(os.path.getsize(diff) for diff in diffs)
+        removed = []
+        for diff in diffs:
+            if total <= self.max_size:
+                break
+            if diff == keep:
+                continue
+            total -= os.path.getsize(diff)
+            os.unlink(diff)
+            if os.path.exists(diff + ".json"):
+                os.unlink(diff + ".json")
+            removed.append(diff)
+        return removed
+
+
+def file_sha256(filename):
+    """
+    Returns the SHA-256 of a file
+
+    :param filename: Path of the file
+    :type filename: str
+    :return: Hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_gzip(filename):
+    """
+    Checks a gzip file can be read to the end
+
+    :param filename: Path of the file
+    :type filename: str
+    :return: None
+    """
+    try:
+        with gzip.open(filename, "rb") as f:
+            while f.read(1 << 20):
+                pass
+    except (IOError, OSError, EOFError, zlib.error) as e:
+        raise ValueError("Corrupt diff {}: {}".format(filename, e))
+
+
+def check_state(filename):
+    """
+    Checks a state file has a sequence number
+
+    :param filename: Path of the file
+    :type filename: str
+    :return: None
+    """
+    with open(filename) as f:
+        parse_state(f.read())
@@ -0,0 +1,369 @@
+from __future__ import absolute_import
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+
+class WebhookEndpoint(object):
+    """
+    Sends the matched changes to a webhook from a background thread. The
+    changes are queued without blocking the processing of the diff and sent
+    in batches, a batch waits at most the window since its first change.
+    When the receiver is slow the queue fills up and the new changes are
+    dropped instead of stalling the diff.
+    """
+
+    def __init__(self, url, window=2.0, batch_size=100, queue_size=10000, retries=3, backoff=1.0, timeout=10.0):
+        """
+        Class constructor
+
+        :param url: Url of the webhook, the changes are sent as a JSON POST
+        :type url: str
+        :param window: Seconds a change waits for others to be sent together
+        :type window: float
+        :param batch_size: Maximum number of changes of a request
+        :type batch_size: int
+        :param queue_size: Maximum number of changes waiting to be sent
+        :type queue_size: int
+        :param retries: Number of times a failed request is repeated
+        :type retries: int
+        :param backoff: Seconds before the first retry, doubled on each one
+        :type backoff: float
+        :param timeout: Seconds to wait for the receiver on each request
+        :type timeout: float
+        """
+        self.url = url
+        self.window = window
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.queue = Queue(queue_size)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.requests = 0
+
+    def put(self, change):
+        """
+        Queues a change, never blocks
+
+        :param change: Change with the keys of changewithin.export.FIELDS
+        :type change: dict
+        :return: True if the change was queued, False if it was dropped
+        :rtype: bool
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="webhook {}".format(self.url))
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            self.queue.put_nowait(change)
+        except Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    def next_batch(self):
+        """
+        Waits for the changes of the next batch
+
+        :return: List of changes, empty if there is nothing to send
+        :rtype: list
+        """
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except Empty:
+            return []
+        deadline = time.time() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0 or self.stopping.is_set():
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Sends the batches until the endpoint is closed and the queue is empty
+
+        :return: None
+        """
+        import requests
+
+        session = requests.Session()
+        while True:
+            batch = self.next_batch()
+            if batch:
+                self.send(session, batch)
+            elif self.stopping.is_set():
+                break
+
+    def send(self, session, batch):
+        """
+        Posts a batch, retrying the connection errors, the server errors and
+        the throttled requests
+
+        :param session: HTTP session
+        :param batch: Changes to send
+        :type batch: list
+        :return: True if the receiver accepted the batch
+        :rtype: bool
+        """
+        import requests
+
+        body = json.dumps({"changes": batch}, sort_keys=True)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.requests += 1
+            try:
+                resp = session.post(self.url, data=body, headers={"Content-Type": "application/json"},
+                                    timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if resp.status_code < 300:
+                self.sent += len(batch)
+                return True
+            error = "HTTP {}".format(resp.status_code)
+            if resp.status_code < 500 and resp.status_code != 429:
+                break
+        self.failed += len(batch)
+        sys.stderr.write('webhook {} failed, {} changes lost: {}\n'.format(self.url, len(batch), error))
+        return False
+
+    def close(self, timeout=30.0):
+        """
+        Sends the queued changes and stops the thread
+
+        :param timeout: Seconds to wait for the queue to be sent
+        :type timeout: float
+        :return: None
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                pending = self.queue.qsize()
+                self.dropped += pending
+                sys.stderr.write('webhook {} not drained, {} changes lost\n'.format(self.url, pending))
+
+
+class WebhookNotifier(object):
+    """
+    Pushes each matched change to the configured webhooks as soon as it is
+    found. It lives longer than a diff, so the changes of consecutive diffs
+    share the queues and the connections.
+    """
+
+    def __init__(self, urls, drain=30.0, **options):
+        """
+        Class constructor
+
+        :param urls: Urls of the webhooks
+        :type urls: list
+        :param drain: Seconds to wait for the queues when the notifier is closed
+        :type drain: float
+        :param options: Options of each WebhookEndpoint
+        """
+        self.drain = drain
+        self.endpoints = [WebhookEndpoint(url, **options) for url in urls]
+
+    def write(self, change):
+        """
+        Queues a change on every endpoint
+
+        :param change: Change with the keys of changewithin.export.FIELDS
+        :type change: dict
+        :return: None
+        """
+        for endpoint in self.endpoints:
+            endpoint.put(change)
+
+    def close(self):
+        """
+        Sends the queued changes and reports the result of each endpoint
+
+        :return: None
+        """
+        deadline = time.time() + self.drain
+        for endpoint in self.endpoints:
+            endpoint.close(max(0.0, deadline - time.time()))
+            sys.stderr.write('webhook {}: {} sent, {} failed, {} dropped in {} requests\n'.format(
+                endpoint.url, endpoint.sent, endpoint.failed, endpoint.dropped, endpoint.requests))
+
+
+def webhook_notifier(conf):
+    """
+    Builds the notifier of the webhooks section of the configuration
+
+    :param conf: Configuration
+    :type conf: dict
+    :return: Notifier or None if there are no webhooks
+    :rtype: WebhookNotifier
+    """
+    if "webhooks" not in conf or not conf["webhooks"].get("urls"):
+        return None
+    webhooks = conf["webhooks"]
+    options = {}
+    for key, kind in (("window", float), ("batch_size", int), ("queue_size", int), ("retries", int),
+                      ("backoff", float), ("timeout", float)):
+        if key in webhooks:
+            options[key] = kind(webhooks[key])
+    return WebhookNotifier(webhooks["urls"].split(), float(webhooks.get("drain", 30)), **options)
+
+
+def read_sequence(filename):
+    """
+    Returns the last sequence processed by the stream
+
+    :param filename: Path of the state of the stream
+    :type filename: str
+    :return: Sequence number or None if the stream never ran
+    :rtype: int
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return int(f.read().strip())
+
+
+def write_sequence(filename, sequence):
+    """
+    Stores the last sequence processed by the stream
+
+    :param filename: Path of the state of the stream
+    :type filename: str
+    :param sequence: Sequence number
+    :type sequence: int
+    :return: None
+    """
+    if filename is None:
+        return
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("{}\n".format(sequence))
+    os.rename(tmp, filename)
+
+
+def process_sequences(changewithin, instance, sequence, latest, state_file):
+    """
+    Processes the pending diffs of the stream. The next diffs are downloaded
+    while the current one is matched, up to the prefetch of the pipeline
+    configuration.
+
+    :param changewithin: Instance with the configuration of the stream
+    :type changewithin: changewithin.changewithin.ChangeWithin
+    :param instance: Returns a new instance for each diff
+    :type instance: callable
+    :param sequence: Last processed sequence
+    :type sequence: int
+    :param latest: Last published sequence
+    :type latest: int
+    :param state_file: Path where the last processed sequence is kept
+    :type state_file: str
+    :return: Last processed sequence
+    :rtype: int
+    """
+    from changewithin.changewithin import get_osc
+    from changewithin.pipeline import Prefetch
+
+    mirror = changewithin.mirror
+    url = changewithin.replication_url
+    temporary = mirror is None
+    fetch = Prefetch(lambda number: get_osc(mirror=mirror, url=url, sequence=number),
+                     range(sequence + 1, latest + 1), max(changewithin.prefetch, 1),
+                     discard=os.unlink if temporary else None)
+    try:
+        for number, filename, exc_info in fetch:
+            if exc_info is not None:
+                # Retried on the next check
+                sys.stderr.write('sequence {} failed: {}\n'.format(number, exc_info[1]))
+                break
+            try:
+                try:
+                    instance().process_file(filename)
+                finally:
+                    if temporary:
+                        os.unlink(filename)
+            except Exception:
+                sys.stderr.write('sequence {} failed: {}\n'.format(number, sys.exc_info()[1]))
+                break
+            sequence = number
+            write_sequence(state_file, sequence)
+    finally:
+        fetch.close()
+    return sequence
+
+
+def stream(conf, cache=None, state_file=None, interval=15.0, once=False):
+    """
+    Processes the diffs of the replication as they are published and pushes
+    the matched changes to the webhooks. Meant for the minutely diffs, each
+    diff is matched by a new instance that shares the cache and the
+    notifier.
+
+    :param conf: Configuration
+    :type conf: dict
+    :param cache: Cache shared by the diffs, None to run without cache
+    :type cache: changewithin.changewithin.DbCache
+    :param state_file: Path where the last processed sequence is kept, without it the stream starts at the last one
+    :type state_file: str
+    :param interval: Seconds between the checks of the replication state
+    :type interval: float
+    :param once: True to stop when there are no new diffs
+    :type once: bool
+    :return: Last processed sequence
+    :rtype: int
+    """
+    from changewithin.changewithin import ChangeWithin, get_state
+
+    notifier = webhook_notifier(conf)
+
+    def instance():
+        changewithin = ChangeWithin()
+        changewithin.notifier = notifier
+        changewithin.handler.notifier = notifier
+        if cache is not None:
+            changewithin.handler.set_cache(None, None, None, None, cache=cache)
+            changewithin.has_cache = True
+        changewithin.load_config(conf)
+        changewithin.handler.keep_changesets = False
+        return changewithin
+
+    sequence = read_sequence(state_file)
+    try:
+        while True:
+            changewithin = instance()
+            try:
+                latest = int(get_state(changewithin.mirror, changewithin.replication_url))
+            except Exception:
+                sys.stderr.write('replication state failed: {}\n'.format(sys.exc_info()[1]))
+                latest = sequence
+            if sequence is None and latest is not None:
+                sequence = latest - 1
+            if latest is not None and sequence < latest:
+                sequence = process_sequences(changewithin, instance, sequence, latest, state_file)
+            if once:
+                return sequence
+            time.sleep(interval)
+    finally:
+        if notifier is not None:
+            notifier.close()
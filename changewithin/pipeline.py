@@ -0,0 +1,384 @@
+from __future__ import absolute_import
+import sys
+import threading
+import time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+
+class StageStats(object):
+    """
+    Counters of a stage of the pipeline, to tune the workers and the queue
+    sizes. The depth of the input queue is sampled on each put, a stage
+    whose queue is often full is the bottleneck and makes the previous
+    stage wait.
+    """
+
+    def __init__(self, name, workers=1, queue_size=0):
+        """
+        Class constructor
+
+        :param name: Name of the stage
+        :type name: str
+        :param workers: Number of threads of the stage
+        :type workers: int
+        :param queue_size: Maximum size of the input queue, 0 if the stage has no queue
+        :type queue_size: int
+        """
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+        self.started = time.time()
+        self.finished = None
+
+    def queued(self, depth, blocked=0.0):
+        """
+        Records an item put on the input queue
+
+        :param depth: Items waiting on the queue
+        :type depth: int
+        :param blocked: Seconds the producer waited for room on the queue
+        :type blocked: float
+        :return: None
+        """
+        self.depth_total += depth
+        self.depth_samples += 1
+        self.depth_max = max(self.depth_max, depth)
+        self.blocked += blocked
+
+    def done(self, busy, items=1):
+        """
+        Records processed items, safe to call from the workers
+
+        :param busy: Seconds spent processing them
+        :type busy: float
+        :param items: Number of items
+        :type items: int
+        :return: None
+        """
+        with self.lock:
+            self.items += items
+            self.busy += busy
+
+    def finish(self):
+        """
+        Marks the end of the stage
+
+        :return: None
+        """
+        self.finished = time.time()
+
+    def summary(self):
+        """
+        Returns the counters of the stage
+
+        :return: dict with the name, the workers, the items, the elapsed and busy seconds, the throughput, the
+            maximum and mean depth of the queue and the seconds the previous stage was blocked on it
+        :rtype: dict
+        """
+        elapsed = (self.finished or time.time()) - self.started
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "elapsed": elapsed,
+            "busy": self.busy,
+            "throughput": self.items / elapsed if elapsed > 0 else 0.0,
+            "queue_size": self.queue_size,
+            "depth_max": self.depth_max,
+            "depth_mean": float(self.depth_total) / self.depth_samples if self.depth_samples else 0.0,
+            "blocked": self.blocked
+        }
+
+
+def write_stats(stats, out=None):
+    """
+    Writes a table with the counters of the stages
+
+    :param stats: Summaries of the stages
+    :type stats: list
+    :param out: File to write, stderr by default
+    :return: None
+    """
+    out = out or sys.stderr
+    out.write('{:<10} {:>7} {:>9} {:>9} {:>9} {:>10} {:>11} {:>10}\n'.format(
+        "stage", "workers", "items", "busy s", "items/s", "queue", "depth max", "blocked s"))
+    for stage in stats:
+        out.write('{:<10} {:>7} {:>9} {:>9.2f} {:>9.1f} {:>10} {:>11} {:>10.2f}\n'.format(
+            stage["stage"], stage["workers"], stage["items"], stage["busy"], stage["throughput"],
+            "{:.1f}/{}".format(stage["depth_mean"], stage["queue_size"]) if stage["queue_size"] else "-",
+            stage["depth_max"], stage["blocked"]))
+
+
+class LookupPool(object):
+    """
+    Runs blocking lookups on worker threads fed by a bounded queue. The
+    producer submits without waiting for the result and collects the
+    finished ones when it wants, so the results are always handled on its
+    own thread. When the workers fall behind the queue fills up and the
+    producer waits, collecting results meanwhile.
+    """
+
+    def __init__(self, function, workers=4, queue_size=1000, name="lookup", initializer=None, finalizer=None):
+        """
+        Class constructor
+
+        :param function: Called on the workers with the arguments of each task
+        :type function: callable
+        :param workers: Number of threads
+        :type workers: int
+        :param queue_size: Maximum number of tasks waiting for a worker
+        :type queue_size: int
+        :param name: Name of the stage
+        :type name: str
+        :param initializer: Called on each worker when it starts
+        :type initializer: callable
+        :param finalizer: Called on each worker when it stops
+        :type finalizer: callable
+        """
+        self.function = function
+        self.tasks = Queue(queue_size)
+        self.results = Queue()
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.stats = StageStats(name, workers, queue_size)
+        self.handled = StageStats("aggregate")
+        self.pending = 0
+        self.stopping = threading.Event()
+        self.threads = []
+        for indx in range(workers):
+            thread = threading.Thread(target=self.run, name="{} {}".format(name, indx))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        """
+        Processes tasks until the sentinel
+
+        :return: None
+        """
+        if self.initializer is not None:
+            self.initializer()
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                if self.stopping.is_set():
+                    # Discarded, the pool is closing after a failure
+                    continue
+                arguments, handler = task
+                start = time.time()
+                try:
+                    self.results.put((handler, self.function(*arguments), None))
+                except Exception:
+                    self.results.put((handler, None, sys.exc_info()))
+                self.stats.done(time.time() - start)
+        finally:
+            if self.finalizer is not None:
+                self.finalizer()
+
+    def submit(self, arguments, handler):
+        """
+        Queues a task, waits while the queue is full
+
+        :param arguments: Arguments of the function
+        :type arguments: tuple
+        :param handler: Called on the producer thread with the result and the exception info, None if it succeeded
+        :type handler: callable
+        :return: None
+        """
+        blocked = 0.0
+        while True:
+            try:
+                self.tasks.put_nowait((arguments, handler))
+                break
+            except Full:
+                start = time.time()
+                # The finished checks are handled while waiting
+                if not self.collect():
+                    try:
+                        self.tasks.put((arguments, handler), timeout=0.05)
+                        blocked += time.time() - start
+                        break
+                    except Full:
+                        pass
+                blocked += time.time() - start
+        self.pending += 1
+        self.stats.queued(self.tasks.qsize(), blocked)
+
+    def collect(self):
+        """
+        Handles the finished tasks without waiting
+
+        :return: Number of handled results
+        :rtype: int
+        """
+        handled = 0
+        while True:
+            try:
+                handler, result, exc_info = self.results.get_nowait()
+            except Empty:
+                return handled
+            self.handle(handler, result, exc_info)
+            handled += 1
+
+    def handle(self, handler, result, exc_info):
+        """
+        Handles the result of a task on the producer thread
+
+        :param handler: Handler of the task
+        :type handler: callable
+        :param result: Result of the function
+        :param exc_info: Exception info, None if the function succeeded
+        :type exc_info: tuple
+        :return: None
+        """
+        self.pending -= 1
+        start = time.time()
+        try:
+            handler(result, exc_info)
+        finally:
+            self.handled.done(time.time() - start)
+
+    def close(self, discard=False):
+        """
+        Waits for the queued tasks, handles their results and stops the
+        workers. The workers are always stopped and joined before it
+        returns, also when a handler raises, so nothing runs on them
+        afterwards.
+
+        :param discard: True to drop the queued tasks and their results, when closing after a failure
+        :type discard: bool
+        :return: None
+        """
+        try:
+            if discard:
+                self.stopping.set()
+            while self.pending and not discard:
+                try:
+                    handler, result, exc_info = self.results.get(timeout=0.1)
+                except Empty:
+                    continue
+                self.handle(handler, result, exc_info)
+        except BaseException:
+            self.stopping.set()
+            raise
+        finally:
+            for thread in self.threads:
+                self.tasks.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.stats.finish()
+            self.handled.finish()
+
+
+class Prefetch(object):
+    """
+    Produces the results of a function over some items on a background
+    thread, at most size results ahead of the consumer, and yields them in
+    order
+    """
+
+    def __init__(self, function, items, size=2, name="fetch", discard=None):
+        """
+        Class constructor
+
+        :param function: Called with each item
+        :type function: callable
+        :param items: Items, in order
+        :type items: list
+        :param size: Maximum number of results waiting for the consumer
+        :type size: int
+        :param name: Name of the stage
+        :type name: str
+        :param discard: Called with the results not consumed when the prefetch is closed
+        :type discard: callable
+        """
+        self.function = function
+        self.items = list(items)
+        self.queue = Queue(size)
+        self.discard = discard
+        self.stopping = threading.Event()
+        self.stats = StageStats(name, 1, size)
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Produces the results until the end of the items or the close
+
+        :return: None
+        """
+        for item in self.items:
+            if self.stopping.is_set():
+                break
+            start = time.time()
+            try:
+                entry = (item, self.function(item), None)
+            except Exception:
+                entry = (item, None, sys.exc_info())
+            self.stats.done(time.time() - start)
+            waiting = time.time()
+            while True:
+                try:
+                    self.queue.put(entry, timeout=0.1)
+                    break
+                except Full:
+                    if self.stopping.is_set():
+                        self.drop(entry)
+                        return
+            self.stats.queued(self.queue.qsize(), time.time() - waiting)
+            if entry[2] is not None:
+                # The consumer stops on the first failure
+                break
+
+    def __iter__(self):
+        """
+        Yields tuples with the item, the result and the exception info, None if it succeeded
+
+        :return: Generator
+        """
+        for indx in range(len(self.items)):
+            entry = self.queue.get()
+            yield entry
+            if entry[2] is not None:
+                return
+
+    def drop(self, entry):
+        """
+        Discards a result not consumed
+
+        :param entry: Tuple with the item, the result and the exception info
+        :type entry: tuple
+        :return: None
+        """
+        if self.discard is not None and entry[2] is None:
+            self.discard(entry[1])
+
+    def close(self):
+        """
+        Stops producing and discards the results not consumed
+
+        :return: None
+        """
+        self.stopping.set()
+        while self.thread.is_alive() or not self.queue.empty():
+            try:
+                self.drop(self.queue.get(timeout=0.1))
+            except Empty:
+                pass
+        self.thread.join()
+        self.stats.finish()
@@ -0,0 +1,280 @@
+from __future__ import absolute_import
+import sys
+import threading
+import time
+from array import array
+
+from changewithin.compat import INT64
+
+
+class AreaPreload(object):
+    """
+    Last versions of the cached nodes and ways of the area kept in memory,
+    so the lookups of the run don't need a query each. The nodes are kept
+    in sorted columns, only the tagged ones have a dict. The elements
+    written during the run are kept apart until the next load. The lookup
+    workers read the nodes while the handler writes them, the nodes
+    written are guarded by a lock.
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.node_ids = None
+        self.node_versions = None
+        self.node_lats = None
+        self.node_lons = None
+        self.node_tags = {}
+        self.ways = {}
+        self.updated_nodes = {}
+        self.lock = threading.Lock()
+        self.load_time = 0
+        self.size = 0
+
+    def load(self, con, envelope, itersize=10000, tags=None):
+        """
+        Streams the last versions of the area from the cache with server
+        side cursors, the rows are never all in memory at once
+
+        :param con: Connection to the cache
+        :param envelope: Parameters of ST_MakeEnvelope as returned by DbCache.area_envelope
+        :type envelope: tuple
+        :param itersize: Rows fetched on each round trip
+        :type itersize: int
+        :param tags: Dictionary of the tags stored as ids
+        :type tags: changewithin.tagdict.TagDictionary
+        :return: None
+        """
+        import numpy
+        from changewithin.wkb import decode_linestring
+
+        start = time.time()
+        nodes_sql = """
+        SELECT n.id, n.version, st_y(n.geom), st_x(n.geom), n.tag, n.tag_ids
+        FROM cache_node n
+        WHERE n.geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+        AND n.version = (SELECT max(version) FROM cache_node WHERE id = n.id)
+        ORDER BY n.id;
+        """
+        ways_sql = """
+        SELECT w.id, w.version, st_asbinary(w.geom), w.tag, w.tag_ids, w.nodes
+        FROM cache_way w
+        WHERE w.geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+        AND w.version = (SELECT max(version) FROM cache_way WHERE id = w.id);
+        """
+        ids = array(INT64)
+        versions = array('i')
+        lats = array('d')
+        lons = array('d')
+        self.node_tags = {}
+        cur = con.cursor(name="preload_nodes")
+        cur.itersize = itersize
+        cur.execute(nodes_sql, envelope)
+        for identifier, version, lat, lon, hstore, tag_ids in cur:
+            ids.append(identifier)
+            versions.append(version)
+            lats.append(lat)
+            lons.append(lon)
+            if tag_ids:
+                self.node_tags[identifier] = tags.decode(con, tag_ids)
+            elif hstore:
+                self.node_tags[identifier] = hstore
+        cur.close()
+        self.node_ids = numpy.frombuffer(ids, dtype=numpy.int64).copy()
+        self.node_versions = numpy.frombuffer(versions, dtype=numpy.int32).copy()
+        self.node_lats = numpy.frombuffer(lats, dtype=numpy.float64).copy()
+        self.node_lons = numpy.frombuffer(lons, dtype=numpy.float64).copy()
+
+        self.ways = {}
+        cur = con.cursor(name="preload_ways")
+        cur.itersize = itersize
+        cur.execute(ways_sql, envelope)
+        for identifier, version, wkb, hstore, tag_ids, refs in cur:
+            way_tags = tags.decode(con, tag_ids) if tag_ids is not None else hstore
+            self.update_way(identifier, version, decode_linestring(wkb), way_tags, refs)
+        cur.close()
+        with self.lock:
+            self.updated_nodes = {}
+        self.load_time = time.time() - start
+        self.size = self.memory()
+
+    def memory(self):
+        """
+        Returns the approximate memory used by the loaded elements
+
+        :return: Bytes
+        :rtype: int
+        """
+        size = 0
+        if self.node_ids is not None:
+            size += self.node_ids.nbytes + self.node_versions.nbytes + self.node_lats.nbytes + \
+                self.node_lons.nbytes
+        size += sys.getsizeof(self.node_tags) + sum(sys.getsizeof(tags) for tags in self.node_tags.values())
+        size += sys.getsizeof(self.ways)
+        for way in self.ways.values():
+            size += sys.getsizeof(way) + sys.getsizeof(way[1]) + sys.getsizeof(way[2]) + sys.getsizeof(way[3]) + \
+                sys.getsizeof(way[4])
+        return size
+
+    def find_node(self, identifier, version=None):
+        """
+        Returns a loaded node. The version loaded is kept after a newer one
+        is written, it is the previous version looked up by the run.
+
+        :param identifier: Node id
+        :type identifier: int
+        :param version: Version of the node, the last one by default
+        :type version: int
+        :return: Tuple with id, version, lat, lon and tags, None if the node is not loaded
+        :rtype: tuple
+        """
+        with self.lock:
+            updated = self.updated_nodes.get(identifier)
+        if updated is not None and (version is None or updated[1] == version):
+            return updated
+        if self.node_ids is None or not len(self.node_ids):
+            return None
+        import numpy
+
+        position = numpy.searchsorted(self.node_ids, identifier)
+        if position >= len(self.node_ids) or self.node_ids[position] != identifier:
+            return None
+        if version is not None and self.node_versions[position] != version:
+            return None
+        return (identifier, int(self.node_versions[position]), float(self.node_lats[position]),
+                float(self.node_lons[position]), self.node_tags.get(identifier, {}))
+
+    def find_way(self, identifier, version=None):
+        """
+        Returns a loaded way
+
+        :param identifier: Way id
+        :type identifier: int
+        :param version: Version of the way, the last one by default
+        :type version: int
+        :return: Tuple with id, version, coordinates as [lat, lon] lists or None, tags and node ids, None if the
+            way is not loaded
+        :rtype: tuple
+        """
+        way = self.ways.get(identifier)
+        if way is None or (version is not None and way[0] != version):
+            return None
+        coordinates = None
+        if way[1] is not None:
+            coordinates = [[way[1][indx], way[1][indx + 1]] for indx in range(0, len(way[1]), 2)]
+        return (identifier, way[0], coordinates, way[2], list(way[3]))
+
+    def envelope(self, element_type, identifier):
+        """
+        Returns the envelope of the last version of a loaded element
+
+        :param element_type: n or w
+        :type element_type: str
+        :param identifier: Element id
+        :type identifier: int
+        :return: Tuple with south, west, north and east, None if the element is not loaded or has no geometry
+        :rtype: tuple
+        """
+        if element_type == "n":
+            node = self.find_node(identifier)
+            if node is None:
+                return None
+            return node[2], node[3], node[2], node[3]
+        way = self.ways.get(identifier)
+        if way is None or way[1] is None:
+            return None
+        return way[4]
+
+    def in_bbox(self, element_type, identifier, bbox):
+        """
+        Checks if a loaded element intersects a bounding box
+
+        :param element_type: n or w
+        :type element_type: str
+        :param identifier: Element id
+        :type identifier: int
+        :param bbox: Tuple with north, east, south and west
+        :type bbox: tuple
+        :return: True or False, None if it can't be decided in memory
+        :rtype: bool
+        """
+        north, east, south, west = bbox
+        extent = self.envelope(element_type, identifier)
+        if extent is None:
+            return None
+        if extent[0] > north or extent[2] < south or extent[1] > east or extent[3] < west:
+            return False
+        if element_type == "n":
+            return True
+        coordinates = self.ways[identifier][1]
+        for indx in range(0, len(coordinates), 2):
+            if south <= coordinates[indx] <= north and west <= coordinates[indx + 1] <= east:
+                return True
+        # A segment may cross the envelope without a vertex inside
+        return None
+
+    def update_node(self, identifier, version, lat, lon, tags):
+        """
+        Keeps a node written to the cache during the run if it is newer
+
+        :param identifier: Node id
+        :type identifier: int
+        :param version: Node version
+        :type version: int
+        :param lat: Latitude
+        :type lat: float
+        :param lon: Longitude
+        :type lon: float
+        :param tags: Tags
+        :type tags: dict
+        :return: None
+        """
+        current = self.find_node(identifier)
+        if current is None or current[1] <= version:
+            # The loaded version is not replaced
+            with self.lock:
+                self.updated_nodes[identifier] = (identifier, version, lat, lon, tags or {})
+
+    def update_way(self, identifier, version, coordinates, tags, refs):
+        """
+        Keeps a way written to the cache during the run if it is newer
+
+        :param identifier: Way id
+        :type identifier: int
+        :param version: Way version
+        :type version: int
+        :param coordinates: Points as [lat, lon], None if the geometry is not known
+        :type coordinates: list
+        :param tags: Tags
+        :type tags: dict
+        :param refs: Node ids
+        :type refs: list
+        :return: None
+        """
+        current = self.ways.get(identifier)
+        if current is None or current[0] <= version:
+            flat = None
+            extent = None
+            if coordinates is not None and len(coordinates):
+                if hasattr(coordinates, "ravel"):
+                    # Decoded WKB, copied without a Python loop. The bytes
+                    # initialize the array on Python 2 and 3 alike
+                    flat = array('d', coordinates.ravel().tobytes())
+                else:
+                    flat = array('d', [float(value) for coordinate in coordinates for value in coordinate[:2]])
+                xs = flat[0::2]
+                ys = flat[1::2]
+                extent = (min(xs), min(ys), max(xs), max(ys))
+            self.ways[identifier] = (version, flat, tags or {}, array(INT64, refs or []), extent)
+
+    def forget_way(self, identifier):
+        """
+        Drops a way whose geometry changed on the cache, the next lookup
+        reads it again
+
+        :param identifier: Way id
+        :type identifier: int
+        :return: None
+        """
+        self.ways.pop(identifier, None)
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+import cProfile
+import os
+import pstats
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+CALLBACKS = ["node", "way", "relation"]
+
+
+def callback_costs(stats):
+    """
+    Returns the cost of the ChangeHandler callbacks by entity type
+
+    :param stats: Profile statistics
+    :type stats: pstats.Stats
+    :return: dict with the calls and the cumulative seconds of each entity type
+    :rtype: dict
+    """
+    entries = {}
+    for (filename, lineno, function), data in stats.stats.items():
+        if os.path.basename(filename) == "changewithin.py" and function in CALLBACKS + ["flush_nodes"]:
+            entries[function] = data
+    costs = {}
+    for entity in CALLBACKS:
+        cc, nc, tt, ct, callers = entries.get(entity, (0, 0, 0.0, 0.0, {}))
+        costs[entity] = {"calls": nc, "cumulative": ct}
+    # The pending batch of nodes is flushed from the way and relation
+    # callbacks and at the end of the file, its cost belongs to the nodes
+    if "flush_nodes" in entries:
+        for caller, data in entries["flush_nodes"][4].items():
+            if caller[2] in ("way", "relation"):
+                costs[caller[2]]["cumulative"] -= data[3]
+            if caller[2] != "batch_node":
+                costs["node"]["cumulative"] += data[3]
+    return costs
+
+
+def profile_file(changewithin, filename, output, top=20):
+    """
+    Processes a file under the profiler and the memory tracer. The profiler only sees the calling thread, the
+    tags are looked up on it while profiling
+
+    :param changewithin: ChangeWithin with the configuration loaded
+    :type changewithin: ChangeWithin
+    :param filename: Path of the osc file
+    :type filename: str
+    :param output: Path of the raw profile, the memory snapshot is stored with the .tracemalloc suffix. Python 2
+        has no memory tracer, only the time is profiled there
+    :type output: str
+    :param top: Number of functions and allocations to report
+    :type top: int
+    :return: Report as text
+    :rtype: str
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    lookup_workers = changewithin.lookup_workers
+    changewithin.lookup_workers = 0
+    profiler = cProfile.Profile()
+    if tracemalloc is not None:
+        tracemalloc.start(25)
+    start = time.time()
+    profiler.enable()
+    try:
+        changewithin.process_file(filename)
+    finally:
+        profiler.disable()
+        elapsed = time.time() - start
+        changewithin.lookup_workers = lookup_workers
+        snapshot = None
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    profiler.dump_stats(output)
+    if snapshot is not None:
+        snapshot.dump("{}.tracemalloc".format(output))
+
+    out = StringIO()
+    handler = changewithin.handler
+    out.write("File: {}\n".format(filename))
+    out.write("Elapsed: {:.3f}s\n".format(elapsed))
+    out.write("Nodes: {} Ways: {} Relations: {}\n".format(handler.num_nodes, handler.num_ways, handler.num_rel))
+    if snapshot is not None:
+        out.write("Memory: current {:.1f} KiB, peak {:.1f} KiB\n".format(current / 1024.0, peak / 1024.0))
+    out.write("\n")
+
+    stats = pstats.Stats(profiler, stream=out)
+    out.write("Callback cost by entity type\n")
+    for entity, cost in sorted(callback_costs(stats).items()):
+        per_call = cost["cumulative"] / cost["calls"] * 1e6 if cost["calls"] else 0.0
+        out.write("  {:<10} calls: {:>10} cumulative: {:>9.3f}s per call: {:>8.1f}us\n".format(
+            entity, cost["calls"], cost["cumulative"], per_call))
+    out.write("\nTop functions by cumulative time\n")
+    stats.sort_stats("cumulative").print_stats(top)
+
+    if snapshot is None:
+        out.write("Raw profile: {}\n".format(output))
+        return out.getvalue()
+    out.write("Top allocations\n")
+    for stat in snapshot.statistics("lineno")[:top]:
+        out.write("  {}\n".format(stat))
+    out.write("\nRaw profile: {}\nMemory snapshot: {}.tracemalloc\n".format(output, output))
+    return out.getvalue()
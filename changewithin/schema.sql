@@ -6,3 +6,21 @@ CREATE TABLE cache_way (id BIGINT, version INTEGER, tag hstore);
 SELECT AddGeometryColumn ('public','cache_way','geom',4326,'LINESTRING',2, false);
 CREATE INDEX ON cache_node(id);
 CREATE INDEX ON cache_node(version);
+CREATE TABLE cache_relation (id BIGINT, version INTEGER);
+SELECT AddGeometryColumn ('public','cache_relation','envelope',4326,'POLYGON',2, false);
+CREATE UNIQUE INDEX ON cache_relation(id, version);
+ALTER TABLE cache_way ADD COLUMN nodes BIGINT[];
+CREATE INDEX ON cache_way(id, version);
+CREATE INDEX ON cache_way USING GIN (nodes);
+CREATE INDEX ON cache_node USING GIST (geom);
+CREATE INDEX ON cache_way USING GIST (geom);
+CREATE TABLE result_run (id SERIAL PRIMARY KEY, started TIMESTAMP DEFAULT now(), source TEXT);
+CREATE TABLE result_change (run_id INTEGER REFERENCES result_run(id), changeset BIGINT, uid BIGINT, username TEXT, element_type TEXT, element_id BIGINT, version INTEGER, rule TEXT, lat DOUBLE PRECISION, lon DOUBLE PRECISION, day DATE);
+CREATE UNIQUE INDEX ON result_change(changeset, element_type, element_id, version, rule);
+CREATE INDEX ON result_change(day);
+CREATE INDEX ON result_change(rule, day);
+CREATE INDEX ON result_change(run_id);
+CREATE TABLE cache_tag_text (id SERIAL PRIMARY KEY, text TEXT UNIQUE);
+ALTER TABLE cache_node ADD COLUMN tag_ids INTEGER[];
+ALTER TABLE cache_way ADD COLUMN tag_ids INTEGER[];
+ALTER TABLE cache_relation ADD COLUMN inside BOOLEAN;
@@ -0,0 +1,560 @@
+from __future__ import absolute_import, division
+import base64
+import hashlib
+import json
+import math
+import struct
+import zlib
+from array import array
+
+from changewithin.compat import INT64
+
+# Version of the serialized sketches
+SKETCH_FORMAT = 1
+ELEMENT_TYPES = ("node", "way", "relation")
+
+
+def hash64(value):
+    """
+    Returns a 64 bit hash of a value, the same on every process and
+    machine so the sketches of different runs can be merged
+
+    :param value: Value, hashed by its text
+    :return: Hash
+    :rtype: int
+    """
+    if not isinstance(value, bytes):
+        value = u"{}".format(value).encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(value).digest()[:8])[0]
+
+
+def encode_array(values):
+    """
+    Encodes an array as compressed base64 text
+
+    :param values: Array
+    :type values: bytearray or array.array
+    :return: Text
+    :rtype: str
+    """
+    import numpy
+
+    return base64.b64encode(zlib.compress(numpy.frombuffer(values, dtype=numpy.uint8).tobytes())).decode("ascii")
+
+
+def decode_array(text):
+    """
+    Decodes the bytes of an array written with encode_array
+
+    :param text: Text
+    :type text: str
+    :return: Bytes
+    :rtype: bytes
+    """
+    return zlib.decompress(base64.b64decode(text))
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added with 2 ** precision
+    registers of a byte. The relative standard error is 1.04 / sqrt(2 **
+    precision), 0.81% with the default precision of 14 on 16 KB. The count
+    uses the estimator of Ertl, "New cardinality estimation algorithms for
+    HyperLogLog sketches" (2017), without bias from a few values to
+    billions. Two sketches of the same precision merge into the sketch of
+    the union.
+    """
+
+    def __init__(self, precision=14):
+        """
+        Class constructor
+
+        :param precision: Bits of the hash that select the register, from 4 to 18
+        :type precision: int
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError("Precision of the HyperLogLog out of range: {}".format(precision))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @property
+    def error(self):
+        """
+        Relative standard error of the count
+
+        :rtype: float
+        """
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, value):
+        """
+        Adds a value
+
+        :param value: Value
+        :return: None
+        """
+        self.add_hash(hash64(value))
+
+    def add_hash(self, hashed):
+        """
+        Adds a value by its hash, for values added to several sketches
+
+        :param hashed: Hash of the value as returned by hash64
+        :type hashed: int
+        :return: None
+        """
+        bits = 64 - self.precision
+        rest = hashed & ((1 << bits) - 1)
+        # Position of the first set bit of the rest of the hash
+        rank = bits - rest.bit_length() + 1
+        index = hashed >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        """
+        Returns the estimated number of distinct values
+
+        :rtype: int
+        """
+        import numpy
+
+        size = len(self.registers)
+        bits = 64 - self.precision
+        histogram = numpy.bincount(numpy.frombuffer(self.registers, dtype=numpy.uint8), minlength=bits + 2)
+        if histogram[0] == size:
+            return 0
+        # Registers at the maximum rank, only reached by billions of values
+        x = 1.0 - float(histogram[bits + 1]) / size
+        tau = 0.0
+        if 0.0 < x < 1.0:
+            z = 1.0 - x
+            power = 1.0
+            while True:
+                x = math.sqrt(x)
+                z_old = z
+                power *= 0.5
+                z -= (1.0 - x) ** 2 * power
+                if z == z_old:
+                    break
+            tau = z / 3.0
+        z = size * tau
+        for rank in range(bits, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        # Empty registers
+        x = float(histogram[0]) / size
+        sigma = x
+        y = 1.0
+        while x < 1.0:
+            x *= x
+            sigma_old = sigma
+            sigma += x * y
+            y += y
+            if sigma == sigma_old:
+                break
+        z += size * sigma
+        return int(round(size * size / (2 * math.log(2)) / z))
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch
+
+        :param other: Sketch of the same precision
+        :type other: HyperLogLog
+        :return: None
+        """
+        import numpy
+
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLog of precision {} and {}".format(self.precision,
+                                                                                     other.precision))
+        registers = numpy.frombuffer(self.registers, dtype=numpy.uint8)
+        numpy.maximum(registers, numpy.frombuffer(other.registers, dtype=numpy.uint8), out=registers)
+
+    def to_dict(self):
+        """
+        Returns the sketch as a dict that can be written as JSON
+
+        :rtype: dict
+        """
+        return {"precision": self.precision, "registers": encode_array(self.registers)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Reads a sketch written with to_dict
+
+        :param data: Sketch as a dict
+        :type data: dict
+        :return: Sketch
+        :rtype: HyperLogLog
+        """
+        sketch = cls(data["precision"])
+        sketch.registers = bytearray(decode_array(data["registers"]))
+        return sketch
+
+
+class CountMinSketch(object):
+    """
+    Estimates how many times each key was added with depth rows of width
+    counters. An estimate is never lower than the true count and, with
+    probability 1 - exp(-depth), not higher than the true count plus e /
+    width times the total added. The defaults bound the excess to 0.1% of
+    the total with 99.3% probability on 109 KB. Two sketches of the same
+    shape merge into the sketch of both streams.
+    """
+
+    def __init__(self, width=2719, depth=5):
+        """
+        Class constructor
+
+        :param width: Counters of each row
+        :type width: int
+        :param depth: Number of rows, each with its own hash
+        :type depth: int
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [array(INT64, [0]) * width for _ in range(depth)]
+        self.total = 0
+
+    @property
+    def error(self):
+        """
+        Maximum excess of an estimate as a fraction of the total, with
+        probability 1 - exp(-depth)
+
+        :rtype: float
+        """
+        return math.e / self.width
+
+    def columns(self, key):
+        """
+        Returns the counter of each row of a key
+
+        :param key: Key
+        :return: Column of each row
+        :rtype: list
+        """
+        digest = hashlib.md5(u"{}".format(key).encode("utf-8")).digest()
+        first, second = struct.unpack("<QQ", digest)
+        # The hashes of the rows are derived from two
+        return [(first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """
+        Adds occurrences of a key
+
+        :param key: Key
+        :param count: Occurrences
+        :type count: int
+        :return: Estimated count of the key after the addition
+        :rtype: int
+        """
+        estimate = None
+        for row, column in zip(self.rows, self.columns(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        """
+        Returns the estimated count of a key
+
+        :param key: Key
+        :return: Count
+        :rtype: int
+        """
+        return min(row[column] for row, column in zip(self.rows, self.columns(key)))
+
+    def merge(self, other):
+        """
+        Adds the counts of another sketch
+
+        :param other: Sketch of the same width and depth
+        :type other: CountMinSketch
+        :return: None
+        """
+        import numpy
+
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Can't merge count-min sketches of different shape")
+        for row, other_row in zip(self.rows, other.rows):
+            counters = numpy.frombuffer(row, dtype=numpy.int64)
+            counters += numpy.frombuffer(other_row, dtype=numpy.int64)
+        self.total += other.total
+
+    def memory(self):
+        """
+        Returns the memory of the counters
+
+        :return: Bytes
+        :rtype: int
+        """
+        return sum(row.itemsize * len(row) for row in self.rows)
+
+    def to_dict(self):
+        """
+        Returns the sketch as a dict that can be written as JSON
+
+        :rtype: dict
+        """
+        return {"width": self.width, "depth": self.depth, "total": self.total,
+                "rows": [encode_array(row) for row in self.rows]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Reads a sketch written with to_dict
+
+        :param data: Sketch as a dict
+        :type data: dict
+        :return: Sketch
+        :rtype: CountMinSketch
+        """
+        import numpy
+
+        sketch = cls(data["width"], data["depth"])
+        for row, text in zip(sketch.rows, data["rows"]):
+            numpy.frombuffer(row, dtype=numpy.int64)[:] = numpy.frombuffer(decode_array(text), dtype="<i8")
+        sketch.total = data["total"]
+        return sketch
+
+
+class ApproximateStats(object):
+    """
+    Counts of the matched changes in fixed memory, for areas where keeping
+    every changeset and element id of the report doesn't fit. For each rule
+    it keeps the distinct changesets and users and the distinct elements of
+    each type as HyperLogLog, the exact number of matches of each type and
+    the matches of each user as a count-min sketch, with the users that
+    have the most. The stats of several processes or days are merged with
+    merge.
+    """
+
+    def __init__(self, precision=14, width=2719, depth=5, top=10):
+        """
+        Class constructor
+
+        :param precision: Precision of the HyperLogLog
+        :type precision: int
+        :param width: Width of the count-min sketches
+        :type width: int
+        :param depth: Depth of the count-min sketches
+        :type depth: int
+        :param top: Number of users with the most matches that are kept
+        :type top: int
+        """
+        self.precision = precision
+        self.width = width
+        self.depth = depth
+        self.top = top
+        self.rules = {}
+        self.changesets = HyperLogLog(precision)
+        self.user_matches = CountMinSketch(width, depth)
+        self.top_users = {}
+        self.names = {}
+
+    def rule(self, name):
+        """
+        Returns the sketches of a rule, created on the first use
+
+        :param name: Name of the rule
+        :type name: str
+        :return: dict with the changesets, the users, the elements and the matches
+        :rtype: dict
+        """
+        sketches = self.rules.get(name)
+        if sketches is None:
+            sketches = {
+                "changesets": HyperLogLog(self.precision),
+                "users": HyperLogLog(self.precision),
+                "elements": dict((elem, HyperLogLog(self.precision)) for elem in ELEMENT_TYPES),
+                "matches": dict((elem, 0) for elem in ELEMENT_TYPES)
+            }
+            self.rules[name] = sketches
+        return sketches
+
+    def add(self, rule, elem, identifier, changeset, user, uid):
+        """
+        Adds a matched change
+
+        :param rule: Name of the matched tags
+        :type rule: str
+        :param elem: Type of element node, way or relation
+        :type elem: str
+        :param identifier: Id of the element
+        :type identifier: int
+        :param changeset: Changeset of the element
+        :type changeset: int
+        :param user: User of the changeset
+        :type user: str
+        :param uid: User id of the changeset
+        :type uid: int
+        :return: None
+        """
+        sketches = self.rule(rule)
+        changeset_hash = hash64(changeset)
+        sketches["changesets"].add_hash(changeset_hash)
+        sketches["users"].add(uid)
+        sketches["elements"][elem].add(identifier)
+        sketches["matches"][elem] += 1
+        self.changesets.add_hash(changeset_hash)
+        self.track_user(uid, user, self.user_matches.add(uid))
+
+    def track_user(self, uid, user, estimate):
+        """
+        Keeps a user among the ones with the most matches if its estimate is
+        higher than the lowest of them
+
+        :param uid: User id
+        :type uid: int
+        :param user: User name
+        :type user: str
+        :param estimate: Estimated matches of the user
+        :type estimate: int
+        :return: None
+        """
+        if uid in self.top_users or len(self.top_users) < self.top:
+            self.top_users[uid] = estimate
+            self.names[uid] = user
+            return
+        lowest = min(self.top_users, key=self.top_users.get)
+        if estimate > self.top_users[lowest]:
+            del self.top_users[lowest]
+            del self.names[lowest]
+            self.top_users[uid] = estimate
+            self.names[uid] = user
+
+    def merge(self, other):
+        """
+        Adds the stats of another process or day
+
+        :param other: Stats with the same precision and sketch shape
+        :type other: ApproximateStats
+        :return: None
+        """
+        for name, other_sketches in other.rules.items():
+            sketches = self.rule(name)
+            sketches["changesets"].merge(other_sketches["changesets"])
+            sketches["users"].merge(other_sketches["users"])
+            for elem in ELEMENT_TYPES:
+                sketches["elements"][elem].merge(other_sketches["elements"][elem])
+                sketches["matches"][elem] += other_sketches["matches"][elem]
+        self.changesets.merge(other.changesets)
+        self.user_matches.merge(other.user_matches)
+        # The candidates of both are ranked again with the merged counts
+        names = dict(self.names)
+        names.update(other.names)
+        self.top_users = {}
+        self.names = {}
+        for uid in names:
+            self.track_user(uid, names[uid], self.user_matches.estimate(uid))
+
+    def report_stats(self):
+        """
+        Returns the stats of the report
+
+        :return: Estimated changesets by rule and the total
+        :rtype: dict
+        """
+        stats = dict((name, sketches["changesets"].count()) for name, sketches in self.rules.items())
+        stats["total"] = self.changesets.count()
+        return stats
+
+    def summary(self):
+        """
+        Returns the estimates of every rule
+
+        :return: dict with the estimated distinct changesets and users and the errors, the rules with the distinct
+            changesets, users and elements of each type and the exact matches of each type, and the users with the
+            most matches
+        :rtype: dict
+        """
+        rules = {}
+        for name, sketches in self.rules.items():
+            rules[name] = {
+                "changesets": sketches["changesets"].count(),
+                "users": sketches["users"].count(),
+                "elements": dict((elem, sketch.count()) for elem, sketch in sketches["elements"].items()),
+                "matches": dict(sketches["matches"])
+            }
+        users = sorted(self.top_users.items(), key=lambda item: (-item[1], item[0]))
+        return {
+            "changesets": self.changesets.count(),
+            "rules": rules,
+            "users": [{"uid": uid, "user": self.names[uid], "matches": matches} for uid, matches in users],
+            "distinct_error": self.changesets.error,
+            "matches_error": int(math.ceil(self.user_matches.error * self.user_matches.total))
+        }
+
+    def memory(self):
+        """
+        Returns the memory used by the sketches, it doesn't grow with the
+        number of changes
+
+        :return: Bytes
+        :rtype: int
+        """
+        size = len(self.changesets.registers) + self.user_matches.memory()
+        for sketches in self.rules.values():
+            size += len(sketches["changesets"].registers) + len(sketches["users"].registers)
+            size += sum(len(sketch.registers) for sketch in sketches["elements"].values())
+        return size
+
+    def dumps(self):
+        """
+        Serializes the stats as JSON, to merge them in another process or
+        with the stats of other days
+
+        :rtype: str
+        """
+        rules = {}
+        for name, sketches in self.rules.items():
+            rules[name] = {
+                "changesets": sketches["changesets"].to_dict(),
+                "users": sketches["users"].to_dict(),
+                "elements": dict((elem, sketch.to_dict()) for elem, sketch in sketches["elements"].items()),
+                "matches": sketches["matches"]
+            }
+        return json.dumps({
+            "format": SKETCH_FORMAT,
+            "precision": self.precision,
+            "top": self.top,
+            "rules": rules,
+            "changesets": self.changesets.to_dict(),
+            "user_matches": self.user_matches.to_dict(),
+            "users": [[uid, self.names[uid], matches] for uid, matches in self.top_users.items()]
+        }, sort_keys=True)
+
+    @classmethod
+    def loads(cls, text):
+        """
+        Reads stats serialized with dumps
+
+        :param text: JSON
+        :type text: str
+        :return: Stats
+        :rtype: ApproximateStats
+        """
+        data = json.loads(text)
+        if data.get("format") != SKETCH_FORMAT:
+            raise ValueError("Unknown format of the sketches: {}".format(data.get("format")))
+        user_matches = CountMinSketch.from_dict(data["user_matches"])
+        stats = cls(data["precision"], user_matches.width, user_matches.depth, data["top"])
+        stats.user_matches = user_matches
+        stats.changesets = HyperLogLog.from_dict(data["changesets"])
+        for name, sketches in data["rules"].items():
+            stats.rules[name] = {
+                "changesets": HyperLogLog.from_dict(sketches["changesets"]),
+                "users": HyperLogLog.from_dict(sketches["users"]),
+                "elements": dict((elem, HyperLogLog.from_dict(sketch))
+                                 for elem, sketch in sketches["elements"].items()),
+                "matches": sketches["matches"]
+            }
+        for uid, user, matches in data["users"]:
+            stats.top_users[uid] = matches
+            stats.names[uid] = user
+        return stats
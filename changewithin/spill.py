@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+
+class ChangeSpill(object):
+    """
+    Keeps the matched changes of the report within a memory budget. The
+    changes are buffered in memory and, when the buffer is over the budget,
+    written sorted by changeset to a run on disk. The runs are merged when
+    the report is built, one changeset at a time.
+    """
+
+    def __init__(self, budget, directory=None, max_runs=64):
+        """
+        Class constructor
+
+        :param budget: Bytes of changes kept in memory before spilling them to disk
+        :type budget: int
+        :param directory: Directory of the runs, the system temporary directory by default
+        :type directory: str
+        :param max_runs: Number of runs merged into a single one, bounds the files open on the merge
+        :type max_runs: int
+        """
+        self.budget = budget
+        self.directory = directory
+        self.max_runs = max_runs
+        self.path = None
+        self.buffer = []
+        self.size = 0
+        self.max_size = 0
+        self.runs = []
+        self.spills = 0
+
+    def add(self, changeset, user, uid, ids_key, tag_name, identifier):
+        """
+        Adds a matched change
+
+        :param changeset: Changeset of the element
+        :type changeset: int
+        :param user: User of the changeset
+        :type user: str
+        :param uid: User id of the changeset
+        :type uid: int
+        :param ids_key: Key of the element type on the changeset, nids, wids or rids
+        :type ids_key: str
+        :param tag_name: Name of the matched tags
+        :type tag_name: str
+        :param identifier: Id of the element
+        :type identifier: int
+        :return: None
+        """
+        record = (changeset, ids_key, tag_name, identifier, user, uid)
+        self.buffer.append(record)
+        self.size += sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record)
+        self.max_size = max(self.max_size, self.size)
+        if self.size >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Writes the buffer sorted to a new run on disk
+
+        :return: None
+        """
+        if not self.buffer:
+            return
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix="changewithin-spill-", dir=self.directory)
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.spills += 1
+        self.buffer = []
+        self.size = 0
+        if len(self.runs) >= self.max_runs:
+            runs = self.runs
+            self.runs = [self.write_run(heapq.merge(*[self.read_run(run) for run in runs]))]
+            for run in runs:
+                os.unlink(run)
+
+    def write_run(self, records):
+        """
+        Writes sorted changes to a new run
+
+        :param records: Sorted change tuples
+        :return: Path of the run
+        :rtype: str
+        """
+        handle, filename = tempfile.mkstemp(prefix="run-", suffix=".jsonl", dir=self.path)
+        with os.fdopen(handle, "w") as f:
+            for record in records:
+                f.write(json.dumps(record))
+                f.write("\n")
+        return filename
+
+    def read_run(self, filename):
+        """
+        Reads the changes of a run
+
+        :param filename: Path of the run
+        :type filename: str
+        :return: Generator of change tuples
+        """
+        with open(filename) as f:
+            for line in f:
+                yield tuple(json.loads(line))
+
+    def records(self):
+        """
+        Returns all the changes sorted by changeset, merging the runs on
+        disk with the buffer
+
+        :return: Generator of change tuples
+        """
+        self.buffer.sort()
+        return heapq.merge(self.buffer, *[self.read_run(run) for run in self.runs])
+
+    def changesets(self):
+        """
+        Returns the changesets with their matched elements, built one at a
+        time from the sorted changes
+
+        :return: Generator of changeset dicts as ChangeHandler.changeset values
+        """
+        current = None
+        for changeset, ids_key, tag_name, identifier, user, uid in self.records():
+            if current is None or current["changeset"] != changeset:
+                if current is not None:
+                    yield current
+                current = {
+                    "changeset": changeset,
+                    "user": user,
+                    "uid": uid,
+                    "nids": {},
+                    "wids": {},
+                    "rids": {}
+                }
+            current[ids_key].setdefault(tag_name, []).append(identifier)
+        if current is not None:
+            yield current
+
+    def summary(self, tag_names, limit=1000):
+        """
+        Merges the changes into the data of the report, only the first
+        changesets are kept in memory
+
+        :param tag_names: Names of the configured tags
+        :type tag_names: list
+        :param limit: Number of changesets kept
+        :type limit: int
+        :return: Tuple with the first changesets by id, the number of changesets by tag name and the total
+            number of changesets
+        :rtype: tuple
+        """
+        changesets = {}
+        stats = dict((tag_name, 0) for tag_name in tag_names)
+        total = 0
+        for changeset in self.changesets():
+            total += 1
+            # A changeset with nodes and ways of the same tags counts once
+            matched = set()
+            for ids_key in ("nids", "wids", "rids"):
+                matched.update(changeset[ids_key].keys())
+            for tag_name in matched:
+                stats[tag_name] = stats.get(tag_name, 0) + 1
+            if len(changesets) < limit:
+                changesets[changeset["changeset"]] = changeset
+        return changesets, stats, total
+
+    def close(self):
+        """
+        Removes the runs from disk
+
+        :return: None
+        """
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+        self.runs = []
+        self.buffer = []
+        self.size = 0
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+import threading
+
+
+class TagDictionary(object):
+    """
+    Interns the keys and values of the cached tags. Each text is stored once
+    in the dictionary table and the elements keep an array of integers with
+    the ids of their keys and values in pairs, sorted by key. The texts read
+    or written by the run are kept in memory, so the same text decoded on
+    many elements is a single string. The lookup workers decode tags while
+    the handler encodes them, the texts are added under a lock.
+    """
+
+    def __init__(self, table="cache_tag_text"):
+        """
+        Class constructor
+
+        :param table: Table of the dictionary
+        :type table: str
+        """
+        self.table = table
+        self.ids = {}
+        self.texts = {}
+        self.lock = threading.Lock()
+
+    def load(self, con):
+        """
+        Reads the whole dictionary
+
+        :param con: Connection to the cache
+        :return: Number of texts
+        :rtype: int
+        """
+        cur = con.cursor()
+        cur.execute("SELECT id, text FROM {};".format(self.table))
+        for identifier, text in cur:
+            self.add(identifier, text)
+        cur.close()
+        return len(self.texts)
+
+    def add(self, identifier, text):
+        """
+        Keeps a text of the dictionary in memory
+
+        :param identifier: Id of the text
+        :type identifier: int
+        :param text: Key or value
+        :type text: str
+        :return: None
+        """
+        with self.lock:
+            text = self.texts.setdefault(identifier, text)
+            self.ids[text] = identifier
+
+    def intern(self, con, texts):
+        """
+        Adds to the dictionary the texts it doesn't have yet
+
+        :param con: Connection to the cache
+        :param texts: Keys and values
+        :type texts: iterable
+        :return: None
+        """
+        missing = list(set(text for text in texts if text not in self.ids))
+        if not missing:
+            return
+        cur = con.cursor()
+        cur.execute("""
+        INSERT INTO {0} (text) SELECT unnest(%s::text[])
+        ON CONFLICT (text) DO NOTHING;
+        SELECT id, text FROM {0} WHERE text = ANY(%s::text[]);
+        """.format(self.table), (missing, missing))
+        for identifier, text in cur.fetchall():
+            self.add(identifier, text)
+        cur.close()
+
+    def lookup(self, con, ids):
+        """
+        Reads the texts of the ids that are not in memory
+
+        :param con: Connection to the cache
+        :param ids: Ids of keys and values
+        :type ids: iterable
+        :return: None
+        """
+        missing = list(set(identifier for identifier in ids if identifier not in self.texts))
+        if not missing:
+            return
+        cur = con.cursor()
+        cur.execute("SELECT id, text FROM {} WHERE id = ANY(%s);".format(self.table), (missing,))
+        for identifier, text in cur.fetchall():
+            self.add(identifier, text)
+        cur.close()
+
+    def encode(self, con, tags):
+        """
+        Returns the ids of some tags, the missing texts are added
+
+        :param con: Connection to the cache
+        :param tags: Tags
+        :type tags: dict
+        :return: Ids of each key and its value, sorted by key
+        :rtype: list
+        """
+        return self.encode_many(con, [tags])[0]
+
+    def encode_many(self, con, tag_sets):
+        """
+        Returns the ids of the tags of several elements with a single query
+        for the missing texts
+
+        :param con: Connection to the cache
+        :param tag_sets: Tags of each element
+        :type tag_sets: list
+        :return: Ids of each element
+        :rtype: list
+        """
+        self.intern(con, (text for tags in tag_sets if tags for item in tags.items() for text in item))
+        ret = []
+        for tags in tag_sets:
+            ids = []
+            for key in sorted(tags or {}):
+                ids.append(self.ids[key])
+                ids.append(self.ids[tags[key]])
+            ret.append(ids)
+        return ret
+
+    def decode(self, con, ids):
+        """
+        Returns the tags of some ids
+
+        :param con: Connection to the cache
+        :param ids: Ids of each key and its value
+        :type ids: list
+        :return: Tags
+        :rtype: dict
+        """
+        return self.decode_many(con, [ids])[0]
+
+    def decode_many(self, con, id_lists):
+        """
+        Returns the tags of several elements with a single query for the
+        texts not in memory
+
+        :param con: Connection to the cache
+        :param id_lists: Ids of each element
+        :type id_lists: list
+        :return: Tags of each element
+        :rtype: list
+        """
+        self.lookup(con, (identifier for ids in id_lists if ids for identifier in ids))
+        texts = self.texts
+        return [dict((texts[ids[indx]], texts[ids[indx + 1]]) for indx in range(0, len(ids or []), 2))
+                for ids in id_lists]
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+import struct
+
+# Geometry types of the well-known binary format
+WKB_LINESTRING = 2
+# Flag of the EWKB geometry type when the SRID is included
+EWKB_SRID = 0x20000000
+
+
+def encode_linestring(points):
+    """
+    Encodes a line as little endian WKB. The points are given as latitude
+    and longitude, the geometry is written with the longitude as x.
+
+    :param points: Points as [lat, lon]
+    :type points: list
+    :return: WKB of the line
+    :rtype: bytes
+    """
+    values = []
+    for lat, lon in points:
+        values.append(lon)
+        values.append(lat)
+    return struct.pack("<BII{}d".format(len(values)), 1, WKB_LINESTRING, len(points), *values)
+
+
+def decode_linestring(data):
+    """
+    Decodes a line in WKB or EWKB, as returned by ST_AsBinary
+
+    :param data: WKB of the line
+    :type data: bytes
+    :return: Array of shape (n, 2) with the latitude and the longitude of each point
+    :rtype: numpy.ndarray
+    """
+    import numpy
+
+    data = bytes(data)
+    order = "<" if data[0:1] == b"\x01" else ">"
+    geometry_type, = struct.unpack(order + "I", data[1:5])
+    offset = 5
+    if geometry_type & EWKB_SRID:
+        offset += 4
+    if geometry_type & 0xff != WKB_LINESTRING:
+        raise ValueError("WKB geometry type {} is not a line".format(geometry_type))
+    count, = struct.unpack(order + "I", data[offset:offset + 4])
+    coordinates = numpy.frombuffer(data, dtype=numpy.dtype(order + "f8"), count=count * 2, offset=offset + 4)
+    # x is the longitude
+    return coordinates.reshape(count, 2)[:, ::-1].astype(numpy.float64)
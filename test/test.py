@@ -2,15 +2,42 @@ import unittest
 from changewithin import ChangeWithin
 from changewithin import ChangeHandler
 from osmium.osm import Location, WayNodeList, Node
+import osmium
 from changewithin import get_state
 from changewithin.changewithin import DbCache
+from changewithin.changewithin import NodeBatch, location_distance, literal_key, flatten_coordinates
+from changewithin.errors import ErrorAggregator, ErrorRateExceeded
+from changewithin.export import get_exporter, ResultWriter
+from changewithin.profiling import profile_file
+from changewithin.mirror import ReplicationMirror
+from changewithin.backfill import SequenceIndex, backfill
+from changewithin.notify import WebhookEndpoint, stream
+from changewithin.preload import AreaPreload
+from changewithin.tagdict import TagDictionary
+from changewithin.pipeline import LookupPool, Prefetch
+from changewithin.wkb import encode_linestring, decode_linestring
+from changewithin.spill import ChangeSpill
+from changewithin.sketch import HyperLogLog, CountMinSketch, ApproximateStats
+import csv
+import gzip
+import io
+import shutil
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
 import osmapi
 import psycopg2
 import sys
 if sys.version_info[0] == 2:
     import mock
+    from mock import MagicMock
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 else:
     from unittest.mock import MagicMock
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 class LibTest(unittest.TestCase):
     """
@@ -96,11 +123,11 @@ class CacheTest(unittest.TestCase):
         l2 = Location(2, 2)
 
         if sys.version_info[0] == 2:
-            n1 = mock.MagicMock(id=1, location=l1)
-            n2 = mock.MagicMock(id=2, location=l2)
+            n1 = mock.MagicMock(id=1, ref=1, location=l1)
+            n2 = mock.MagicMock(id=2, ref=2, location=l2)
         else:
-            n1 = MagicMock(id=1, location=l1)
-            n2 = MagicMock(id=2, location=l2)
+            n1 = MagicMock(id=1, ref=1, location=l1)
+            n2 = MagicMock(id=2, ref=2, location=l2)
 
         if sys.version_info[0] == 2:
             nl = [n1, n2]
@@ -127,11 +154,11 @@ class CacheTest(unittest.TestCase):
         l2 = Location(2, 2)
 
         if sys.version_info[0] == 2:
-            n1 = mock.MagicMock(id=1,location=l1)
-            n2 = mock.MagicMock(id=2,location=l2)
+            n1 = mock.MagicMock(id=1, ref=1, location=l1)
+            n2 = mock.MagicMock(id=2, ref=2, location=l2)
         else:
-            n1 = MagicMock(id=1,location=l1)
-            n2 = MagicMock(id=2,location=l2)
+            n1 = MagicMock(id=1, ref=1, location=l1)
+            n2 = MagicMock(id=2, ref=2, location=l2)
 
         if sys.version_info[0] == 2:
             nl = [n1, n2]
@@ -154,7 +181,8 @@ class CacheTest(unittest.TestCase):
                 "id": 1,
                 "version": 2,
                 "tag": {},
-                "coordinates": [[[1, 1], [2, 2]]]
+                "coordinates": [[[1, 1], [2, 2]]],
+                "nodes": [1, 2]
             }
 
         }
@@ -164,6 +192,280 @@ class CacheTest(unittest.TestCase):
         way_none = self.cache.get_way(23212)
         self.assertIsNone(way_none)
 
+    def test_way_nodes(self):
+        """
+        Tests the reverse lookup of ways by node and the rebuild of their geometry
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_way;")
+        self.cur.execute("DELETE FROM cache_node;")
+        self.connection.commit()
+        if sys.version_info[0] == 2:
+            n1 = mock.MagicMock(ref=501, location=Location(1, 1))
+            n2 = mock.MagicMock(ref=502, location=Location(2, 2))
+            n3 = mock.MagicMock(ref=503, location=Location())
+        else:
+            n1 = MagicMock(ref=501, location=Location(1, 1))
+            n2 = MagicMock(ref=502, location=Location(2, 2))
+            n3 = MagicMock(ref=503, location=Location())
+        self.cache.add_node(501, 1, 1, 1, {})
+        self.cache.add_node(502, 1, 2, 2, {})
+        self.assertTrue(self.cache.add_way(50, 1, [n1, n2], {}))
+        self.assertFalse(self.cache.add_way(51, 1, [n1, n3], {}))
+        self.cache.commit()
+        self.assertEqual(self.cache.get_way(51)["data"]["nodes"], [501, 503])
+        self.assertEqual(self.cache.get_way(51)["data"]["coordinates"], [])
+        self.assertEqual(self.cache.get_ways_by_nodes([502]), set([50]))
+        self.assertEqual(self.cache.get_ways_by_nodes([501]), set([50, 51]))
+
+        self.cache.add_node(502, 2, 3, 3, {})
+        self.cache.commit()
+        changes = self.cache.rebuild_way_geometries([50, 51], (10, 10, 2.5, 2.5))
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0][:3], (50, False, True))
+        self.assertAlmostEqual(changes[0][3], 2 ** 0.5)
+        self.assertEqual(changes[0][5], [501, 502])
+        self.assertEqual(changes[0][6], 1)
+        self.assertEqual(self.cache.get_way(50)["data"]["coordinates"], [[[1, 1], [3, 3]]])
+
+    def test_in_bbox_batch(self):
+        """
+        Tests the batched spatial checks of the cache
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_way;")
+        self.cur.execute("DELETE FROM cache_node;")
+        self.connection.commit()
+        if sys.version_info[0] == 2:
+            n1 = mock.MagicMock(ref=601, location=Location(2.81, 41.98))
+            n2 = mock.MagicMock(ref=602, location=Location(10, 10))
+        else:
+            n1 = MagicMock(ref=601, location=Location(2.81, 41.98))
+            n2 = MagicMock(ref=602, location=Location(10, 10))
+        self.cache.add_node(601, 1, 41.98, 2.81, {})
+        self.cache.add_node(602, 1, 10, 10, {})
+        self.cache.add_node(602, 2, 41.97, 2.80, {})
+        self.cache.add_node(603, 1, 10, 10, {})
+        self.cache.add_way(60, 1, [n1, n2], {})
+        self.cache.commit()
+        bbox = (41.9933, 2.8576, 41.9623, 2.7847)
+        self.assertEqual(self.cache.nodes_in_bbox([601, 602, 603, 604], bbox), set([601, 602]))
+        self.assertEqual(self.cache.ways_in_bbox([60, 61], bbox), set([60]))
+        nodes, ways, envelope = self.cache.get_extent([601, 603, 604], [60, 61])
+        self.assertEqual(nodes, set([601, 603]))
+        self.assertEqual(ways, set([60]))
+        self.assertEqual(envelope, (10, 2.81, 41.98, 10))
+
+    def test_relation_envelope(self):
+        """
+        Tests the envelopes of the relations on the cache
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_relation;")
+        self.connection.commit()
+        self.cache.add_relation(7, 1, (41.0, 2.0, 42.0, 3.0))
+        self.cache.add_relation(7, 2, (41.5, 2.5, 42.5, 3.5), True)
+        self.cache.add_relation(7, 2, (41.5, 2.5, 42.5, 3.5), True)
+        self.cache.commit()
+        self.assertEqual(self.cache.get_relation(7, 1)["data"]["envelope"], (41.0, 2.0, 42.0, 3.0))
+        self.assertIsNone(self.cache.get_relation(7, 1)["data"]["inside"])
+        self.assertEqual(self.cache.get_relation(7)["data"]["version"], 2)
+        self.assertTrue(self.cache.get_relation(7)["data"]["inside"])
+        self.cur.execute("SELECT count(*) FROM cache_relation WHERE id = 7 AND version = 2;")
+        self.assertEqual(self.cur.fetchone()[0], 1)
+        self.assertIsNone(self.cache.get_relation(8))
+
+    def test_axis_order(self):
+        """
+        Tests the geometries are stored with the longitude as x and read back as latitude and longitude
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node;")
+        self.cur.execute("DELETE FROM cache_way;")
+        self.connection.commit()
+        self.cache.add_node(1, 1, 41.98, 2.81, {})
+        self.cache.add_nodes([(2, 1, 41.97, 2.80, {})])
+        self.cache.add_way(10, 1, [[41.98, 2.81], [41.97, 2.80]], {}, [1, 2])
+        self.cache.commit()
+        self.cur.execute("SELECT id, ST_X(geom), ST_Y(geom) FROM cache_node ORDER BY id;")
+        self.assertEqual(self.cur.fetchall(), [(1, 2.81, 41.98), (2, 2.80, 41.97)])
+        self.cur.execute("SELECT ST_X(ST_StartPoint(geom)), ST_Y(ST_StartPoint(geom)) FROM cache_way;")
+        self.assertEqual(self.cur.fetchall(), [(2.81, 41.98)])
+        node = self.cache.get_node(1)["data"]
+        self.assertEqual((node["lat"], node["lon"]), (41.98, 2.81))
+        self.assertEqual(flatten_coordinates(self.cache.get_way(10)["data"]["coordinates"]),
+                         [[41.98, 2.81], [41.97, 2.80]])
+        self.assertEqual(self.cache.get_previous_locations([1], [2]), {1: (41.98, 2.81)})
+        bbox = (41.9933, 2.8576, 41.9623, 2.7847)
+        self.assertEqual(self.cache.nodes_in_bbox([1, 2], bbox), set([1, 2]))
+        self.assertEqual(self.cache.ways_in_bbox([10], bbox), set([10]))
+        self.assertEqual(self.cache.get_extent([1, 2], [10])[2], (41.97, 2.80, 41.98, 2.81))
+
+    def test_tag_dictionary(self):
+        """
+        Tests the tags stored as ids of the dictionary are read as the hstore ones
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node;")
+        self.cur.execute("DELETE FROM cache_way;")
+        self.connection.commit()
+        self.cache.add_node(1, 1, 41.98, 2.81, {"building": "yes"})
+        self.cache.tag_storage = "dictionary"
+        self.cache.add_node(1, 2, 41.98, 2.81, {"building": "yes", "name": "yes"})
+        self.cache.add_nodes([(2, 1, 41.97, 2.80, {"building": "house"}), (3, 1, 41.97, 2.80, {})])
+        self.cache.add_way(10, 1, [[41.98, 2.81], [41.97, 2.80]], {"building": "yes"}, [1, 2])
+        self.cache.commit()
+        self.cur.execute("SELECT tag, tag_ids FROM cache_node WHERE id = 1 ORDER BY version;")
+        rows = self.cur.fetchall()
+        self.assertEqual(rows[0], ({"building": "yes"}, None))
+        self.assertIsNone(rows[1][0])
+        self.assertEqual(len(rows[1][1]), 4)
+        self.cur.execute("SELECT count(*) FROM cache_tag_text WHERE text IN ('building', 'yes');")
+        self.assertEqual(self.cur.fetchone()[0], 2)
+        # Read back without the texts in memory
+        self.cache.tag_dictionary = TagDictionary()
+        self.assertEqual(self.cache.get_node(1, 1)["data"]["tag"], {"building": "yes"})
+        self.assertEqual(self.cache.get_node(1, 2)["data"]["tag"], {"building": "yes", "name": "yes"})
+        self.assertEqual(self.cache.get_node(2)["data"]["tag"], {"building": "house"})
+        self.assertEqual(self.cache.get_node(3)["data"]["tag"], {})
+        self.assertEqual(self.cache.get_way(10)["data"]["tag"], {"building": "yes"})
+
+    def test_previous_versions(self):
+        """
+        Tests the previous versions of the deleted elements are read in batch
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node;")
+        self.cur.execute("DELETE FROM cache_way;")
+        self.cur.execute("DELETE FROM cache_relation;")
+        self.connection.commit()
+        self.cache.add_nodes([(1, 1, 41.98, 2.81, {"building": "yes"}), (1, 2, 41.97, 2.80, {"building": "house"})])
+        self.cache.add_way(10, 1, [[41.98, 2.81], [41.97, 2.80]], {"building": "yes"}, [1, 2])
+        self.cache.add_relation(20, 3, (41.97, 2.80, 41.98, 2.81))
+        self.cache.commit()
+        self.assertEqual(self.cache.get_previous_versions("node", [1, 2], [3, 2]),
+                         {1: (2, {"building": "house"}, [[41.97, 2.80]])})
+        self.assertEqual(self.cache.get_previous_versions("node", [1], [2]),
+                         {1: (1, {"building": "yes"}, [[41.98, 2.81]])})
+        self.assertEqual(self.cache.get_previous_versions("way", [10], [2]),
+                         {10: (1, {"building": "yes"}, [[41.98, 2.81], [41.97, 2.80]])})
+        self.assertEqual(self.cache.get_previous_versions("relation", [20], [4]),
+                         {20: (3, None, (41.97, 2.80, 41.98, 2.81))})
+
+    def test_preload(self):
+        """
+        Tests the lookups of the preloaded area are answered from memory
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node;")
+        self.cur.execute("DELETE FROM cache_way;")
+        self.connection.commit()
+        self.cache.add_nodes([(1, 1, 41.97, 2.80, {"building": "yes"}), (1, 2, 41.98, 2.81, {}),
+                              (2, 1, 41.975, 2.805, {}), (3, 1, 10.0, 10.0, {})])
+        self.cache.add_way(10, 1, [[41.97, 2.80], [41.975, 2.805]], {"highway": "path"}, [1, 2])
+        self.cache.commit()
+        preloaded = self.cache.preload((41.9933, 2.8576, 41.9623, 2.7847))
+        self.assertEqual(list(preloaded.node_ids), [1, 2])
+        self.assertEqual(list(preloaded.ways.keys()), [10])
+        self.cache.con.close()
+        self.assertEqual(self.cache.get_node(1)["data"]["version"], 2)
+        self.assertEqual(self.cache.get_way(10)["data"]["nodes"], [1, 2])
+        nodes, ways, envelope = self.cache.get_extent([1, 2], [10])
+        self.assertEqual((nodes, ways), (set([1, 2]), set([10])))
+        self.assertEqual(envelope, (41.97, 2.80, 41.98, 2.81))
+
+    def test_results_rollup(self):
+        """
+        Tests the stored results and their rollup by period
+
+        :return: None
+        """
+
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM result_change;")
+        self.connection.commit()
+        change = {
+            "changeset": 1, "user": "a", "uid": 10, "type": "node", "id": 5, "version": 1,
+            "rule": "highway", "lat": 41.9, "lon": 2.8, "timestamp": "2017-05-29T10:00:00Z"
+        }
+        other = dict(change, changeset=2, uid=11, id=6, timestamp="2017-05-30T10:00:00Z")
+        first = self.cache.start_run("first.osc")
+        self.cache.add_results(first, [change])
+        second = self.cache.start_run("second.osc")
+        self.cache.add_results(second, [change, other])
+        self.cache.commit()
+        days = self.cache.get_rollup("day")
+        self.assertEqual([(row["period"], row["changes"]) for row in days],
+                         [("2017-05-29", 1), ("2017-05-30", 1)])
+        week = self.cache.get_rollup("week", "2017-05-29", "2017-06-04")
+        self.assertEqual(len(week), 1)
+        self.assertEqual(week[0]["changes"], 2)
+        self.assertEqual(week[0]["users"], 2)
+        self.assertRaises(ValueError, self.cache.get_rollup, "year")
+
+    def test_write_lock(self):
+        """
+        Tests the overlapping runs serialize their writes
+
+        :return: None
+        """
+
+        other = DbCache("localhost", "changewithin", "postgres", "postgres")
+        self.assertTrue(self.cache.lock_writes())
+        self.assertFalse(other.lock_writes(wait=False))
+        self.assertIsNone(other.get_node(1))
+        self.cache.unlock_writes()
+        self.assertTrue(other.lock_writes(wait=False))
+        other.close()
+        self.assertTrue(other.pool.closed)
+        other.close()
+        self.assertTrue(self.cache.lock_writes(wait=False))
+        self.cache.close()
+
+    def test_thread_connections(self):
+        """
+        Tests each thread queries the cache with its own connection
+
+        :return: None
+        """
+
+        connections = []
+
+        def worker():
+            connections.append(self.cache.con)
+            self.cache.get_node(1)
+            self.cache.release()
+
+        threads = [threading.Thread(target=worker) for indx in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(connections), 3)
+        self.assertTrue(self.cache.con not in connections)
+        self.assertTrue(all(con.autocommit for con in connections))
+
     def test_get_node(self):
         """
         Test the get_node method
@@ -226,6 +528,322 @@ class HandlerTest(unittest.TestCase):
         l = Location(2.81372, 41.98268)
         self.assertTrue(self.handler.location_in_bbox(l))
 
+    def test_node_batch_in_bbox(self):
+        """
+        Tests the spatial filter of a batch of nodes
+        :return: None
+        """
+
+        batch = NodeBatch()
+        batch.add(1, 1, 41.98268, 2.81372, None)
+        batch.add(2, 1, 10.0, 2.81372, None)
+        batch.add(3, 1, float("nan"), float("nan"), None)
+        batch.add(4, 1, 41.97, 2.80, None)
+        self.assertEqual(list(batch.in_bbox(41.9933, 2.8576, 41.9623, 2.7847)), [0, 3])
+        self.assertEqual(list(batch.valid()), [0, 1, 3])
+        batch.clear()
+        self.assertEqual(len(batch), 0)
+
+    def test_moved_nodes(self):
+        """
+        Tests the nodes moved with the same tags are matched with a single cache lookup
+        :return: None
+        """
+
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        self.handler.set_tags("building", "building", ".*", ["node"], geometry=True)
+        if sys.version_info[0] == 2:
+            self.handler.cache = mock.MagicMock()
+        else:
+            self.handler.cache = MagicMock()
+        self.handler.cache_enabled = True
+        self.handler.has_tag_changed = lambda *args: False
+        self.handler.cache.get_previous_locations.return_value = {
+            1: (41.98268, 2.81372),
+            2: (41.98000, 2.81372)
+        }
+        info = (100, "user", 5, False, {"building": "yes"}, None)
+        self.handler.node_batch.add(1, 2, 41.982681, 2.81372, info)
+        self.handler.node_batch.add(2, 2, 41.98268, 2.81372, info)
+        self.handler.node_batch.add(3, 1, 41.98268, 2.81372, info)
+        self.handler.flush_nodes()
+        self.assertEqual(self.handler.cache.get_previous_locations.call_count, 1)
+        self.assertEqual(sorted(self.handler.cache.get_previous_locations.call_args[0][0]), [1, 2])
+        self.assertEqual(self.handler.changeset[100]["nids"]["building"], [2, 3])
+        self.assertAlmostEqual(location_distance((41.98, 2.81), (41.98268, 2.81)), 298.0, 0)
+
+    def test_cache_area(self):
+        """
+        Tests only the elements near the area and the nodes of its ways are stored on the cache
+        :return: None
+        """
+        osc = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <modify>
+  <node id="1" version="1" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1" lat="41.98" lon="2.81"/>
+  <node id="2" version="1" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1" lat="41.998" lon="2.81"/>
+  <node id="3" version="2" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1" lat="41.98" lon="3.5"/>
+  <node id="4" version="1" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1" lat="10.0" lon="10.0"/>
+  <way id="10" version="1" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1">
+   <nd ref="1"/><nd ref="3"/>
+  </way>
+  <way id="11" version="1" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1">
+   <nd ref="4"/><nd ref="4"/>
+  </way>
+  <way id="12" version="2" changeset="1" timestamp="2017-05-27T21:19:43Z" user="u" uid="1">
+   <nd ref="99"/><nd ref="98"/>
+  </way>
+ </modify>
+</osmChange>
+"""
+        handle, filename = tempfile.mkstemp(suffix=".osc")
+        with os.fdopen(handle, "w") as f:
+            f.write(osc)
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        self.handler.cache_buffer = 1000
+        if sys.version_info[0] == 2:
+            self.handler.cache = mock.MagicMock()
+        else:
+            self.handler.cache = MagicMock()
+        self.handler.cache_enabled = True
+        self.handler.cache.get_pending_nodes.return_value = 0
+        self.handler.cache.get_pending_ways.return_value = 0
+        try:
+            self.handler.apply_file(filename, True)
+        finally:
+            os.unlink(filename)
+        stored = [row[0] for call in self.handler.cache.add_nodes.call_args_list for row in call[0][0]]
+        self.assertEqual(stored, [1, 2, 3])
+        self.assertEqual([call[0][0] for call in self.handler.cache.add_way.call_args_list], [10, 12])
+        self.assertEqual(self.handler.cache_skipped, {"node": 2, "way": 1})
+        self.assertEqual(self.handler.cache_referenced, 1)
+        self.assertTrue(3 in self.handler.modified_nodes)
+
+    def test_deleted(self):
+        """
+        Tests the deleted elements are placed with their previous version from the cache and the API
+        :return: None
+        """
+        osc = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <delete>
+  <node id="5" version="2" changeset="7" timestamp="2017-05-27T21:19:43Z" user="u" uid="1"/>
+  <node id="6" version="3" changeset="7" timestamp="2017-05-27T21:19:43Z" user="u" uid="1"/>
+  <node id="7" version="4" changeset="8" timestamp="2017-05-27T21:19:43Z" user="u" uid="1"/>
+  <way id="20" version="2" changeset="8" timestamp="2017-05-27T21:19:43Z" user="u" uid="1"/>
+  <relation id="30" version="5" changeset="9" timestamp="2017-05-27T21:19:43Z" user="u" uid="1"/>
+ </delete>
+</osmChange>
+"""
+        handle, filename = tempfile.mkstemp(suffix=".osc")
+        with os.fdopen(handle, "w") as f:
+            f.write(osc)
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        self.handler.set_tags("building", "building", ".*", ["node", "way", "relation"])
+        if sys.version_info[0] == 2:
+            self.handler.cache = mock.MagicMock()
+            self.handler.api = mock.MagicMock()
+        else:
+            self.handler.cache = MagicMock()
+            self.handler.api = MagicMock()
+        self.handler.cache_enabled = True
+        self.handler.cache.get_pending_nodes.return_value = 0
+        self.handler.cache.get_pending_ways.return_value = 0
+        previous = {
+            "node": {5: (1, {"building": "yes"}, [[41.98, 2.81]]), 6: (2, {"building": "yes"}, [[10.0, 10.0]])},
+            "way": {},
+            "relation": {30: (4, None, (10.0, 10.0, 11.0, 11.0))}
+        }
+        self.handler.cache.get_previous_versions.side_effect = lambda element_type, ids, versions: dict(
+            (identifier, previous[element_type][identifier]) for identifier in ids
+            if identifier in previous[element_type])
+        self.handler.cache.get_previous_locations.return_value = {}
+        self.handler.api.WaysGet.return_value = {20: {"id": 20, "version": 1, "nd": [7, 8], "tag": {"building": "yes"}}}
+        nodes = {"7v3": {"id": 7, "lat": 41.97, "lon": 2.80, "tag": {}}, "8": {"id": 8, "lat": 41.98, "lon": 2.81}}
+        self.handler.api.NodesGet.side_effect = lambda ids: dict(
+            (nodes[str(identifier)]["id"], nodes[str(identifier)]) for identifier in ids)
+        try:
+            self.handler.apply_file(filename, True)
+        finally:
+            os.unlink(filename)
+        self.assertEqual([element[0] for element in self.handler.deleted["node"]], [5, 6, 7])
+        self.handler.resolve_deleted()
+
+        self.assertEqual(self.handler.changeset[7]["nids"]["building"], [5])
+        self.assertEqual(self.handler.changeset[8]["wids"]["building"], [20])
+        self.assertFalse(9 in self.handler.changeset)
+        self.assertEqual(self.handler.api.WaysGet.call_args[0][0], ["20v1"])
+        # The deleted node of the way is read at its previous version
+        self.assertEqual(sorted(str(identifier) for identifier in self.handler.api.NodesGet.call_args[0][0]),
+                         ["7v3", "8"])
+        self.assertFalse(self.handler.api.RelationsGet.called)
+        self.assertEqual(self.handler.api.NodesGet.call_args_list[0][0][0], ["7v3"])
+        self.assertEqual(self.handler.deleted_resolved, {"cache": 3, "api": 2, "unresolved": 0})
+
+        self.handler.deleted_api_limit = 0
+        self.handler.deleted["way"].append((20, 2, 8, "u", 1, None, None))
+        self.handler.resolve_deleted()
+        self.assertEqual(self.handler.deleted_resolved["unresolved"], 1)
+
+    def test_area_preload(self):
+        """
+        Tests the elements of the preload and the ones written during the run
+        :return: None
+        """
+        if sys.version_info[0] == 2:
+            con = mock.MagicMock()
+            nodes, ways = mock.MagicMock(), mock.MagicMock()
+        else:
+            con = MagicMock()
+            nodes, ways = MagicMock(), MagicMock()
+        nodes.__iter__.return_value = iter([(1, 2, 41.98, 2.81, {"building": "yes"}, None),
+                                            (5, 1, 41.97, 2.80, None, None), (6, 1, 41.97, 2.81, None, [1, 2])])
+        ways.__iter__.return_value = iter([(10, 1, encode_linestring([(41.97, 2.80), (41.98, 2.81)]),
+                                            {"highway": "path"}, None, [5, 1])])
+        con.cursor.side_effect = [nodes, ways]
+        tags = TagDictionary()
+        tags.add(1, "building")
+        tags.add(2, "yes")
+        preloaded = AreaPreload()
+        preloaded.load(con, (41.9623, 2.7847, 41.9933, 2.8576), tags=tags)
+        self.assertEqual([call[1] for call in con.cursor.call_args_list],
+                         [{"name": "preload_nodes"}, {"name": "preload_ways"}])
+        self.assertEqual(preloaded.find_node(1), (1, 2, 41.98, 2.81, {"building": "yes"}))
+        self.assertIsNone(preloaded.find_node(1, 1))
+        self.assertIsNone(preloaded.find_node(3))
+        self.assertEqual(preloaded.find_node(5)[4], {})
+        self.assertEqual(preloaded.find_node(6)[4], {"building": "yes"})
+        self.assertEqual(preloaded.find_way(10), (10, 1, [[41.97, 2.80], [41.98, 2.81]], {"highway": "path"}, [5, 1]))
+        self.assertTrue(preloaded.size > 0)
+
+        preloaded.update_node(1, 3, 41.99, 2.82, {})
+        self.assertEqual(preloaded.find_node(1)[1], 3)
+        self.assertEqual(preloaded.find_node(1, 2)[1], 2)
+        self.assertTrue(preloaded.in_bbox("n", 5, (41.975, 2.805, 41.96, 2.79)))
+        self.assertFalse(preloaded.in_bbox("w", 10, (1, 1, 0, 0)))
+        self.assertIsNone(preloaded.in_bbox("w", 10, (41.979, 2.809, 41.971, 2.801)))
+        preloaded.forget_way(10)
+        self.assertIsNone(preloaded.find_way(10))
+
+    def test_reshaped_ways(self):
+        """
+        Tests the ways of the diff reshaped with the same tags are matched
+        :return: None
+        """
+
+        self.handler.set_tags("building", "building", ".*", ["way"], geometry=True)
+        if sys.version_info[0] == 2:
+            self.handler.cache = mock.MagicMock()
+        else:
+            self.handler.cache = MagicMock()
+        self.handler.cache_enabled = True
+        self.handler.cache.get_reshaped_ways.return_value = set([20])
+        self.handler.geometry_ways = [
+            (20, 3, "building", 100, "user", 5, (41.98, 2.81), None),
+            (21, 2, "building", 100, "user", 5, (41.98, 2.81), None)
+        ]
+        self.handler.check_way_geometries()
+        self.assertEqual(self.handler.changeset[100]["wids"]["building"], [20])
+        self.assertEqual(self.handler.geometry_ways, [])
+
+    def test_resolve_relation(self):
+        """
+        Tests the resolution of nested relations with a cycle
+        :return: None
+        """
+
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        if sys.version_info[0] == 2:
+            api = mock.MagicMock()
+        else:
+            api = MagicMock()
+        nodes = {
+            100: {"id": 100, "lat": 10.0, "lon": 10.0},
+            101: {"id": 101, "lat": 41.98268, "lon": 2.81372}
+        }
+        api.NodeGet.side_effect = lambda ref: nodes[ref]
+        api.RelationGet.return_value = {
+            "id": 2,
+            "version": 4,
+            "member": [
+                {"type": "node", "ref": 101, "role": ""},
+                {"type": "relation", "ref": 1, "role": ""}
+            ]
+        }
+        envelope, inside, cut = self.handler.resolve_relation(1, 3, [("n", 100), ("r", 2)], api)
+        self.assertTrue(inside)
+        self.assertEqual(cut, set())
+        self.assertEqual(envelope, (10.0, 2.81372, 41.98268, 10.0))
+        self.assertEqual(self.handler.relation_envelopes[1], (3, envelope, True))
+        self.assertFalse(2 in self.handler.relation_envelopes)
+
+        envelope, inside, cut = self.handler.resolve_relation(1, 3, [("n", 100), ("r", 2)], api)
+        self.assertTrue(inside)
+        self.assertEqual(api.RelationGet.call_count, 1)
+
+    def test_resolve_relation_cache(self):
+        """
+        Tests that the members on the cache are checked in batch
+        :return: None
+        """
+
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        if sys.version_info[0] == 2:
+            api = mock.MagicMock()
+            cache = mock.MagicMock()
+        else:
+            api = MagicMock()
+            cache = MagicMock()
+        cache.get_relation.return_value = None
+        cache.get_node.return_value = None
+        cache.get_extent.return_value = (set([100]), set([200]), (41.97, 2.80, 42.5, 3.5))
+        cache.nodes_in_bbox.return_value = set()
+        cache.ways_in_bbox.return_value = set([200])
+        api.NodeGet.return_value = {"id": 101, "lat": 50.0, "lon": 5.0}
+        self.handler.cache = cache
+        self.handler.cache_enabled = True
+        envelope, inside, cut = self.handler.resolve_relation(1, 1, [("n", 100), ("n", 101), ("w", 200)], api)
+        self.assertTrue(inside)
+        self.assertEqual(envelope, (41.97, 2.80, 50.0, 5.0))
+        api.NodeGet.assert_called_once_with(101)
+        self.assertEqual(api.WayFull.call_count, 0)
+        cache.add_relation.assert_called_once_with(1, 1, envelope, True)
+
+    def test_resolve_relation_cached_inside(self):
+        """
+        Tests that a relation cached inside the bbox is not walked again
+        :return: None
+        """
+
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        if sys.version_info[0] == 2:
+            api = mock.MagicMock()
+            cache = mock.MagicMock()
+        else:
+            api = MagicMock()
+            cache = MagicMock()
+        envelope = (41.97, 2.80, 42.5, 3.5)
+        cache.get_relation.return_value = {"data": {"id": 1, "version": 1, "envelope": envelope, "inside": True}}
+        self.handler.cache = cache
+        self.handler.cache_enabled = True
+        self.assertEqual(self.handler.resolve_relation(1, 1, None, api), (envelope, True, set()))
+        self.assertEqual(api.RelationGet.call_count, 0)
+        self.assertEqual(cache.get_extent.call_count, 0)
+        self.assertEqual(cache.add_relation.call_count, 0)
+        self.assertEqual(self.handler.relation_envelopes[1], (1, envelope, True))
+
+    def test_envelope_in_bbox(self):
+        """
+        Tests the intersection of envelopes with the bounding box
+        :return: None
+        """
+
+        self.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        self.assertTrue(self.handler.envelope_in_bbox((40.0, 2.0, 42.5, 3.0)))
+        self.assertTrue(self.handler.envelope_in_bbox((41.97, 2.80, 41.98, 2.81)))
+        self.assertFalse(self.handler.envelope_in_bbox((10.0, 10.0, 11.0, 11.0)))
+        self.assertFalse(self.handler.envelope_in_bbox(None))
+
     def test_set_tags(self):
         """
         Test set_tags of handler
@@ -267,6 +885,28 @@ class ChangesWithinTest(unittest.TestCase):
         """
         self.cw = ChangeWithin()
 
+    def test_lazy_templates(self):
+        """
+        Tests that the templates are compiled on first use
+        :return: None
+        """
+        self.assertEqual(self.cw.templates, {})
+        self.assertIsNotNone(self.cw.html_tmpl)
+        self.assertTrue("html" in self.cw.templates)
+        self.assertFalse("text" in self.cw.templates)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Lazy package attributes need python 3.7")
+    def test_lazy_imports(self):
+        """
+        Tests that the command line doesn't load the heavy dependencies
+        :return: None
+        """
+        code = "import sys, changewithin.cli; print(','.join(sorted(sys.modules)))"
+        output = subprocess.check_output([sys.executable, "-c", code]).decode("utf-8")
+        modules = output.strip().split(",")
+        for module in ["jinja2", "psycopg2", "osmapi", "raven", "numpy", "requests", "changewithin.changewithin"]:
+            self.assertFalse(module in modules, module)
+
     def test_osc1(self):
         """
         Tests load of test1.osc
@@ -335,9 +975,9 @@ class ChangesWithinTest(unittest.TestCase):
         self.assertEqual(len(set(self.cw.stats["building"])), len(self.cw.stats["building"]))
         self.assertTrue(48595327 in self.cw.changesets)
 
-    def test_relation(self):
+    def test_osc1_batch(self):
         """
-        Tests load of test1.osc
+        Tests that the batch and the node by node filters find the same changes
         :return: None
         """
         conf = {
@@ -352,25 +992,1310 @@ class ChangesWithinTest(unittest.TestCase):
                 "housenumber": {
                     "tags": "addr:housenumber=.*",
                     "type": "way,node"
-                },
-                "building": {
-                    "tags": "building=public",
-                    "type": "way,node"
                 }
             },
             "url_locales": "locales"
         }
+        self.cw.load_config(conf)
         self.cw.conf = conf
+        self.cw.process_file("test/test1.osc")
+        single = ChangeWithin()
+        single.handler.node_batch_size = 0
+        single.load_config(conf)
+        single.conf = conf
+        single.process_file("test/test1.osc")
+        self.assertTrue(4880791637 in self.cw.changesets[49033608]["nids"]["highway"])
+        self.assertEqual(self.cw.changesets, single.changesets)
+
+    def test_fetch(self):
+        """
+        Tests the diff fetched on the background is processed and a failed fetch stops the run
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway$=.*",
+                    'type': 'node,way'
+                }
+            },
+            "url_locales": "locales"
+        }
         self.cw.load_config(conf)
-        self.cw.handler.set_bbox('41.9933', '2.8576', '41.9623', '2.7847')
-        self.assertEqual(self.cw.handler.north, 41.9933)
-        self.assertEqual(self.cw.handler.east, 2.8576)
-        self.assertEqual(self.cw.handler.south, 41.9623)
-        self.assertEqual(self.cw.handler.west, 2.7847)
-        self.cw.handler.set_tags("all", ".*", ".*", ["node", "way"])
-        self.cw.process_file("test/test_rel.osc")
-        self.assertTrue(41928815 in self.cw.changesets)
-        self.assertTrue(343535 in self.cw.changesets[41928815]["rids"]["all"])
+        self.cw.conf = conf
+        self.cw.mirror = MagicMock()
+        self.cw.mirror.state.return_value = "1234"
+        self.cw.mirror.diff.return_value = "test/test1.osc"
+        self.cw.process_file()
+        self.assertEqual(self.cw.osc_file, "test/test1.osc")
+        self.assertEqual(self.cw.pipeline_stats[0]["stage"], "fetch")
+        self.assertTrue(49033608 in self.cw.changesets)
+        self.cw.mirror.diff.side_effect = IOError("unavailable")
+        self.assertRaises(IOError, self.cw.process_file)
+
+    def test_close(self):
+        """
+        Tests the instance closes the cache it created and leaves a shared one open
+        :return: None
+        """
+        shared = ChangeWithin()
+        shared.handler.set_cache(None, None, None, None, cache=MagicMock())
+        shared.close()
+        self.assertEqual(shared.handler.cache.close.call_count, 0)
+        owner = ChangeWithin()
+        owner.handler.set_cache(None, None, None, None, cache=MagicMock())
+        owner.owns_cache = True
+        owner.notifier = MagicMock()
+        owner.notifier.close.side_effect = IOError("unavailable")
+        self.assertRaises(IOError, owner.close)
+        self.assertEqual(owner.handler.cache.close.call_count, 1)
+
+    def test_node_batch_cache_only(self):
+        """
+        Tests the nodes are only batched for the cache
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        handler.batch_node = MagicMock()
+        handler.apply_file("test/test1.osc")
+        self.assertEqual(handler.batch_node.call_count, 0)
+        self.assertTrue(handler.num_nodes > 0)
+
+    def test_prefilter(self):
+        """
+        Tests the objects dropped by the reader don't change the matched changes
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway$=.*",
+                    'type': 'node,way'
+                }
+            },
+            "url_locales": "locales"
+        }
+        self.cw.load_config(conf)
+        self.cw.conf = conf
+        self.assertEqual(len(self.cw.handler.prefilters()), 2)
+        self.cw.process_file("test/test1.osc")
+        plain = ChangeWithin()
+        plain.handler.prefilter = False
+        plain.load_config(conf)
+        plain.conf = conf
+        self.assertEqual(plain.handler.prefilters(), [])
+        plain.process_file("test/test1.osc")
+        self.assertEqual(self.cw.changesets, plain.changesets)
+        self.assertTrue(self.cw.handler.num_nodes < plain.handler.num_nodes)
+        self.assertEqual(literal_key("^addr:housenumber$"), "addr:housenumber")
+        self.assertIsNone(literal_key("building"))
+
+    def test_extract(self):
+        """
+        Tests the objects inside the area are written to a clipped change file
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway$=.*",
+                    'type': 'node,way'
+                }
+            },
+            "url_locales": "locales"
+        }
+        handle, path = tempfile.mkstemp(suffix=".osc.gz")
+        os.close(handle)
+        self.cw.load_config(conf)
+        self.cw.conf = conf
+        self.cw.add_extract(path)
+        self.cw.process_file("test/test1.osc")
+        extract = self.cw.handler.extract
+
+        written = {"n": set(), "w": set(), "r": set()}
+        refs = set()
+        for obj in osmium.FileProcessor(path):
+            written[obj.type_str()].add(obj.id)
+            if obj.type_str() == "w":
+                refs.update(node.ref for node in obj.nodes)
+        os.unlink(path)
+        self.assertTrue(4880791637 in written["n"])
+        self.assertTrue(len(written["w"]) > 0)
+        self.assertEqual(written["w"], extract.ways)
+        self.assertTrue(written["n"] <= extract.nodes)
+        self.assertTrue(len(written["n"] - refs) > 0)
+
+    def test_relation(self):
+        """
+        Tests load of test1.osc
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway=.*",
+                    'type': 'node,way'
+                },
+                "housenumber": {
+                    "tags": "addr:housenumber=.*",
+                    "type": "way,node"
+                },
+                "building": {
+                    "tags": "building=public",
+                    "type": "way,node"
+                }
+            },
+            "url_locales": "locales"
+        }
+        self.cw.conf = conf
+        self.cw.load_config(conf)
+        self.cw.handler.set_bbox('41.9933', '2.8576', '41.9623', '2.7847')
+        self.assertEqual(self.cw.handler.north, 41.9933)
+        self.assertEqual(self.cw.handler.east, 2.8576)
+        self.assertEqual(self.cw.handler.south, 41.9623)
+        self.assertEqual(self.cw.handler.west, 2.7847)
+        self.cw.handler.set_tags("all", ".*", ".*", ["node", "way"])
+        self.cw.process_file("test/test_rel.osc")
+        self.assertTrue(41928815 in self.cw.changesets)
+        self.assertTrue(343535 in self.cw.changesets[41928815]["rids"]["all"])
+
+
+
+class SpillTest(unittest.TestCase):
+    """
+    Unittest for the bounded memory mode
+    """
+
+    def setUp(self):
+        """
+        Writes a synthetic diff with many matched nodes
+        """
+        handle, self.path = tempfile.mkstemp(suffix=".osc")
+        with os.fdopen(handle, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <create>\n')
+            for identifier in range(1, 5001):
+                f.write('  <node id="{0}" version="1" changeset="{1}" timestamp="2017-05-27T21:19:43Z" '
+                        'user="user{2}" uid="{2}" lat="41.98" lon="2.81">\n'.format(
+                            identifier, identifier * 7919 % 1500, identifier % 50))
+                f.write('   <tag k="building" v="yes"/>\n')
+                if identifier % 3 == 0:
+                    f.write('   <tag k="addr:housenumber" v="{0}"/>\n'.format(identifier))
+                f.write('  </node>\n')
+            f.write(' </create>\n</osmChange>\n')
+        self.conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'building': {
+                    'tags': "building=.*",
+                    'type': 'node,way'
+                },
+                "housenumber": {
+                    "tags": "addr:housenumber=.*",
+                    "type": "way,node"
+                }
+            },
+            "url_locales": "locales"
+        }
+
+    def tearDown(self):
+        """
+        Removes the diff
+        """
+        os.unlink(self.path)
+
+    def test_small_budget(self):
+        """
+        Tests a diff processed under a small memory budget matches the same changes
+        :return: None
+        """
+        memory = ChangeWithin()
+        memory.load_config(self.conf)
+        memory.process_file(self.path)
+
+        conf = dict(self.conf, memory={"budget": "0.02"})
+        spill = ChangeWithin()
+        spill.load_config(conf)
+        spill.process_file(self.path)
+
+        budget = spill.handler.spill.budget
+        self.assertTrue(spill.handler.spill.spills > 10)
+        self.assertTrue(spill.handler.spill.max_size < budget + 1024)
+        self.assertIsNone(spill.handler.spill.path)
+        self.assertEqual(spill.stats["total"], 1500)
+        self.assertEqual(spill.stats["total"], memory.stats["total"])
+        self.assertEqual(spill.stats["building"], len(memory.stats["building"]))
+        self.assertEqual(spill.stats["housenumber"], len(memory.stats["housenumber"]))
+        self.assertEqual(len(spill.changesets), 1000)
+        for changeset, data in spill.changesets.items():
+            self.assertEqual(data, memory.changesets[changeset])
+
+    def test_merge_runs(self):
+        """
+        Tests the runs are merged when there are too many
+        :return: None
+        """
+        spill = ChangeSpill(1, max_runs=4)
+        for identifier in range(10):
+            spill.add(identifier % 3, "user", 1, "nids", "building", identifier)
+        self.assertTrue(len(spill.runs) < 4)
+        changesets = list(spill.changesets())
+        self.assertEqual([changeset["changeset"] for changeset in changesets], [0, 1, 2])
+        self.assertEqual(changesets[0]["nids"]["building"], [0, 3, 6, 9])
+        spill.close()
+
+
+class ExportTest(unittest.TestCase):
+    """
+    Unittest for the exporters
+    """
+
+    def setUp(self):
+        """
+        Creates the output file
+        """
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.change = {
+            "changeset": 49033608,
+            "user": "5R-MFT",
+            "uid": 3417876,
+            "type": "node",
+            "id": 4880791637,
+            "version": 1,
+            "rule": "highway",
+            "lat": 41.9820449,
+            "lon": 2.8229217
+        }
+
+    def tearDown(self):
+        """
+        Removes the output file
+        """
+        os.unlink(self.path)
+
+    def test_jsonl(self):
+        """
+        Tests the JSON Lines exporter
+        :return: None
+        """
+        exporter = get_exporter("jsonl", self.path)
+        exporter.write(self.change)
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.readline()), self.change)
+        exporter.close()
+
+    def test_csv(self):
+        """
+        Tests the CSV exporter
+        :return: None
+        """
+        exporter = get_exporter("csv", self.path)
+        exporter.write(self.change)
+        exporter.close()
+        with open(self.path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["id"], "4880791637")
+        self.assertEqual(rows[0]["rule"], "highway")
+
+    def test_csv_unicode(self):
+        """
+        Tests the CSV exporter with text out of ASCII, written as str by the csv module of Python 2
+        :return: None
+        """
+        self.change["user"] = u"N\u00faria"
+        self.change["timestamp"] = u"2017-05-27T21:19:43Z"
+        exporter = get_exporter("csv", self.path)
+        exporter.write(self.change)
+        exporter.close()
+        with io.open(self.path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(u"N\u00faria" in lines[1])
+        self.assertTrue(lines[1].endswith(u"2017-05-27T21:19:43Z"))
+
+    def test_geojsonseq(self):
+        """
+        Tests the GeoJSON sequence exporter
+        :return: None
+        """
+        exporter = get_exporter("geojsonseq", self.path)
+        exporter.write(self.change)
+        exporter.close()
+        with open(self.path) as f:
+            data = f.read()
+        self.assertTrue(data.startswith("\x1e"))
+        feature = json.loads(data[1:])
+        self.assertEqual(feature["geometry"]["coordinates"], [2.8229217, 41.9820449])
+        self.assertEqual(feature["properties"]["changeset"], 49033608)
+
+    def test_result_writer(self):
+        """
+        Tests the changes are stored in batches in the results table
+        :return: None
+        """
+        cache = MagicMock()
+        cache.start_run.return_value = 3
+        writer = ResultWriter(cache, "test1.osc", batch_size=2)
+        for indx in range(3):
+            writer.write(dict(self.change, id=indx))
+        self.assertEqual(cache.add_results.call_count, 1)
+        writer.close()
+        self.assertEqual(cache.add_results.call_count, 2)
+        self.assertEqual(cache.add_results.call_args[0], (3, [dict(self.change, id=2)]))
+        cache.commit.assert_called_once_with()
+
+    def test_unknown_format(self):
+        """
+        Tests an unknown export format
+        :return: None
+        """
+        self.assertRaises(ValueError, get_exporter, "xml", self.path)
+
+    def test_process_file(self):
+        """
+        Tests the export of the changes of test1.osc without keeping them in memory
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway=.*",
+                    'type': 'node,way'
+                }
+            }
+        }
+        cw = ChangeWithin()
+        cw.load_config(conf)
+        cw.add_export("jsonl", self.path)
+        cw.handler.keep_changesets = False
+        cw.process_file("test/test1.osc")
+        with open(self.path) as f:
+            changes = [json.loads(line) for line in f]
+        self.assertEqual(cw.changesets, {})
+        self.assertTrue(4880791637 in [change["id"] for change in changes if change["type"] == "node"])
+        self.assertTrue(496371206 in [change["id"] for change in changes if change["type"] == "way"])
+
+
+class ProfileTest(unittest.TestCase):
+    """
+    Unittest for the profiler
+    """
+
+    def test_profile_file(self):
+        """
+        Tests the profile of test1.osc
+        :return: None
+        """
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway=.*",
+                    'type': 'node,way'
+                }
+            }
+        }
+        cw = ChangeWithin()
+        cw.load_config(conf)
+        cw.lookup_workers = 2
+        cw.handler.start_lookups = MagicMock()
+        output = os.path.join(tempfile.mkdtemp(), "test.prof")
+        report = profile_file(cw, "test/test1.osc", output, 5)
+        self.assertFalse(cw.handler.start_lookups.called)
+        self.assertEqual(cw.lookup_workers, 2)
+        self.assertTrue("Callback cost by entity type" in report)
+        self.assertTrue(os.path.exists(output))
+        if sys.version_info[0] > 2:
+            self.assertTrue("Top allocations" in report)
+            self.assertTrue(os.path.exists(output + ".tracemalloc"))
+
+
+class ErrorsTest(unittest.TestCase):
+    """
+    Unittest for the error aggregation
+    """
+
+    def setUp(self):
+        """
+        Initialization
+        """
+        self.errors = ErrorAggregator(max_error_rate=0.5, min_elements=4)
+        if sys.version_info[0] == 2:
+            self.errors.client = mock.MagicMock()
+        else:
+            self.errors.client = MagicMock()
+
+    def record_error(self, exception):
+        """
+        Records an exception
+        """
+        try:
+            raise exception
+        except Exception:
+            self.errors.record("node", sys.exc_info())
+
+    def test_group(self):
+        """
+        Tests the grouping of errors by type and location
+        :return: None
+        """
+        for x in range(5):
+            self.record_error(ValueError("value"))
+        self.record_error(KeyError("key"))
+        summary = self.errors.summary()
+        self.assertEqual(len(summary), 2)
+        self.assertEqual(summary[0]["type"], "ValueError")
+        self.assertEqual(summary[0]["count"], 5)
+        self.assertEqual(summary[1]["count"], 1)
+
+    def test_report(self):
+        """
+        Tests that the report is a single message
+        :return: None
+        """
+        for x in range(100):
+            self.record_error(ValueError("value"))
+        self.errors.report()
+        self.assertEqual(self.errors.client.captureMessage.call_count, 1)
+        self.assertEqual(self.errors.client.captureException.call_count, 0)
+        self.assertEqual(self.errors.summary(), [])
+        self.errors.report()
+        self.assertEqual(self.errors.client.captureMessage.call_count, 1)
+
+    def test_exceeded(self):
+        """
+        Tests the error rate limit
+        :return: None
+        """
+        self.record_error(ValueError("value"))
+        self.assertFalse(self.errors.exceeded(1))
+        self.record_error(ValueError("value"))
+        self.assertFalse(self.errors.exceeded(4))
+        self.record_error(ValueError("value"))
+        self.assertTrue(self.errors.exceeded(4))
+        self.assertFalse(self.errors.exceeded(6))
+        self.errors.max_error_rate = None
+        self.assertFalse(self.errors.exceeded(4))
+
+    def test_handler_abort(self):
+        """
+        Tests that the handler aborts when the error rate is exceeded
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.errors = self.errors
+        # The failed nodes are counted once, as handled elements
+        handler.num_nodes = 4
+        for x in range(2):
+            try:
+                raise ValueError("value")
+            except ValueError:
+                handler.report_error("node")
+        try:
+            raise ValueError("value")
+        except ValueError:
+            self.assertRaises(ErrorRateExceeded, handler.report_error, "node")
+
+    def test_failed_batch(self):
+        """
+        Tests that a batch of nodes lost for the cache counts all its nodes in the error rate
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.errors = self.errors
+        handler.set_cache(None, None, None, None, cache=MagicMock())
+        handler.cache.add_nodes.side_effect = psycopg2.OperationalError("server closed the connection")
+        handler.cache_area = MagicMock(return_value=None)
+        for identifier in range(1, 5):
+            handler.node_batch.add(identifier, 1, 10.0, 10.0, (1, "user", 1, False, {}, None))
+        self.assertRaises(ErrorRateExceeded, handler.flush_nodes)
+        self.assertEqual(self.errors.failed, 4)
+        self.assertEqual(self.errors.summary()[0]["count"], 4)
+
+    def test_failed_nodes_counted_once(self):
+        """
+        Tests that the failed nodes of a batch are counted once in the error rate
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.errors = self.errors
+        handler.north, handler.east, handler.south, handler.west = 42.0, 3.0, 41.0, 2.0
+        for identifier in range(1, 5):
+            handler.node_batch.add(identifier, 2, 41.97, 2.82,
+                                   (1, "user", 1, False, {"highway": "crossing"}, None))
+        handler.match_node = MagicMock(side_effect=[ValueError("value"), None, ValueError("value"),
+                                                    ValueError("value")])
+        # The third failure is over the rate of 0.5 of the 4 nodes
+        self.assertRaises(ErrorRateExceeded, handler.flush_nodes)
+        self.assertEqual(handler.num_nodes, 4)
+        self.assertEqual(self.errors.failed, 3)
+
+
+class BackfillTest(unittest.TestCase):
+    """
+    Unittest for the parallel backfill of a range of days
+    """
+
+    def setUp(self):
+        """
+        Starts a local replication server with a daily diff from May 24 to
+        May 28 of 2017
+        """
+        self.server = HTTPServer(("127.0.0.1", 0), ReplicationRequestHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        diff = io.BytesIO()
+        with open("test/test1.osc", "rb") as f:
+            with gzip.GzipFile(fileobj=diff, mode="wb") as out:
+                out.write(f.read())
+        self.server.files = {}
+        for sequence in range(6):
+            state = "#\nsequenceNumber={0}\ntimestamp=2017-05-{1:02d}T00\\:00\\:00Z\n".format(
+                sequence, 24 + sequence).encode("utf-8")
+            self.server.files["/000/000/{0:03d}.state.txt".format(sequence)] = state
+            self.server.files["/000/000/{0:03d}.osc.gz".format(sequence)] = diff.getvalue()
+        self.server.files["/state.txt"] = self.server.files["/000/000/005.state.txt"]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Stops the server and removes the reports
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_sequences(self):
+        """
+        Tests the sequences of a range of days are found from the states
+        :return: None
+        """
+        from datetime import date
+
+        index = SequenceIndex(self.url)
+        self.assertEqual(index.sequences(date(2017, 5, 25), date(2017, 5, 26)), [2, 3])
+        self.assertEqual(index.day(2), date(2017, 5, 25))
+        self.assertEqual(index.sequences(date(2017, 6, 1), date(2017, 6, 2)), [])
+
+    def test_backfill(self):
+        """
+        Tests the reports of each day and the summary of the period
+        :return: None
+        """
+        from datetime import date
+
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway$=.*",
+                    'type': 'node,way'
+                }
+            },
+            'replication': {
+                'url': self.url
+            },
+            "url_locales": "locales"
+        }
+        cw = ChangeWithin()
+        cw.load_config(conf)
+        reports = backfill(cw, date(2017, 5, 25), date(2017, 5, 26), 2, self.path)
+        self.assertEqual([os.path.basename(report) for report in reports], [
+            "osm_change_report_2017-05-25.html",
+            "osm_change_report_2017-05-26.html",
+            "osm_change_report_2017-05-25_2017-05-26.html"
+        ])
+        for report in reports:
+            with io.open(report, encoding="utf-8") as f:
+                self.assertTrue("49033608" in f.read())
+        self.assertTrue("/000/000/002.osc.gz" in self.server.requests)
+        self.assertTrue("/000/000/003.osc.gz" in self.server.requests)
+        self.assertFalse("/000/000/004.osc.gz" in self.server.requests)
+
+    def test_backfill_results(self):
+        """
+        Tests that the changes matched by the workers are stored from the main process
+        :return: None
+        """
+        from datetime import date
+
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'highway': {
+                    'tags': "highway$=.*",
+                    'type': 'node,way'
+                }
+            },
+            'pipeline': {
+                'lookup_workers': '4'
+            },
+            'replication': {
+                'url': self.url
+            },
+            "url_locales": "locales"
+        }
+        cw = ChangeWithin()
+        cw.load_config(conf)
+        cache = MagicMock()
+        cache.start_run.return_value = 7
+        cw.handler.set_cache(None, None, None, None, cache=cache)
+        cw.cache_file = MagicMock()
+        backfill(cw, date(2017, 5, 25), date(2017, 5, 25), 2, self.path)
+        self.assertEqual(cw.cache_file.call_count, 1)
+        self.assertEqual(cache.start_run.call_count, 1)
+        self.assertTrue(cache.start_run.call_args[0][0].endswith("/000/000/002.osc.gz"))
+        changes = [change for call in cache.add_results.call_args_list for change in call[0][1]]
+        self.assertTrue(changes)
+        self.assertTrue(all(call[0][0] == 7 for call in cache.add_results.call_args_list))
+        self.assertTrue(49033608 in [change["changeset"] for change in changes])
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """
+    Receives the changes of NotifyTest
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        time.sleep(self.server.delay)
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        if status == 200:
+            self.server.posts.append(json.loads(body.decode("utf-8"))["changes"])
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class NotifyTest(unittest.TestCase):
+    """
+    Unittest for the webhook notifications
+    """
+
+    def setUp(self):
+        """
+        Starts a local webhook receiver
+        """
+        self.server = HTTPServer(("127.0.0.1", 0), WebhookRequestHandler)
+        self.server.posts = []
+        self.server.responses = []
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/hook".format(self.server.server_address[1])
+        self.changes = [{"changeset": 1, "type": "node", "id": identifier, "rule": "building"}
+                        for identifier in range(5)]
+
+    def tearDown(self):
+        """
+        Stops the receiver
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batching(self):
+        """
+        Tests the changes of the window are sent in a single request
+        :return: None
+        """
+        endpoint = WebhookEndpoint(self.url, window=0.3)
+        for change in self.changes:
+            endpoint.put(change)
+        endpoint.close(5)
+        self.assertEqual(self.server.posts, [self.changes])
+        self.assertEqual(endpoint.requests, 1)
+        self.assertEqual(endpoint.sent, 5)
+
+    def test_retries(self):
+        """
+        Tests the server errors are retried and the client errors are not
+        :return: None
+        """
+        self.server.responses = [500, 503]
+        endpoint = WebhookEndpoint(self.url, window=0.1, backoff=0.01)
+        for change in self.changes:
+            endpoint.put(change)
+        endpoint.close(5)
+        self.assertEqual(self.server.posts, [self.changes])
+        self.assertEqual(endpoint.requests, 3)
+
+        self.server.responses = [400]
+        endpoint = WebhookEndpoint(self.url, window=0.1, backoff=0.01)
+        endpoint.put(self.changes[0])
+        endpoint.close(5)
+        self.assertEqual(endpoint.requests, 1)
+        self.assertEqual(endpoint.failed, 1)
+
+    def test_backpressure(self):
+        """
+        Tests a slow receiver drops changes instead of blocking
+        :return: None
+        """
+        self.server.delay = 0.5
+        endpoint = WebhookEndpoint(self.url, window=0, batch_size=1, queue_size=2)
+        start = time.time()
+        for identifier in range(50):
+            endpoint.put({"changeset": 1, "type": "node", "id": identifier, "rule": "building"})
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertTrue(endpoint.dropped > 0)
+        self.assertEqual(endpoint.queued + endpoint.dropped, 50)
+        endpoint.close(5)
+        self.assertEqual(endpoint.sent, endpoint.queued)
+
+    def test_stream(self):
+        """
+        Tests the new diffs of the replication are pushed to the webhook
+        :return: None
+        """
+        replication = HTTPServer(("127.0.0.1", 0), ReplicationRequestHandler)
+        replication.requests = []
+        replication.delay = 0
+        diff = io.BytesIO()
+        with open("test/test1.osc", "rb") as f:
+            with gzip.GzipFile(fileobj=diff, mode="wb") as out:
+                out.write(f.read())
+        replication.files = {
+            "/state.txt": b"#\nsequenceNumber=5\ntimestamp=2017-05-29T00\\:00\\:00Z\n",
+            "/000/000/005.osc.gz": diff.getvalue()
+        }
+        thread = threading.Thread(target=replication.serve_forever)
+        thread.daemon = True
+        thread.start()
+        handle, state_file = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(state_file, "w") as f:
+                f.write("4\n")
+            conf = {
+                'area': {
+                    'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+                },
+                'tags': {
+                    'highway': {
+                        'tags': "highway$=.*",
+                        'type': 'node,way'
+                    }
+                },
+                'replication': {
+                    'url': "http://127.0.0.1:{}".format(replication.server_address[1])
+                },
+                'webhooks': {
+                    'urls': self.url,
+                    'window': '0.1'
+                },
+                "url_locales": "locales"
+            }
+            self.assertEqual(stream(conf, state_file=state_file, once=True), 5)
+            with open(state_file) as f:
+                self.assertEqual(f.read().strip(), "5")
+            changes = [change for post in self.server.posts for change in post]
+            self.assertTrue(changes)
+            self.assertTrue(49033608 in [change["changeset"] for change in changes])
+            self.assertEqual(replication.requests, ["/state.txt", "/000/000/005.osc.gz"])
+        finally:
+            replication.shutdown()
+            replication.server_close()
+            os.unlink(state_file)
+
+
+class WkbTest(unittest.TestCase):
+    """
+    Unittest for the binary geometries of the cache
+    """
+
+    def test_linestring(self):
+        """
+        Tests a line is written with the longitude as x and read back as latitude and longitude
+        :return: None
+        """
+        import struct
+
+        points = [(41.98, 2.81), (41.97, 2.80), (41.96, 2.79)]
+        data = encode_linestring(points)
+        self.assertEqual(struct.unpack("<BII", data[:9]), (1, 2, 3))
+        self.assertEqual(struct.unpack("<2d", data[9:25]), (2.81, 41.98))
+        self.assertEqual(decode_linestring(data).tolist(), [list(point) for point in points])
+
+    def test_ewkb(self):
+        """
+        Tests a big endian line with SRID is decoded
+        :return: None
+        """
+        import struct
+
+        data = struct.pack(">BIII4d", 0, 2 | 0x20000000, 4326, 2, 2.81, 41.98, 2.80, 41.97)
+        self.assertEqual(decode_linestring(data).tolist(), [[41.98, 2.81], [41.97, 2.80]])
+        self.assertRaises(ValueError, decode_linestring, struct.pack("<BI2d", 1, 1, 2.81, 41.98))
+
+
+class TagDictionaryTest(unittest.TestCase):
+    """
+    Unittest for the dictionary of the cached tags
+    """
+
+    def test_encode(self):
+        """
+        Tests the tags are encoded sorted by key with a single query for the missing texts
+        :return: None
+        """
+        if sys.version_info[0] == 2:
+            con = mock.MagicMock()
+        else:
+            con = MagicMock()
+        con.cursor.return_value.fetchall.return_value = [(3, "name"), (4, "Girona")]
+        tags = TagDictionary()
+        tags.add(1, "building")
+        tags.add(2, "yes")
+        self.assertEqual(tags.encode_many(con, [{"name": "Girona", "building": "yes"}, {"building": "yes"}, {}]),
+                         [[1, 2, 3, 4], [1, 2], []])
+        self.assertEqual(con.cursor.return_value.execute.call_count, 1)
+        self.assertEqual(sorted(con.cursor.return_value.execute.call_args[0][1][0]), ["Girona", "name"])
+        self.assertEqual(tags.encode(con, {"building": "yes"}), [1, 2])
+        self.assertEqual(con.cursor.return_value.execute.call_count, 1)
+
+    def test_decode(self):
+        """
+        Tests the decoded tags share the texts of the dictionary
+        :return: None
+        """
+        if sys.version_info[0] == 2:
+            con = mock.MagicMock()
+        else:
+            con = MagicMock()
+        con.cursor.return_value.fetchall.return_value = [(1, "building"), (2, "yes")]
+        tags = TagDictionary()
+        first, second = tags.decode_many(con, [[1, 2], [1, 2]])
+        self.assertEqual(first, {"building": "yes"})
+        self.assertEqual(sorted(con.cursor.return_value.execute.call_args[0][1][0]), [1, 2])
+        self.assertTrue(list(first.keys())[0] is list(second.keys())[0])
+        self.assertEqual(tags.decode(con, []), {})
+        self.assertEqual(con.cursor.return_value.execute.call_count, 1)
+
+
+class PipelineTest(unittest.TestCase):
+    """
+    Unittest for the stages of the pipeline
+    """
+
+    def test_lookup_pool(self):
+        """
+        Tests the lookups run on the workers and their results are handled on the producer thread
+        :return: None
+        """
+        import threading
+
+        def lookup(value):
+            time.sleep(0.01)
+            if value == 7:
+                raise ValueError(value)
+            return value * 2
+
+        results = {}
+        failed = []
+        threads = set()
+
+        def handler(value):
+            def handle(result, exc_info):
+                threads.add(threading.current_thread())
+                if exc_info is not None:
+                    failed.append(value)
+                else:
+                    results[value] = result
+            return handle
+
+        pool = LookupPool(lookup, workers=4, queue_size=2)
+        for value in range(20):
+            pool.submit((value,), handler(value))
+        pool.close()
+        self.assertEqual(results, dict((value, value * 2) for value in range(20) if value != 7))
+        self.assertEqual(failed, [7])
+        self.assertEqual(threads, set([threading.current_thread()]))
+        stats = pool.stats.summary()
+        self.assertEqual(stats["items"], 20)
+        self.assertTrue(stats["depth_max"] <= 2)
+        self.assertTrue(stats["blocked"] > 0)
+        self.assertEqual(pool.handled.summary()["items"], 20)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+
+    def test_lookup_pool_failure(self):
+        """
+        Tests the workers are stopped when a result handler raises and the queued tasks are discarded
+        :return: None
+        """
+        done = []
+
+        def lookup(value):
+            time.sleep(0.01)
+            done.append(value)
+            return value
+
+        def handle(result, exc_info):
+            raise ErrorRateExceeded("too many errors")
+
+        pool = LookupPool(lookup, workers=1, queue_size=100)
+        for value in range(50):
+            pool.submit((value,), handle)
+        self.assertRaises(ErrorRateExceeded, pool.close)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+        self.assertTrue(len(done) < 50)
+
+        pool = LookupPool(lookup, workers=2, queue_size=100)
+        for value in range(50):
+            pool.submit((value,), handle)
+        pool.close(discard=True)
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+
+    def test_check_tags(self):
+        """
+        Tests the previous tags are checked on the lookup workers
+        :return: None
+        """
+        handler = ChangeHandler()
+        if sys.version_info[0] == 2:
+            handler.has_tag_changed = mock.MagicMock(side_effect=lambda gid, tags, key, version, elem: gid % 2 == 1)
+        else:
+            handler.has_tag_changed = MagicMock(side_effect=lambda gid, tags, key, version, elem: gid % 2 == 1)
+        handler.set_tags("building", "building", ".*", ["node"])
+        handler.start_lookups(workers=2, queue_size=1)
+        for identifier in range(1, 11):
+            handler.match_node(identifier, 2, 100, "u", 1, False, {"building": "yes"}, (41.98, 2.81))
+        self.assertTrue(handler.lookups is not None)
+        stats = handler.finish_lookups()
+        self.assertIsNone(handler.lookups)
+        self.assertEqual(sorted(handler.changeset[100]["nids"]["building"]), [1, 3, 5, 7, 9])
+        self.assertEqual([stage["stage"] for stage in stats], ["lookup", "aggregate"])
+        self.assertEqual(stats[0]["items"], 10)
+
+    def test_check_tags_pending(self):
+        """
+        Tests the nodes written by the run are committed before a check is queued
+        :return: None
+        """
+        handler = ChangeHandler()
+        if sys.version_info[0] == 2:
+            handler.cache = mock.MagicMock()
+        else:
+            handler.cache = MagicMock()
+        handler.cache_enabled = True
+        handler.cache.get_pending_nodes.return_value = 0
+        handler.cache.get_node.return_value = {"data": {"tag": {"building": "yes"}}}
+        handler.set_tags("building", "building", ".*", ["node"])
+        handler.start_lookups(workers=1, queue_size=1)
+        handler.check_tags("node", 1, {"building": "yes"}, handler.tags["building"]["key_re"], 2, lambda: None)
+        self.assertEqual(handler.cache.commit.call_count, 0)
+        handler.cache.get_pending_nodes.return_value = 5
+        handler.check_tags("node", 2, {"building": "yes"}, handler.tags["building"]["key_re"], 2, lambda: None)
+        self.assertEqual(handler.cache.commit.call_count, 1)
+        handler.finish_lookups()
+        self.assertEqual(handler.cache.release.call_count, 1)
+
+    def test_prefetch(self):
+        """
+        Tests the results are produced ahead in order and the ones not consumed are discarded
+        :return: None
+        """
+        produced = []
+        discarded = []
+
+        def fetch(item):
+            produced.append(item)
+            return "file{}".format(item)
+
+        prefetch = Prefetch(fetch, range(10), size=1, discard=discarded.append)
+        consumed = []
+        for item, result, exc_info in prefetch:
+            consumed.append(result)
+            if item == 2:
+                break
+        prefetch.close()
+        self.assertEqual(consumed, ["file0", "file1", "file2"])
+        self.assertTrue(len(produced) < 10)
+        self.assertEqual(sorted(discarded), ["file{}".format(item) for item in produced[3:]])
+
+        def failing(item):
+            if item == 1:
+                raise IOError("not found")
+            return item
+
+        prefetch = Prefetch(failing, range(5))
+        entries = list(prefetch)
+        prefetch.close()
+        self.assertEqual([entry[0] for entry in entries], [0, 1])
+        self.assertTrue(entries[1][2] is not None)
+
+
+class ReplicationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the replication files of MirrorTest
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        time.sleep(self.server.delay)
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content = self.server.files[self.path]
+        etag = '"{}"'.format(len(content))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class MirrorTest(unittest.TestCase):
+    """
+    Unittest for the local mirror of the replication files
+    """
+
+    def setUp(self):
+        """
+        Starts a local replication server
+        """
+        self.server = HTTPServer(("127.0.0.1", 0), ReplicationRequestHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        diff = io.BytesIO()
+        with open("test/test1.osc", "rb") as f:
+            with gzip.GzipFile(fileobj=diff, mode="wb") as out:
+                out.write(f.read())
+        self.server.files = {
+            "/state.txt": b"#Mon May 29 00:00:00 UTC 2017\nsequenceNumber=1234\ntimestamp=2017-05-29T00\\:00\\:00Z\n",
+            "/000/001/234.osc.gz": diff.getvalue(),
+            "/000/001/233.osc.gz": diff.getvalue()
+        }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Stops the server and removes the mirror
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_repeat_run(self):
+        """
+        Tests a repeat run is served from disk
+        :return: None
+        """
+        mirror = ReplicationMirror(self.path, self.url)
+        self.assertEqual(mirror.state(), "1234")
+        filename = mirror.diff("1234")
+        self.assertTrue(filename.endswith(os.path.join("000", "001", "234.osc.gz")))
+        self.assertEqual(self.server.requests, ["/state.txt", "/000/001/234.osc.gz"])
+
+        mirror = ReplicationMirror(self.path, self.url)
+        self.assertEqual(mirror.state(), "1234")
+        self.assertEqual(mirror.diff("1234"), filename)
+        self.assertEqual(self.server.requests, ["/state.txt", "/000/001/234.osc.gz", "/state.txt"])
+
+    def test_timeout(self):
+        """
+        Tests a request to a server that doesn't answer gives up
+        :return: None
+        """
+        import requests
+
+        self.server.delay = 0.5
+        mirror = ReplicationMirror(self.path, self.url, timeout=0.1)
+        self.assertRaises(requests.exceptions.Timeout, mirror.state)
+        index = SequenceIndex(self.url, timeout=0.1)
+        self.assertRaises(requests.exceptions.Timeout, index.latest)
+
+    def test_corrupt_diff(self):
+        """
+        Tests a corrupt diff is downloaded again
+        :return: None
+        """
+        mirror = ReplicationMirror(self.path, self.url)
+        filename = mirror.diff("1234")
+        with open(filename, "r+b") as f:
+            f.seek(10)
+            f.write(b"broken")
+        mirror.diff("1234")
+        self.assertEqual(self.server.requests, ["/000/001/234.osc.gz", "/000/001/234.osc.gz"])
+        self.server.files["/000/001/233.osc.gz"] = b"not gzip"
+        self.assertRaises(ValueError, mirror.diff, "1233")
+        self.assertEqual(mirror.diffs(), [filename])
+
+    def test_size_budget(self):
+        """
+        Tests the oldest diffs are removed when the mirror is over its budget
+        :return: None
+        """
+        mirror = ReplicationMirror(self.path, self.url, max_size=len(self.server.files["/000/001/234.osc.gz"]))
+        first = mirror.diff("1233")
+        second = mirror.diff("1234")
+        self.assertEqual(mirror.diffs(), [second])
+        self.assertFalse(os.path.exists(first))
+
+
+class SketchTest(unittest.TestCase):
+    """
+    Unittest for the approximate stats
+    """
+
+    def test_hyperloglog(self):
+        """
+        Tests the distinct counts against the exact ones and the merge of
+        overlapping sketches
+        :return: None
+        """
+        for count in (0, 1, 100, 5000, 100000):
+            sketch = HyperLogLog(12)
+            for identifier in range(count):
+                sketch.add(identifier)
+                sketch.add(identifier)
+            self.assertTrue(abs(sketch.count() - count) <= 3 * sketch.error * count)
+        self.assertEqual(sketch.error, 1.04 / 64)
+        first = HyperLogLog(12)
+        second = HyperLogLog(12)
+        union = HyperLogLog(12)
+        for identifier in range(30000):
+            union.add(identifier)
+            if identifier < 20000:
+                first.add(identifier)
+            if identifier >= 10000:
+                second.add(identifier)
+        first.merge(second)
+        self.assertEqual(first.registers, union.registers)
+        self.assertEqual(HyperLogLog.from_dict(first.to_dict()).registers, union.registers)
+        self.assertRaises(ValueError, first.merge, HyperLogLog(14))
+
+    def test_count_min(self):
+        """
+        Tests the count-min estimates are within their bound
+        :return: None
+        """
+        sketch = CountMinSketch(272, 5)
+        exact = {}
+        for indx in range(20000):
+            key = indx * indx % 1009
+            exact[key] = exact.get(key, 0) + 1
+            sketch.add(key)
+        bound = sketch.error * sketch.total
+        for key, count in exact.items():
+            estimate = sketch.estimate(key)
+            self.assertTrue(count <= estimate <= count + bound)
+        merged = CountMinSketch.from_dict(sketch.to_dict())
+        merged.merge(sketch)
+        self.assertEqual(merged.total, 40000)
+        self.assertEqual(merged.estimate(0), 2 * sketch.estimate(0))
+
+    def test_approximate_mode(self):
+        """
+        Tests the stats of a diff matched in approximate mode against the
+        exact ones, and the stats of two processes merged
+        :return: None
+        """
+        handle, path = tempfile.mkstemp(suffix=".osc")
+        with os.fdopen(handle, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <create>\n')
+            for identifier in range(1, 5001):
+                f.write('  <node id="{0}" version="1" changeset="{1}" timestamp="2017-05-27T21:19:43Z" '
+                        'user="user{2}" uid="{2}" lat="41.98" lon="2.81">\n'.format(
+                            identifier, identifier * 7919 % 1500, identifier % 50 if identifier % 4 else 7))
+                f.write('   <tag k="building" v="yes"/>\n')
+                if identifier % 3 == 0:
+                    f.write('   <tag k="addr:housenumber" v="{0}"/>\n'.format(identifier))
+                f.write('  </node>\n')
+            f.write(' </create>\n</osmChange>\n')
+        conf = {
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'building': {
+                    'tags': "building=.*",
+                    'type': 'node,way'
+                },
+                "housenumber": {
+                    "tags": "addr:housenumber=.*",
+                    "type": "way,node"
+                }
+            },
+            "url_locales": "locales"
+        }
+        try:
+            exact = ChangeWithin()
+            exact.load_config(conf)
+            exact.process_file(path)
+            approximate = ChangeWithin()
+            approximate.load_config(dict(conf, stats={"mode": "approximate", "precision": "12"}))
+            approximate.process_file(path)
+        finally:
+            os.unlink(path)
+
+        sketch = approximate.handler.sketch
+        error = 3 * sketch.changesets.error
+        self.assertEqual(approximate.changesets, {})
+        for name in ("building", "housenumber", "total"):
+            expected = exact.stats[name] if name == "total" else len(exact.stats[name])
+            self.assertTrue(abs(approximate.stats[name] - expected) <= error * expected)
+        summary = sketch.summary()
+        self.assertEqual(summary["rules"]["building"]["matches"], {"node": 5000, "way": 0, "relation": 0})
+        self.assertEqual(summary["rules"]["housenumber"]["matches"]["node"], 1666)
+        self.assertTrue(abs(summary["rules"]["building"]["elements"]["node"] - 5000) <= error * 5000)
+        self.assertTrue(abs(summary["rules"]["building"]["users"] - 50) <= error * 50)
+        # A quarter of the nodes are of the same user
+        matches = sum(2 if identifier % 3 == 0 else 1 for identifier in range(1, 5001)
+                      if identifier % 4 == 0 or identifier % 50 == 7)
+        self.assertEqual(summary["users"][0]["user"], "user7")
+        self.assertTrue(matches <= summary["users"][0]["matches"] <= matches + summary["matches_error"])
+        self.assertTrue(sketch.memory() < 250 * 1024)
+
+        merged = ApproximateStats.loads(sketch.dumps())
+        merged.merge(ApproximateStats.loads(sketch.dumps()))
+        self.assertEqual(merged.report_stats(), approximate.stats)
+        self.assertEqual(merged.summary()["rules"]["building"]["matches"]["node"], 10000)
+        self.assertRaises(ValueError, approximate.load_config, dict(conf, stats={"mode": "sampled"}))
 
 
 if __name__ == '__main__':